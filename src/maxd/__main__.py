@@ -1,12 +1,15 @@
 # -*- coding: utf-8 -*-
+import atexit
 import logging
 import signal
+import sys
 from argparse import ArgumentParser
 from logging.handlers import SysLogHandler
 
 logger = logging.getLogger(__name__)
 
 from maxd.daemon import Daemon
+from maxd.logqueue import start_queue_logging
 
 if __name__ == "__main__":  # pragma: nocover
     parser = ArgumentParser()
@@ -15,19 +18,102 @@ if __name__ == "__main__":  # pragma: nocover
     parser.add_argument('-d', '--debug', action='store_true', default=False, help="Enabled debug messages from the pymax library")
 
     parser.add_argument('--log-target', default='syslog')
+    parser.add_argument('--once', action='store_true', default=False, help="Run the worker once and exit (e.g. from cron or a systemd timer)")
+    parser.add_argument('--check-config', action='store_true', default=False, help="Validate the configuration file and exit")
+    parser.add_argument('--replay', metavar='PATH', help="Replay a recorded tick (or a directory of ticks) and compare the results")
+    parser.add_argument('--simulate', metavar='DAYS', type=int, help="Run the worker through DAYS days of virtual time against a stub cube and print a summary")
+    parser.add_argument('--simulate-interval', metavar='SECONDS', type=int, default=600, help="Virtual time between two simulated ticks (default: %(default)s)")
+    parser.add_argument('--control', metavar='COMMAND', help="Send a command (e.g. status, refresh) to the control socket of the running daemon")
+    parser.add_argument('--boost', metavar='ROOMS', help="Set a temporary temperature on the given rooms (comma separated) right away, through the control socket if it is set")
+    parser.add_argument('--boost-minutes', metavar='MINUTES', type=int, help="Duration of the boost (default: boost_duration)")
+    parser.add_argument('--boost-temperature', metavar='TEMPERATURE', type=float, help="Temperature of the boost (default: the high temperature of the room)")
 
     args = parser.parse_args()
 
     if args.log_target == 'syslog':
-        logging.basicConfig(level=logging.FATAL - (10 * args.verbose), format='maxd: [%(levelname)s] %(message)s',
-                            handlers=(SysLogHandler('/dev/log', facility=SysLogHandler.LOG_DAEMON), ))
+        log_handler = SysLogHandler('/dev/log', facility=SysLogHandler.LOG_DAEMON)
+        log_handler.setFormatter(logging.Formatter('maxd: [%(levelname)s] %(message)s'))
     else:
-        logging.basicConfig(level=logging.FATAL - (10 * args.verbose), format='%(asctime)s %(levelname)-7s %(message)s')
+        log_handler = logging.StreamHandler()
+        log_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)-7s %(message)s'))
+
+    # the handler runs in a thread of its own, a backed up syslog socket doesn't stall the worker
+    log_listener = start_queue_logging([log_handler], logging.FATAL - (10 * args.verbose))
+    if log_listener:
+        atexit.register(log_listener.stop)
 
     if not args.debug:
         pymax_logger = logging.getLogger('pymax')
         pymax_logger.setLevel(logging.WARNING)
 
+    if args.check_config:
+        from maxd.config import Configuration
+        problems = Configuration(args.config).check()
+        for problem in problems:
+            sys.stderr.write("%s\n" % problem)
+        sys.exit(1 if problems else 0)
+
+    if args.replay:
+        from maxd.replay import replay
+        failed = False
+        for result in replay(args.replay):
+            stages = ('fetch', 'schedule', 'apply', 'total')
+            sys.stdout.write("%s: %s %s\n" % (result['path'], ', '.join(
+                "%s %.3fs (recorded %.3fs)" % (stage, result['timings'].get(stage, 0), result['recorded_timings'].get(stage, 0))
+                for stage in stages
+            ), 'DIFFERENT' if result['diffs'] else 'OK'))
+            for line in result['diffs']:
+                sys.stdout.write("  %s\n" % line)
+            failed = failed or bool(result['diffs'])
+        sys.exit(1 if failed else 0)
+
+    if args.simulate:
+        import datetime
+        import pytz
+        from maxd.config import Configuration
+        from maxd.simulation import simulate
+        summary = simulate(Configuration(args.config), datetime.datetime.now(tz=pytz.UTC),
+                           datetime.timedelta(days=args.simulate), args.simulate_interval)
+        for key in sorted(summary.keys()):
+            sys.stdout.write("%s: %s\n" % (key, summary[key]))
+        sys.exit(1 if summary.get('failed_ticks') else 0)
+
+    if args.control:
+        import json
+        from maxd.config import Configuration
+        from maxd.control import send_command
+        control_socket = Configuration(args.config).control_socket
+        if not control_socket:
+            sys.stderr.write("control_socket is not set in %s\n" % args.config)
+            sys.exit(1)
+        response = send_command(control_socket, args.control)
+        sys.stdout.write("%s\n" % json.dumps(response, indent=2, sort_keys=True))
+        sys.exit(1 if 'error' in response else 0)
+
+    if args.boost:
+        import datetime
+        import json
+        from maxd.config import Configuration
+        config = Configuration(args.config)
+        minutes = args.boost_minutes or int(config.boost_duration.total_seconds() // 60)
+        if config.control_socket:
+            from maxd.control import send_command
+            command = 'boost %s %s' % (args.boost, minutes)
+            if args.boost_temperature is not None:
+                command += ' %s' % args.boost_temperature
+            response = send_command(config.control_socket, command)
+        else:
+            try:
+                response = Daemon(args.config).boost_once([x for x in args.boost.split(',') if x],
+                                                          datetime.timedelta(minutes=minutes), args.boost_temperature)
+            except Exception as ex:
+                response = {'error': str(ex)}
+        sys.stdout.write("%s\n" % json.dumps(response, indent=2, sort_keys=True))
+        sys.exit(1 if 'error' in response else 0)
+
+    if args.once:
+        sys.exit(0 if Daemon(args.config).run_once() else 1)
+
     daemon = None
 
     def stop_daemon(signum, frame):
@@ -35,8 +121,24 @@ if __name__ == "__main__":  # pragma: nocover
             logger.debug("Stopping daemon")
             daemon.stop()
 
+    def reload_config(signum, frame):
+        if daemon:
+            logger.info("Reloading configuration")
+            daemon.reload()
+
+    def profile(signum, frame):
+        if daemon:
+            daemon.profile()
+
+    def memory_snapshot(signum, frame):
+        if daemon:
+            daemon.memory_snapshot()
+
     signal.signal(signal.SIGTERM, stop_daemon)
     signal.signal(signal.SIGINT, stop_daemon)
+    signal.signal(signal.SIGHUP, reload_config)
+    signal.signal(signal.SIGUSR1, profile)
+    signal.signal(signal.SIGUSR2, memory_snapshot)
 
     daemon = Daemon(args.config)
     daemon.run()
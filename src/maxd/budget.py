@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+import collections
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+COLLAPSE = 'collapse'
+SKIP = 'skip'
+
+
+class ExpansionBudget(object):
+    """
+    Limits the number of occurrences and the time spent expanding the recurrence rules of one calendar, per series
+    and for the whole calendar. The reasons for series running out of budget are counted in `exceeded`.
+    """
+
+    # the clock is only read every that many iterations of a rule
+    check_every = 256
+
+    def __init__(self, name, series_occurrences=1000, calendar_occurrences=20000, series_seconds=1.0,
+                 calendar_seconds=10.0, overflow=COLLAPSE, clock=time.time):
+        self.name = name
+        self.series_occurrences = series_occurrences
+        self.calendar_occurrences = calendar_occurrences
+        self.series_seconds = series_seconds
+        self.calendar_seconds = calendar_seconds
+        self.overflow = overflow
+        self.clock = clock
+        self.started = clock()
+        self.occurrences = 0
+        self.exceeded = collections.Counter()
+
+    @classmethod
+    def for_calendar(cls, calendar_config, clock=time.time):
+        return cls(calendar_config.name, calendar_config.max_occurrences, calendar_config.max_calendar_occurrences,
+                   calendar_config.max_expand_time, calendar_config.max_calendar_expand_time,
+                   calendar_config.expand_overflow, clock)
+
+    def add(self, count):
+        """Counts occurrences which were expanded without the budget (e.g. by the arithmetic expansion)"""
+        self.occurrences += count
+
+    def expand(self, rule, after, before):
+        """
+        Returns the occurrences of the dateutil rule between after and before (both inclusive) and None, or the
+        occurrences found until the budget ran out and the reason ('series', 'calendar' or 'time').
+        """
+        series_started = self.clock()
+        occurrences = []
+
+        for i, dt in enumerate(rule):
+            if i % self.check_every == 0 and i:
+                now = self.clock()
+                if now - series_started >= self.series_seconds or now - self.started >= self.calendar_seconds:
+                    return occurrences, 'time'
+
+            if dt > before:
+                break
+            if dt < after:
+                continue
+
+            if len(occurrences) >= self.series_occurrences:
+                return occurrences, 'series'
+            if self.occurrences >= self.calendar_occurrences:
+                return occurrences, 'calendar'
+
+            occurrences.append(dt)
+            self.occurrences += 1
+
+        return occurrences, None
+
+    def record(self, reason, summary):
+        self.exceeded[reason] += 1
+        logger.warning("Expansion budget (%s) of calendar %s exceeded by '%s', %s", reason, self.name, summary,
+                       'collapsing the series' if self.overflow == COLLAPSE else 'skipping the series')
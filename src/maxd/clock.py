@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+import calendar
+import datetime
+import time
+
+import pytz
+
+
+class SystemClock(object):
+    """The wall clock"""
+
+    def now(self):
+        return datetime.datetime.now(tz=pytz.UTC)
+
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+class VirtualClock(object):
+    """A clock which only moves when it is told to. sleep() advances it immediately."""
+
+    def __init__(self, start):
+        self.current = start.astimezone(pytz.UTC) if start.tzinfo else start.replace(tzinfo=pytz.UTC)
+
+    def now(self):
+        return self.current
+
+    def time(self):
+        return calendar.timegm(self.current.utctimetuple()) + self.current.microsecond / 1000000.0
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def advance(self, seconds):
+        self.current += datetime.timedelta(seconds=seconds)
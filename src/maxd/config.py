@@ -3,6 +3,7 @@ import collections
 import logging
 import datetime
 import re
+import tempfile
 from functools import wraps
 
 try:
@@ -85,12 +86,38 @@ def time_range(s):
             yield int(m.group(1)), int(m.group(2)), int(m.group(3)), int(m.group(4))
 
 
-class CalendarConfig(collections.namedtuple('CalendarConfig', ('name', 'url', 'username', 'password', 'filter'))):
+def byte_size(s):
+    if s is None or isinstance(s, int):
+        return s
+
+    m = re.match(r"^\s*(\d+)\s*([kmg]?)b?\s*$", s, re.IGNORECASE)
+    if not m:
+        raise ValueError("Unparsable size: %s" % s)
+    return int(m.group(1)) * {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}[m.group(2).lower()]
+
+
+class CalendarConfig(collections.namedtuple('CalendarConfig', ('name', 'url', 'username', 'password', 'filter', 'caldav',
+                                                               'connect_timeout', 'read_timeout', 'max_size',
+                                                               'max_occurrences', 'max_calendar_occurrences',
+                                                               'max_expand_time', 'max_calendar_expand_time',
+                                                               'expand_overflow', 'index', 'refresh', 'fast_parse'))):
 
     def __new__(cls, **kwargs):
         kwargs.setdefault('username', None)
         kwargs.setdefault('password', None)
         kwargs.setdefault('filter', None)
+        kwargs.setdefault('caldav', False)
+        kwargs.setdefault('connect_timeout', 10)
+        kwargs.setdefault('read_timeout', 30)
+        kwargs.setdefault('max_size', 32 * 1024 * 1024)
+        kwargs.setdefault('max_occurrences', 1000)
+        kwargs.setdefault('max_calendar_occurrences', 20000)
+        kwargs.setdefault('max_expand_time', 1.0)
+        kwargs.setdefault('max_calendar_expand_time', 10.0)
+        kwargs.setdefault('expand_overflow', 'collapse')
+        kwargs.setdefault('index', False)
+        kwargs.setdefault('refresh', None)
+        kwargs.setdefault('fast_parse', False)
         return super(CalendarConfig, cls).__new__(cls, **kwargs)
 
     @property
@@ -98,6 +125,16 @@ class CalendarConfig(collections.namedtuple('CalendarConfig', ('name', 'url', 'u
         return bool(self.username and self.password)
 
 
+class RoomConfig(collections.namedtuple('RoomConfig', ('label', 'room_id', 'name', 'rf_addr', 'calendars', 'filter',
+                                                       'high_temperature', 'low_temperature'))):
+    """A [room:<label>] section: the rooms it matches and their calendars, filter and temperatures"""
+
+    def matches(self, room):
+        return (self.room_id is not None and room.room_id == self.room_id) or \
+               (bool(self.name) and room.name == self.name) or \
+               (self.rf_addr is not None and room.rf_address == self.rf_addr)
+
+
 class Configuration(object):
 
     def __init__(self, config_path):
@@ -105,12 +142,17 @@ class Configuration(object):
         self.cfg_parser = None
         self._calendar = None
         self._static = None
+        self._rooms = None
         self.reload()
 
     def reload(self):
-        self.cfg_parser = ConfigParser()
-        if not self.cfg_parser.read(self.path) == [self.path]:
+        cfg_parser = ConfigParser()
+        if not cfg_parser.read(self.path) == [self.path]:
             raise Exception("Failed to read configuration file %s" % self.path)
+        self.cfg_parser = cfg_parser
+        self._calendar = None
+        self._static = None
+        self._rooms = None
 
     def get_option(self, section, option, default=None):
         return self.cfg_parser.get(section, option) if self.cfg_parser.has_option(section, option) else default
@@ -118,6 +160,12 @@ class Configuration(object):
     def get_int(self, section, option, default=None):
         return self.cfg_parser.getint(section, option) if self.cfg_parser.has_option(section, option) else default
 
+    def get_float(self, section, option, default=None):
+        return self.cfg_parser.getfloat(section, option) if self.cfg_parser.has_option(section, option) else default
+
+    def get_bool(self, section, option, default=None):
+        return self.cfg_parser.getboolean(section, option) if self.cfg_parser.has_option(section, option) else default
+
     @property
     def calendars(self):
         if self._calendar is None:
@@ -132,7 +180,19 @@ class Configuration(object):
 
                 calconf = CalendarConfig(name=section_name, url=url,
                                          username=self.get_option(section_name, 'username'),
-                                         password=self.get_option(section_name, 'password'))
+                                         password=self.get_option(section_name, 'password'),
+                                         caldav=self.get_bool(section_name, 'caldav', False),
+                                         connect_timeout=self.get_int(section_name, 'connect_timeout', 10),
+                                         read_timeout=self.get_int(section_name, 'read_timeout', 30),
+                                         max_size=byte_size(self.get_option(section_name, 'max_size', '32M')),
+                                         max_occurrences=self.get_int(section_name, 'max_occurrences', 1000),
+                                         max_calendar_occurrences=self.get_int(section_name, 'max_calendar_occurrences', 20000),
+                                         max_expand_time=self.get_float(section_name, 'max_expand_time', 1.0),
+                                         max_calendar_expand_time=self.get_float(section_name, 'max_calendar_expand_time', 10.0),
+                                         expand_overflow=self.get_option(section_name, 'expand_overflow', 'collapse'),
+                                         index=self.get_bool(section_name, 'index', False),
+                                         refresh=self.get_int(section_name, 'refresh', None),
+                                         fast_parse=self.get_bool(section_name, 'fast_parse', False))
                 self._calendar.append(calconf)
 
         return self._calendar
@@ -155,6 +215,75 @@ class Configuration(object):
     def low_temperature(self):
         return self.get_int('GENERAL', 'low_temperature', 10)
 
+    @property
+    @timediff
+    def boost_duration(self):
+        return self.get_option('GENERAL', 'boost_duration', '60')
+
+    @property
+    def tick_timeout(self):
+        return self.get_int('GENERAL', 'tick_timeout', 120)
+
+    @property
+    def io_retries(self):
+        return self.get_int('GENERAL', 'retries', 2)
+
+    @property
+    def retry_backoff(self):
+        return self.get_int('GENERAL', 'retry_backoff', 1)
+
+    @property
+    def breaker_threshold(self):
+        return self.get_int('GENERAL', 'breaker_threshold', 3)
+
+    @property
+    def breaker_reset(self):
+        return self.get_int('GENERAL', 'breaker_reset', 300)
+
+    @property
+    def reconcile_interval(self):
+        return self.get_int('GENERAL', 'reconcile_interval', 3600)
+
+    @property
+    def reconcile_writes(self):
+        return self.get_int('GENERAL', 'reconcile_writes', 7)
+
+    @property
+    def record_dir(self):
+        return self.get_option('GENERAL', 'record')
+
+    @property
+    def record_keep(self):
+        return self.get_int('GENERAL', 'record_keep', 1000)
+
+    @property
+    def control_socket(self):
+        return self.get_option('GENERAL', 'control_socket')
+
+    @property
+    def snapshot_file(self):
+        return self.get_option('GENERAL', 'snapshot')
+
+    @property
+    def http_cache_size(self):
+        return byte_size(self.get_option('GENERAL', 'http_cache_size', '32M'))
+
+    @property
+    def http_cache_dir(self):
+        return self.get_option('GENERAL', 'http_cache_dir')
+
+    @property
+    def http_cache_disk_size(self):
+        return byte_size(self.get_option('GENERAL', 'http_cache_disk_size', '256M'))
+
+    @property
+    def profile_dir(self):
+        return self.get_option('GENERAL', 'profile_dir', tempfile.gettempdir())
+
+    @property
+    def profile_ticks(self):
+        return self.get_int('GENERAL', 'profile_ticks', 5)
+
     @property
     def cube_serial(self):
         return self.get_option('cube', 'serial')
@@ -205,10 +334,87 @@ class Configuration(object):
     def room_rf_addr(self):
         return self.get_int('room', 'rf_addr')
 
+    @max_value(30)
+    @min_value(5)
+    def _room_temperature(self, section, option, default):
+        return self.get_int(section, option, default)
+
+    @property
+    def rooms(self):
+        """The rooms mapped in [room:<label>] sections. Without such sections, the [room] section applies."""
+        if self._rooms is None:
+            self._rooms = []
+            calendar_names = [c.name for c in self.calendars]
+
+            for section_name in self.cfg_parser.sections():
+                if not section_name.startswith('room:'):
+                    continue
+
+                calendars = self.get_option(section_name, 'calendars')
+                self._rooms.append(RoomConfig(
+                    label=section_name[len('room:'):].strip(),
+                    room_id=self.get_int(section_name, 'id'),
+                    name=self.get_option(section_name, 'name'),
+                    rf_addr=self.get_int(section_name, 'rf_addr'),
+                    calendars=tuple(x.strip() for x in calendars.split(',') if x.strip()) if calendars is not None else tuple(calendar_names),
+                    filter=self.get_option(section_name, 'filter'),
+                    high_temperature=self._room_temperature(section_name, 'high_temperature', self.high_temperature),
+                    low_temperature=self._room_temperature(section_name, 'low_temperature', self.low_temperature),
+                ))
+
+        return self._rooms
+
     @property
     def has_room_settings(self):
         return self.room_id or self.room_name or self.room_rf_addr
 
+    def check(self):
+        """Reads every setting once and returns a list of problems found in the configuration file."""
+        problems = []
+
+        names = [x.strip() for x in self.get_option('GENERAL', 'calendars', '').split(',') if x.strip()]
+        for section_name in names:
+            if not self.cfg_parser.has_section(section_name):
+                problems.append("Calendar section '%s' is missing" % section_name)
+            elif not self.get_option(section_name, 'url'):
+                problems.append("Calendar '%s' has no url" % section_name)
+            elif self.get_option(section_name, 'expand_overflow', 'collapse') not in ('collapse', 'skip'):
+                problems.append("Calendar '%s': expand_overflow must be collapse or skip" % section_name)
+
+        for name in ('warmup_duration', 'high_temperature', 'low_temperature', 'cube_port', 'static_schedule',
+                     'room_id', 'room_name', 'room_rf_addr', 'allday_range', 'tick_timeout', 'io_retries',
+                     'retry_backoff', 'breaker_threshold', 'breaker_reset', 'reconcile_interval', 'reconcile_writes',
+                     'http_cache_size', 'http_cache_disk_size', 'boost_duration', 'record_keep'):
+            try:
+                getattr(self, name)
+            except Exception as ex:
+                problems.append("Invalid value for %s: %s" % (name, ex))
+
+        try:
+            calendar_names = [c.name for c in self.calendars]
+        except Exception as ex:
+            calendar_names = []
+            problems.append("Invalid calendar settings: %s" % ex)
+
+        try:
+            for room in self.rooms:
+                if room.room_id is None and not room.name and room.rf_addr is None:
+                    problems.append("Room '%s' has no id, name or rf_addr" % room.label)
+                for name in room.calendars:
+                    if name not in calendar_names:
+                        problems.append("Room '%s' uses unknown calendar '%s'" % (room.label, name))
+        except Exception as ex:
+            problems.append("Invalid room settings: %s" % ex)
+
+        if self.cube_timezone:
+            import pytz
+            try:
+                pytz.timezone(self.cube_timezone)
+            except pytz.UnknownTimeZoneError:
+                problems.append("Unknown cube timezone: %s" % self.cube_timezone)
+
+        return problems
+
     @property
     def allday_range(self):
         a, b, c, d = list(time_range(self.get_option('GENERAL', 'allday', '06:00 - 23:00')))[0]
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import datetime
+import json
+import logging
+import os
+import socket
+import threading
+
+try:
+    import SocketServer as socketserver
+except ImportError: # pragma: nocover
+    import socketserver
+
+logger = logging.getLogger(__name__)
+
+
+class ControlRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Handles a single command per connection. A command is a line of text, e.g. "status" or "refresh cal1 cal2", the
+    response a single line of JSON.
+    """
+
+    def handle(self):
+        line = self.rfile.readline(4096).decode('utf-8').strip()
+        if not line:
+            return
+
+        chunks = line.split()
+        command, args = chunks[0].lower(), chunks[1:]
+        handler = getattr(self.server, 'command_%s' % command, None)
+
+        try:
+            if handler is None:
+                response = {'error': "Unknown command: %s" % command}
+            else:
+                response = handler(*args)
+        except Exception as ex:
+            logger.exception("Control command '%s' failed" % line)
+            response = {'error': str(ex)}
+
+        self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+
+class ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """UNIX domain socket server to control a running daemon"""
+
+    daemon_threads = True
+    refresh_timeout = 60
+
+    def __init__(self, path, daemon):
+        if os.path.exists(path):
+            os.unlink(path)
+        socketserver.UnixStreamServer.__init__(self, path, ControlRequestHandler)
+        os.chmod(path, 0o660)
+        self.path = path
+        self.daemon = daemon
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, kwargs={'poll_interval': 0.5})
+        self.thread.daemon = True
+        self.thread.start()
+        logger.info("Control socket listening on %s" % self.path)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def command_status(self):
+        return self.daemon.status()
+
+    def command_refresh(self, *calendars):
+        done = self.daemon.refresh(list(calendars) or None)
+        if not done.wait(self.refresh_timeout):
+            return {'error': "Refresh did not finish within %s seconds" % self.refresh_timeout}
+        return {'result': 'ok', 'status': self.daemon.status()}
+
+    def command_reload(self):
+        done = self.daemon.reload()
+        if not done.wait(self.refresh_timeout):
+            return {'error': "Reload did not finish within %s seconds" % self.refresh_timeout}
+        return {'result': 'ok', 'status': self.daemon.status()}
+
+    def command_boost(self, rooms, minutes=None, temperature=None):
+        duration = datetime.timedelta(minutes=int(minutes)) if minutes is not None else None
+        result = self.daemon.boost([x for x in rooms.split(',') if x], duration,
+                                   float(temperature) if temperature is not None else None)
+        result['result'] = 'ok'
+        return result
+
+
+def send_command(path, command, timeout=None):
+    """Sends a command to the control socket at `path` and returns the decoded response"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall(command.encode('utf-8') + b'\n')
+
+        chunks = []
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return json.loads(b''.join(chunks).decode('utf-8'))
+    finally:
+        sock.close()
@@ -5,31 +5,191 @@ import threading
 import time
 
 from maxd.config import Configuration
-from maxd.worker import Worker
 
 logger = logging.getLogger(__name__)
 
+
+class LatestValue(object):
+    """
+    A slot for the most recent value of a producer. put() replaces a value the consumer didn't take yet, take()
+    waits for a value and empties the slot.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.value = None
+        self.full = False
+
+    def put(self, value, merge=None):
+        """Stores value, or merge(unsent value, value) if the slot still holds a value"""
+        with self.condition:
+            if self.full and merge:
+                value = merge(self.value, value)
+            elif self.full:
+                logger.debug("Replacing unsent value")
+            self.value, self.full = value, True
+            self.condition.notify_all()
+
+    def take(self, timeout=None):
+        """Returns the value, or None if there was none within timeout seconds"""
+        with self.condition:
+            if not self.full:
+                self.condition.wait(timeout)
+            if not self.full:
+                return None
+            value, self.value, self.full = self.value, None, False
+            return value
+
+
+class CubeWriterThread(threading.Thread):
+    """
+    Writes the desired states computed by the worker thread to the cube. The slot holds (state, events) pairs, the
+    events are set when the state was written (or failed to).
+    """
+
+    def __init__(self, worker, slot, lock, *args, **kwargs):
+        super(CubeWriterThread, self).__init__(*args, **kwargs)
+        self.worker = worker
+        self.slot = slot
+        self.lock = lock
+        self.exit = threading.Event()
+
+    def stop(self):
+        self.exit.set()
+
+    def run(self):
+        while not self.exit.is_set():
+            item = self.slot.take(1)
+            if item is None:
+                continue
+
+            state, events = item
+            try:
+                with self.lock:
+                    self.worker.write(state)
+            except:
+                logger.exception("Failed to write to the cube")
+            finally:
+                for done in events:
+                    done.set()
+
+        logger.info("cube writer thread exiting")
+
+
+def _merge_desired(unsent, latest):
+    # the unsent state is dropped, the callers waiting for it are told when the latest one was written
+    return latest[0], unsent[1] + latest[1]
+
+
 class WorkerThread(threading.Thread):
 
+    interval = 10
+
     def __init__(self, config_file, *args, **kwargs):
         super(WorkerThread, self).__init__(*args, **kwargs)
         self.config_file = config_file
         self.timer = None
+        self.worker = None
         self.exit = threading.Event()
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+        self.refresh_requests = []
+        self.reload_requests = []
+        self.profiler = None
+        # the desired state of the cube, written by the cube writer thread. The worker thread keeps fetching
+        # calendars while a slow write is running; a newer state replaces one which wasn't written yet.
+        self.desired = LatestValue()
+        self.write_lock = threading.Lock()
+        self.writer = None
+
+    def request_refresh(self, calendars=None):
+        """
+        Asks the worker thread to run immediately and to bypass the caches for the given calendars (all calendars
+        if None). Returns an event which is set when the run finished.
+        """
+        done = threading.Event()
+        with self.lock:
+            self.refresh_requests.append((calendars, done))
+        self.wakeup.set()
+        return done
+
+    def request_reload(self):
+        """
+        Asks the worker thread to reload the configuration before its next run. Returns an event which is set when
+        that run finished.
+        """
+        done = threading.Event()
+        with self.lock:
+            self.reload_requests.append(done)
+        self.wakeup.set()
+        return done
+
+    def boost(self, names, duration=None, temperature=None):
+        """
+        Sets a temporary temperature on the named rooms right away. Waits only for a write of the cube writer thread
+        which is already running, as the cube accepts one client at a time.
+        """
+        if self.worker is None:
+            raise Exception("The worker is not running yet")
+        with self.write_lock:
+            return self.worker.boost(names, duration, temperature)
+
+    def stop(self):
+        self.exit.set()
+        self.wakeup.set()
 
     def run(self):
-        worker = Worker(Configuration(self.config_file))
+        from maxd.worker import Worker
+
+        self.worker = Worker(Configuration(self.config_file))
 
         def _exec():
+            with self.lock:
+                requests, self.refresh_requests = self.refresh_requests, []
+                reloads, self.reload_requests = self.reload_requests, []
+
+            if reloads:
+                try:
+                    # not while the writer uses the settings which are about to change
+                    with self.write_lock:
+                        self.worker.reload_config()
+                except:
+                    logger.exception("Failed to reload configuration")
+
+            refresh = set()
+            for calendars, _ in requests:
+                refresh.update(calendars if calendars is not None else [c.name for c in self.worker.config.calendars])
+
+            events = [done for _, done in requests] + reloads
             try:
-                worker.execute()
+                if self.profiler:
+                    state = self.profiler.run(self.worker.compute, refresh=refresh)
+                else:
+                    state = self.worker.compute(refresh=refresh)
             except:
                 logger.exception("Worker failure")
+                for done in events:
+                    done.set()
+            else:
+                self.desired.put((state, events), _merge_desired)
+
+        try:
+            self.worker.warm_start()
+        except:
+            logger.exception("Warm start failed")
+
+        self.writer = CubeWriterThread(self.worker, self.desired, self.write_lock)
+        self.writer.daemon = True
+        self.writer.start()
 
-        _exec()
-        while not self.exit.wait(10):
+        while not self.exit.is_set():
+            # refresh requests coming in while _exec() runs set wakeup again and are handled right afterwards
+            self.wakeup.clear()
             _exec()
+            self.wakeup.wait(self.interval)
 
+        self.writer.stop()
+        self.writer.join()
         logger.info("worker thread exiting")
 
 
@@ -39,13 +199,30 @@ class Daemon(object):
         super(Daemon, self).__init__(*args, **kwargs)
         self.config_file = config_file
         self.worker_thread = None
+        self.control_server = None
+        self.profiler = None
+        self.memory_snapshots = None
 
     def run(self):
+        from maxd.profiling import TickProfiler, MemorySnapshots
+
+        config = Configuration(self.config_file)
+        self.profiler = TickProfiler(config.profile_dir)
+        self.memory_snapshots = MemorySnapshots(config.profile_dir)
+        self.profile_ticks = config.profile_ticks
+
         logger.info("Starting worker thread")
         self.worker_thread = WorkerThread(self.config_file)
+        self.worker_thread.profiler = self.profiler
         self.worker_thread.daemon = True
         self.worker_thread.start()
 
+        control_socket = config.control_socket
+        if control_socket:
+            from maxd.control import ControlServer
+            self.control_server = ControlServer(control_socket, self)
+            self.control_server.start()
+
         while True:
             time.sleep(1)
             if self.worker_thread.exit.is_set():
@@ -53,8 +230,50 @@ class Daemon(object):
                 self.worker_thread.join()
                 break
 
+    def run_once(self):
+        from maxd.worker import Worker
+
+        logger.info("Running worker once")
+        try:
+            Worker(Configuration(self.config_file)).execute()
+        except:
+            logger.exception("Worker failure")
+            return False
+        return True
+
+    def status(self):
+        worker = self.worker_thread.worker if self.worker_thread else None
+        return worker.status() if worker else {}
+
+    def refresh(self, calendars=None):
+        return self.worker_thread.request_refresh(calendars)
+
+    def reload(self):
+        return self.worker_thread.request_reload()
+
+    def boost(self, names, duration=None, temperature=None):
+        return self.worker_thread.boost(names, duration, temperature)
+
+    def boost_once(self, names, duration=None, temperature=None):
+        from maxd.worker import Worker
+
+        logger.info("Boosting %s" % ', '.join(names))
+        return Worker(Configuration(self.config_file)).boost(names, duration, temperature)
+
+    def profile(self, ticks=None):
+        """Profiles the next `ticks` runs of the worker (profile_ticks if None)"""
+        if self.profiler:
+            self.profiler.request(ticks or self.profile_ticks)
+
+    def memory_snapshot(self):
+        if self.memory_snapshots:
+            return self.memory_snapshots.snapshot()
+
     def stop(self):
+        if self.control_server:
+            logger.debug("Stopping control server")
+            self.control_server.stop()
         logger.debug("Stopping worker thread")
-        self.worker_thread.exit.set()
+        self.worker_thread.stop()
         self.worker_thread.join()
         logger.debug("Worker Thread join()ed")
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Fast parsing of calendar documents. The content lines are tokenised without decoding them; only the VEVENT
+properties maxd uses, the VTIMEZONEs they refer to and the requested calendar properties are handed to icalendar.
+All other components (VALARM, VTODO, VJOURNAL, ...) and properties (DESCRIPTION, ATTENDEE, ATTACH, ...) are skipped
+without being decoded.
+"""
+import re
+
+from maxd.index import KEY_PROPERTIES
+
+# the VEVENT properties maxd reads: the ones which make up its identity and content in the event index
+EVENT_PROPERTIES = frozenset(name.encode('ascii') for name in KEY_PROPERTIES)
+
+# a line break which isn't followed by a folded continuation line
+_lines = re.compile(br'\r?\n(?![ \t])')
+_name = re.compile(br'[A-Za-z0-9-]+')
+
+VCALENDAR = b'VCALENDAR'
+VEVENT = b'VEVENT'
+VTIMEZONE = b'VTIMEZONE'
+
+
+def reduce_document(data, event_properties=EVENT_PROPERTIES, calendar_properties=()):
+    """
+    Returns the calendar document `data` (bytes or text) with only the `event_properties` of the top level VEVENTs,
+    the VTIMEZONEs and the `calendar_properties` (names as text) of the VCALENDAR.
+    """
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    calendar_properties = frozenset(name.upper().encode('ascii') for name in calendar_properties)
+
+    kept = []
+    # the names of the open components and the top level component below the VCALENDAR
+    stack = []
+    component = None
+
+    for line in _lines.split(data):
+        m = _name.match(line)
+        name = m.group(0).upper() if m else b''
+        depth = len(stack)
+
+        if name == b'BEGIN':
+            stack.append(line[6:].strip().upper())
+            if depth == 0:
+                kept.append(line)
+            elif depth == 1:
+                component = stack[-1]
+                if component in (VEVENT, VTIMEZONE):
+                    kept.append(line)
+            elif component == VTIMEZONE:
+                kept.append(line)
+        elif name == b'END':
+            if depth == 1 or (depth == 2 and component == VEVENT) or component == VTIMEZONE:
+                kept.append(line)
+            if stack:
+                stack.pop()
+            if depth == 2:
+                component = None
+        elif depth == 1:
+            if name in calendar_properties or name == b'VERSION':
+                kept.append(line)
+        elif depth == 2 and component == VEVENT:
+            if name in event_properties:
+                kept.append(line)
+        elif component == VTIMEZONE:
+            kept.append(line)
+
+    kept.append(b'')
+    return b'\r\n'.join(kept)
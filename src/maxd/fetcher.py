@@ -1,47 +1,392 @@
 # -*- coding: utf-8 -*-
-from icalendar import Calendar
-from cachecontrol import CacheControl
-import requests
-from requests.auth import HTTPBasicAuth
+import datetime
+import email.utils
+import logging
+import os
+import time
+import xml.etree.ElementTree as ET
+
+from maxd.resilience import DeadlineExceeded
+
+# The calendar and HTTP libraries are imported where they are used. They account for most of maxd's start-up time and
+# are not needed for --help, --check-config or a run against local calendars only.
+
+logger = logging.getLogger(__name__)
+
+DAV_NS = 'DAV:'
+CALDAV_NS = 'urn:ietf:params:xml:ns:caldav'
+
+# calendar properties telling how often a feed should be refreshed, in order of preference (RFC 7986 first)
+FEED_TTL_PROPERTIES = ('REFRESH-INTERVAL', 'X-PUBLISHED-TTL')
+
+
+def _duration_seconds(value):
+    from icalendar.prop import vDuration
+
+    duration = getattr(value, 'dt', None)
+    if not isinstance(duration, datetime.timedelta):
+        try:
+            duration = vDuration.from_ical(str(value))
+        except ValueError:
+            return None
+    seconds = int(duration.total_seconds())
+    return seconds if seconds > 0 else None
+
+
+def _http_ttl(headers):
+    """Returns the seconds a response stays fresh according to its Cache-Control or Expires header, or None"""
+    max_age = None
+    for directive in headers.get('Cache-Control', '').split(','):
+        name, _, value = directive.strip().partition('=')
+        name = name.lower()
+        if name in ('no-cache', 'no-store'):
+            return None
+        if name in ('max-age', 's-maxage') and value.strip('"').isdigit():
+            max_age = int(value.strip('"'))
+
+    if max_age is not None:
+        age = headers.get('Age', '0')
+        return max(max_age - (int(age) if age.isdigit() else 0), 0) or None
+
+    expires = headers.get('Expires')
+    if expires:
+        expires = email.utils.parsedate_tz(expires)
+        date = email.utils.parsedate_tz(headers.get('Date', '')) if headers.get('Date') else None
+        if expires:
+            now = email.utils.mktime_tz(date) if date else time.time()
+            return max(int(email.utils.mktime_tz(expires) - now), 0) or None
+
+    return None
+
+
+def _vevents(data, properties=None, event_properties=None):
+    from icalendar import Calendar
+
+    if event_properties is not None:
+        from maxd.fastparse import reduce_document
+        data = reduce_document(data, event_properties, FEED_TTL_PROPERTIES)
+
+    calendar = Calendar.from_ical(data)
+    if properties is not None:
+        properties.clear()
+        properties.update((name, calendar[name]) for name in FEED_TTL_PROPERTIES if name in calendar)
+
+    for item in calendar.walk():
+        if item.name != "VEVENT":
+            continue
+
+        yield item
+
 
 class EventFetcher(object):
 
-    def fetch(self, calendar_config):
+    # whether failed fetches are worth retrying (e.g. network errors)
+    retryable = False
+
+    def __init__(self):
+        # the raw calendar documents the events of the last fetch() were parsed from
+        self.documents = []
+        # the refresh properties of the last parsed document and the freshness of the last HTTP response
+        self.feed_properties = {}
+        self.http_ttl = None
+        # the VEVENT properties to decode (see maxd.fastparse), None decodes the whole document
+        self.event_properties = None
+
+    def parse(self, data):
+        self.documents.append(data)
+        return _vevents(data, self.feed_properties, self.event_properties)
+
+    @property
+    def ttl(self):
+        """
+        Returns the number of seconds the data of the last fetch stays fresh according to the feed (REFRESH-INTERVAL or
+        X-PUBLISHED-TTL) or to the HTTP cache headers, or None if neither tells.
+        """
+        for name in FEED_TTL_PROPERTIES:
+            if name in self.feed_properties:
+                seconds = _duration_seconds(self.feed_properties[name])
+                if seconds:
+                    return seconds
+        return self.http_ttl
+
+    def fetch(self, calendar_config, start=None, end=None, deadline=None):
         raise NotImplementedError  # pragma: nocover
 
+    def invalidate(self):
+        """Makes the next fetch() bypass any cached data"""
+        pass
+
 
 class LocalCalendarEventFetcher(EventFetcher):
 
-    def fetch(self, calendar_config):
-        with open(calendar_config.url, 'r') as f:
-            calendar = Calendar.from_ical(f.read())
-            for item in calendar.walk():
-                if item.name != "VEVENT":
-                    continue
+    def __init__(self):
+        super(LocalCalendarEventFetcher, self).__init__()
+        self.file_index = None
+
+    def fetch(self, calendar_config, start=None, end=None, deadline=None):
+        self.documents = []
+        if calendar_config.index and os.path.getsize(calendar_config.url):
+            data = self.indexed_document(calendar_config, start, end)
+        else:
+            with open(calendar_config.url, 'r') as f:
+                data = f.read()
+
+        for item in self.parse(data):
+            yield item
+
+    def indexed_document(self, calendar_config, start=None, end=None):
+        """Returns a document with only the VEVENTs of the file which can overlap the window, using the file's index"""
+        from maxd.icsindex import CalendarFileIndex, open_mmap
+
+        if self.file_index is None or self.file_index.path != calendar_config.url:
+            self.file_index = CalendarFileIndex(calendar_config.url)
 
-                yield item
+        mm, stat = open_mmap(calendar_config.url)
+        try:
+            return self.file_index.document(mm, stat, start, end)
+        finally:
+            mm.close()
 
 
 class HTTPCalendarEventFetcher(EventFetcher):
 
-    def __init__(self):
-        self.session = CacheControl(requests.session())
+    chunk_size = 64 * 1024
+    retryable = True
+
+    def __init__(self, cache=None):
+        from cachecontrol import CacheControl
+        import requests
+
+        super(HTTPCalendarEventFetcher, self).__init__()
+        # the CacheControl cache backend, an unbounded in-memory cache if None
+        self.session = CacheControl(requests.session(), cache=cache)
+        self.no_cache = False
+
+    def invalidate(self):
+        self.no_cache = True
+
+    def request_kwargs(self, calendar_config, headers, deadline=None):
+        from requests.auth import HTTPBasicAuth
+
+        headers = dict(headers)
+        headers.setdefault('Accept-Encoding', 'gzip, deflate')
+        if self.no_cache:
+            headers['Cache-Control'] = 'no-cache'
 
-    def fetch(self, calendar_config):
         req_kwargs = {
-            'headers': {
-                'Accept': 'text/calendar'
-            }
+            'headers': headers,
+            'stream': True,
+            'timeout': (calendar_config.connect_timeout, calendar_config.read_timeout),
         }
+        if deadline:
+            req_kwargs['timeout'] = tuple(deadline.timeout(t) for t in req_kwargs['timeout'])
         if calendar_config.auth:
             req_kwargs['auth'] = HTTPBasicAuth(calendar_config.username, calendar_config.password)
+        return req_kwargs
 
-        response = self.session.get(calendar_config.url, **req_kwargs)
-        response.raise_for_status()
+    def read_body(self, response, calendar_config, deadline=None):
+        """
+        Reads the (streamed) response body chunk by chunk. gzip and deflate encoded bodies are decompressed while
+        reading, the download is aborted as soon as the decompressed body exceeds the calendar's max_size.
+        """
+        max_size = calendar_config.max_size
+
+        content_length = response.headers.get('Content-Length')
+        if max_size and content_length and content_length.isdigit() and int(content_length) > max_size:
+            response.close()
+            raise Exception("Response from %s is too large (%s bytes, max_size is %s)" % (calendar_config.name, content_length, max_size))
+
+        chunks = []
+        size = 0
+        for chunk in response.iter_content(chunk_size=self.chunk_size):
+            if deadline and deadline.expired():
+                response.close()
+                raise DeadlineExceeded("Deadline exceeded while reading response from %s" % calendar_config.name)
+            size += len(chunk)
+            if max_size and size > max_size:
+                response.close()
+                raise Exception("Response from %s exceeds max_size of %s bytes" % (calendar_config.name, max_size))
+            chunks.append(chunk)
 
-        calendar = Calendar.from_ical(response.content)
-        for item in calendar.walk():
-            if item.name != "VEVENT":
-                continue
+        return b''.join(chunks)
 
+    def fetch(self, calendar_config, start=None, end=None, deadline=None):
+        self.documents = []
+        response = self.session.get(calendar_config.url, **self.request_kwargs(calendar_config, {
+            'Accept': 'text/calendar'
+        }, deadline))
+        response.raise_for_status()
+        self.no_cache = False
+        self.http_ttl = _http_ttl(response.headers)
+
+        for item in self.parse(self.read_body(response, calendar_config, deadline)):
             yield item
+
+
+def _caldav_time(dt):
+    import pytz
+
+    if dt.tzinfo:
+        dt = dt.astimezone(pytz.UTC)
+    return dt.strftime('%Y%m%dT%H%M%SZ')
+
+
+class CalDAVCalendarEventFetcher(HTTPCalendarEventFetcher):
+    """
+    Fetches events from a CalDAV collection. If a time window is given, a calendar-query REPORT with a time-range
+    filter is sent, so that the server only returns the events in the window (expanded by the server, if it
+    supports it). Servers which reject the calendar-query are synchronized incrementally with sync-collection REPORTs
+    instead: only objects which changed since the last sync token are transferred and parsed.
+    """
+
+    # status codes of servers which do not support a REPORT (or parts of it)
+    unsupported_status = (400, 403, 405, 415, 501)
+
+    def __init__(self, cache=None):
+        super(CalDAVCalendarEventFetcher, self).__init__(cache)
+        self.expand_supported = True
+        self.query_supported = True
+        self.sync_token = None
+        self.objects = {}
+
+    def report(self, calendar_config, body, depth='1', deadline=None):
+        return self.session.request('REPORT', calendar_config.url, data=body.encode('utf-8'),
+                                    **self.request_kwargs(calendar_config, {
+                                        'Content-Type': 'application/xml; charset=utf-8',
+                                        'Depth': depth,
+                                    }, deadline))
+
+    def fetch(self, calendar_config, start=None, end=None, deadline=None):
+        self.documents = []
+        if start is not None and end is not None and self.query_supported:
+            response = self.report(calendar_config, self.calendar_query(start, end, self.expand_supported), deadline=deadline)
+
+            if response.status_code in self.unsupported_status and self.expand_supported:
+                logger.info("Server of %s rejected expanded calendar-query, retrying without expand", calendar_config.name)
+                response.close()
+                self.expand_supported = False
+                response = self.report(calendar_config, self.calendar_query(start, end, False), deadline=deadline)
+
+            if response.status_code in self.unsupported_status:
+                logger.info("Server of %s rejected calendar-query, using sync-collection", calendar_config.name)
+                response.close()
+                self.query_supported = False
+            else:
+                response.raise_for_status()
+                events = []
+                for _, _, data in self.parse_multistatus(self.read_body(response, calendar_config, deadline)):
+                    if data:
+                        events.extend(self.parse(data))
+                self.no_cache = False
+                return events
+
+        events = self.sync(calendar_config, deadline)
+        self.no_cache = False
+        return events
+
+    def calendar_query(self, start, end, expand):
+        time_range = 'start="%s" end="%s"' % (_caldav_time(start), _caldav_time(end))
+        return """<?xml version="1.0" encoding="utf-8"?>
+<C:calendar-query xmlns:D="DAV:" xmlns:C="urn:ietf:params:xml:ns:caldav">
+  <D:prop>
+    <C:calendar-data>%s</C:calendar-data>
+  </D:prop>
+  <C:filter>
+    <C:comp-filter name="VCALENDAR">
+      <C:comp-filter name="VEVENT">
+        <C:time-range %s/>
+      </C:comp-filter>
+    </C:comp-filter>
+  </C:filter>
+</C:calendar-query>""" % (('<C:expand %s/>' % time_range) if expand else '', time_range)
+
+    def sync_collection(self):
+        return """<?xml version="1.0" encoding="utf-8"?>
+<D:sync-collection xmlns:D="DAV:" xmlns:C="urn:ietf:params:xml:ns:caldav">
+  <D:sync-token>%s</D:sync-token>
+  <D:sync-level>1</D:sync-level>
+  <D:prop>
+    <D:getetag/>
+    <C:calendar-data/>
+  </D:prop>
+</D:sync-collection>""" % (self.sync_token or '')
+
+    def calendar_multiget(self, hrefs):
+        return """<?xml version="1.0" encoding="utf-8"?>
+<C:calendar-multiget xmlns:D="DAV:" xmlns:C="urn:ietf:params:xml:ns:caldav">
+  <D:prop>
+    <D:getetag/>
+    <C:calendar-data/>
+  </D:prop>
+  %s
+</C:calendar-multiget>""" % '\n  '.join('<D:href>%s</D:href>' % href for href in hrefs)
+
+    def sync(self, calendar_config, deadline=None):
+        response = self.report(calendar_config, self.sync_collection(), deadline=deadline)
+
+        if response.status_code in (403, 409) and self.sync_token:
+            # the server does not know our sync token (anymore) - start over with an initial sync
+            logger.info("Sync token for %s is invalid, doing a full sync", calendar_config.name)
+            response.close()
+            self.sync_token = None
+            self.objects = {}
+            response = self.report(calendar_config, self.sync_collection(), deadline=deadline)
+        response.raise_for_status()
+        content = self.read_body(response, calendar_config, deadline)
+        sync_token = self.parse_sync_token(content)
+
+        missing = []
+        for href, status, data in self.parse_multistatus(content):
+            if status == 404:
+                self.objects.pop(href, None)
+            elif data:
+                self.objects[href] = (data, list(_vevents(data)))
+            else:
+                missing.append(href)
+
+        if missing:
+            # some servers only report the changed hrefs, fetch their data with a single multiget
+            response = self.report(calendar_config, self.calendar_multiget(missing), deadline=deadline)
+            response.raise_for_status()
+            for href, status, data in self.parse_multistatus(self.read_body(response, calendar_config, deadline)):
+                if data:
+                    self.objects[href] = (data, list(_vevents(data)))
+
+        self.sync_token = sync_token or self.sync_token
+
+        events = []
+        for href in sorted(self.objects.keys()):
+            data, object_events = self.objects[href]
+            self.documents.append(data)
+            events.extend(object_events)
+        return events
+
+    def parse_multistatus(self, content):
+        root = ET.fromstring(content)
+
+        for response in root.findall('{%s}response' % DAV_NS):
+            href = response.findtext('{%s}href' % DAV_NS)
+
+            status = self._status_code(response.findtext('{%s}status' % DAV_NS))
+            data = None
+            for propstat in response.findall('{%s}propstat' % DAV_NS):
+                propstat_status = self._status_code(propstat.findtext('{%s}status' % DAV_NS))
+                calendar_data = propstat.find('{%s}prop/{%s}calendar-data' % (DAV_NS, CALDAV_NS))
+                if propstat_status == 200 and calendar_data is not None and (calendar_data.text or '').strip():
+                    data = calendar_data.text
+                    status = 200
+                elif status is None:
+                    status = propstat_status
+
+            yield href, status, data
+
+    def parse_sync_token(self, content):
+        root = ET.fromstring(content)
+        return root.findtext('{%s}sync-token' % DAV_NS)
+
+    def _status_code(self, status_line):
+        # HTTP/1.1 200 OK
+        if not status_line:
+            return None
+        chunks = status_line.split()
+        return int(chunks[1]) if len(chunks) > 1 and chunks[1].isdigit() else None
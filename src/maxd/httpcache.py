@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+A cache backend for CacheControl with a byte budget. The least recently used responses are evicted when the budget
+is exceeded; with a spill directory they are moved to disk (with a budget of their own) instead of being dropped.
+"""
+import collections
+import hashlib
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class BoundedCache(object):
+    """
+    Keeps cached responses in memory up to `max_bytes` and, if `spill_dir` is set, up to `max_disk_bytes` in files in
+    that directory. Both tiers evict the least recently used entries first. Responses larger than the memory budget go
+    to disk right away (or aren't cached at all).
+    """
+
+    def __init__(self, max_bytes, spill_dir=None, max_disk_bytes=None):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.lock = threading.Lock()
+        self.memory = collections.OrderedDict()
+        self.resident_bytes = 0
+        # file name -> size, least recently used first
+        self.disk = collections.OrderedDict()
+        self.disk_bytes = 0
+        self.counters = collections.Counter()
+
+        if spill_dir:
+            self._scan()
+
+    def _scan(self):
+        # responses spilled by a previous run are still valid cache entries
+        if not os.path.isdir(self.spill_dir):
+            os.makedirs(self.spill_dir)
+        entries = []
+        for name in os.listdir(self.spill_dir):
+            if name.endswith('.cache'):
+                st = os.stat(os.path.join(self.spill_dir, name))
+                entries.append((st.st_mtime, name, st.st_size))
+        for _, name, size in sorted(entries):
+            self.disk[name] = size
+            self.disk_bytes += size
+        self._evict_disk()
+
+    def _filename(self, key):
+        return '%s.cache' % hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def _path(self, filename):
+        return os.path.join(self.spill_dir, filename)
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                value = self.memory.pop(key)
+                self.memory[key] = value
+                self.counters['hits'] += 1
+                return value
+
+            value = self._read_disk(key)
+            if value is None:
+                self.counters['misses'] += 1
+                return None
+
+            self.counters['disk_hits'] += 1
+            if len(value) <= self.max_bytes:
+                self._remove_disk(self._filename(key))
+                self._store(key, value)
+            return value
+
+    def set(self, key, value, expires=None):
+        with self.lock:
+            self._remove(key)
+            if len(value) > self.max_bytes:
+                if not self._write_disk(key, value):
+                    self.counters['rejected'] += 1
+                return
+            self._store(key, value)
+
+    def delete(self, key):
+        with self.lock:
+            self._remove(key)
+
+    def close(self):
+        pass
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.memory):
+                self._remove(key)
+            for filename in list(self.disk):
+                self._remove_disk(filename)
+
+    def resize(self, max_bytes, max_disk_bytes=None):
+        """Changes the budgets and evicts entries until they are kept"""
+        with self.lock:
+            self.max_bytes = max_bytes
+            self.max_disk_bytes = max_disk_bytes
+            self._evict_memory()
+            self._evict_disk()
+
+    def _store(self, key, value):
+        self.memory[key] = value
+        self.resident_bytes += len(value)
+        self._evict_memory()
+
+    def _evict_memory(self):
+        while self.memory and self.resident_bytes > self.max_bytes:
+            old_key, old_value = self.memory.popitem(last=False)
+            self.resident_bytes -= len(old_value)
+            self.counters['evictions'] += 1
+            self._write_disk(old_key, old_value)
+
+    def _remove(self, key):
+        if key in self.memory:
+            self.resident_bytes -= len(self.memory.pop(key))
+        if self.spill_dir:
+            self._remove_disk(self._filename(key))
+
+    def _read_disk(self, key):
+        if not self.spill_dir:
+            return None
+        filename = self._filename(key)
+        if filename not in self.disk:
+            return None
+        try:
+            with open(self._path(filename), 'rb') as f:
+                value = f.read()
+        except (IOError, OSError):
+            self._remove_disk(filename)
+            return None
+        self.disk[filename] = self.disk.pop(filename)
+        return value
+
+    def _write_disk(self, key, value):
+        if not self.spill_dir or (self.max_disk_bytes is not None and len(value) > self.max_disk_bytes):
+            return False
+
+        filename = self._filename(key)
+        tmp_path = '%s.tmp' % self._path(filename)
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(value)
+            os.rename(tmp_path, self._path(filename))
+        except (IOError, OSError):
+            logger.exception("Failed to spill cached response to %s" % self.spill_dir)
+            return False
+
+        self.disk_bytes -= self.disk.pop(filename, 0)
+        self.disk[filename] = len(value)
+        self.disk_bytes += len(value)
+        self.counters['spilled'] += 1
+        self._evict_disk()
+        return True
+
+    def _remove_disk(self, filename):
+        if filename not in self.disk:
+            return
+        self.disk_bytes -= self.disk.pop(filename)
+        try:
+            os.unlink(self._path(filename))
+        except OSError:
+            pass
+
+    def _evict_disk(self):
+        while self.max_disk_bytes is not None and self.disk_bytes > self.max_disk_bytes:
+            filename = next(iter(self.disk))
+            self._remove_disk(filename)
+            self.counters['disk_evictions'] += 1
+
+    def stats(self):
+        with self.lock:
+            stats = dict((name, self.counters[name]) for name in ('hits', 'disk_hits', 'misses', 'evictions',
+                                                                 'spilled', 'disk_evictions', 'rejected'))
+            lookups = stats['hits'] + stats['disk_hits'] + stats['misses']
+            stats.update({
+                'hit_rate': float(stats['hits'] + stats['disk_hits']) / lookups if lookups else None,
+                'entries': len(self.memory),
+                'resident_bytes': self.resident_bytes,
+                'disk_entries': len(self.disk),
+                'disk_bytes': self.disk_bytes,
+            })
+            return stats
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Offset index for large local iCalendar files. The index records the byte range of every VEVENT and VTIMEZONE in the
+file together with the time span a VEVENT can possibly cover (from its DTSTART, DTEND/DURATION and the UNTIL of its
+RRULE). With the index, only the VEVENTs which can overlap the window have to be parsed. The index is kept in a
+sidecar file next to the calendar and rebuilt when the size or the modification time of the calendar changes.
+"""
+import calendar
+import datetime
+import json
+import logging
+import mmap
+import os
+import re
+
+logger = logging.getLogger(__name__)
+
+INDEX_VERSION = 1
+
+# times with a TZID or without a timezone are treated as UTC. The slack covers every UTC offset.
+SLACK = 24 * 3600
+
+_unfold = re.compile(br'\r?\n[ \t]')
+_alarms = re.compile(br'BEGIN:VALARM.*?END:VALARM', re.DOTALL)
+_property = re.compile(br'^(DTSTART|DTEND|DURATION|RRULE|RDATE)[;:](.*?)\r?$', re.MULTILINE)
+_datetime = re.compile(br'(\d{8})(?:T(\d{6}))?')
+_duration = re.compile(br'^[+-]?P(?:(\d+)W)?(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?$')
+_until = re.compile(br'UNTIL=([0-9TZ]+)')
+
+
+def _timestamp(value):
+    m = _datetime.match(value)
+    if not m:
+        return None, False
+    date, time = m.groups()
+    dt = datetime.datetime.strptime((date + (time or b'000000')).decode('ascii'), '%Y%m%d%H%M%S')
+    return calendar.timegm(dt.utctimetuple()), time is None
+
+
+def _duration_seconds(value):
+    m = _duration.match(value)
+    if not m:
+        return None
+    weeks, days, hours, minutes, seconds = [int(x or 0) for x in m.groups()]
+    return (((weeks * 7 + days) * 24 + hours) * 60 + minutes) * 60 + seconds
+
+
+def _value(params_and_value):
+    # DTSTART;TZID=Europe/Berlin:20151229T100000 -> 20151229T100000
+    return params_and_value.rsplit(b':', 1)[-1].strip()
+
+
+def event_span(block):
+    """
+    Returns the earliest start and the latest end (UNIX timestamps, None if unbounded) a VEVENT can cover, without
+    the slack for timezones.
+    """
+    block = _alarms.sub(b'', _unfold.sub(b'', block))
+    props = {}
+    for name, rest in _property.findall(block):
+        props.setdefault(name, rest)
+
+    if b'DTSTART' not in props:
+        return None, None
+
+    start, all_day = _timestamp(_value(props[b'DTSTART']))
+    if start is None:
+        return None, None
+
+    duration = None
+    if b'DTEND' in props:
+        end, _ = _timestamp(_value(props[b'DTEND']))
+        duration = end - start if end is not None else None
+    elif b'DURATION' in props:
+        duration = _duration_seconds(_value(props[b'DURATION']))
+    if duration is None:
+        duration = 86400 if all_day else 0
+
+    if b'RDATE' in props:
+        # additional dates can be anywhere
+        return None, None
+
+    if b'RRULE' in props:
+        m = _until.search(props[b'RRULE'])
+        if not m:
+            return start, None
+        until, _ = _timestamp(m.group(1))
+        return start, until + duration + (86400 if all_day else 0) if until is not None else None
+
+    return start, start + duration
+
+
+def _components(mm, name):
+    begin, end = b'BEGIN:' + name, b'END:' + name
+    pos = mm.find(begin)
+    while pos != -1:
+        stop = mm.find(end, pos)
+        if stop == -1:
+            break
+        stop += len(end)
+        yield pos, stop - pos
+        pos = mm.find(begin, stop)
+
+
+def build_index(mm):
+    events = []
+    for offset, length in _components(mm, b'VEVENT'):
+        start, end = event_span(mm[offset:offset + length])
+        events.append([offset, length, start, end])
+
+    return {
+        'version': INDEX_VERSION,
+        'timezones': [[offset, length] for offset, length in _components(mm, b'VTIMEZONE')],
+        'events': events,
+    }
+
+
+class CalendarFileIndex(object):
+    """The index of the iCalendar file at `path`, kept in `path`.idx"""
+
+    def __init__(self, path):
+        self.path = path
+        self.index_path = '%s.idx' % path
+        self.index = None
+        self.stat = None
+
+    def _load(self, stat):
+        try:
+            with open(self.index_path, 'r') as f:
+                index = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if index.get('version') != INDEX_VERSION or index.get('stat') != stat:
+            return None
+        return index
+
+    def _save(self, index):
+        tmp_path = '%s.tmp' % self.index_path
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(index, f, separators=(',', ':'))
+            os.rename(tmp_path, self.index_path)
+        except (IOError, OSError):
+            logger.warning("Could not write calendar index %s, keeping it in memory only" % self.index_path)
+
+    def update(self, mm, stat):
+        """
+        Loads or rebuilds the index if the file changed since the last call. `stat` is the size and modification time
+        of the mapped file, as returned by open_mmap().
+        """
+        if self.index is not None and self.stat == stat:
+            return self.index
+
+        index = self._load(stat)
+        if index is None:
+            logger.info("Building calendar index for %s" % self.path)
+            index = build_index(mm)
+            index['stat'] = stat
+            self._save(index)
+
+        self.index, self.stat = index, stat
+        return index
+
+    def document(self, mm, stat, start=None, end=None):
+        """
+        Returns a calendar document with all VTIMEZONEs of the file and the VEVENTs which can overlap the window
+        between start and end (all VEVENTs if start or end is None).
+        """
+        index = self.update(mm, stat)
+
+        if start is not None and end is not None:
+            window_start = calendar.timegm(start.utctimetuple()) - SLACK
+            window_end = calendar.timegm(end.utctimetuple()) + SLACK
+            events = [(o, l) for o, l, s, e in index['events']
+                      if s is None or (s <= window_end and (e is None or e >= window_start))]
+        else:
+            events = [(o, l) for o, l, _, _ in index['events']]
+
+        logger.debug("Parsing %s of %s VEVENTs of %s" % (len(events), len(index['events']), self.path))
+
+        chunks = [b'BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//maxd//calendar index//EN\r\n']
+        for offset, length in [tuple(t) for t in index['timezones']] + events:
+            chunks.append(mm[offset:offset + length])
+            chunks.append(b'\r\n')
+        chunks.append(b'END:VCALENDAR\r\n')
+        return b''.join(chunks)
+
+
+def open_mmap(path):
+    """
+    Returns a read only memory map of the file at `path` and the size and modification time of the mapped file. Both
+    come from the same descriptor, so they match even if the file is replaced in between.
+    """
+    with open(path, 'rb') as f:
+        st = os.fstat(f.fileno())
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), [st.st_size, st.st_mtime]
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+A schedule which is updated period by period. Next to the periods of every weekday it keeps their union (the
+effective periods, overlapping and adjacent periods merged), so adding or removing a period only touches the merged
+period it falls into. The weekdays whose effective periods changed are collected in `dirty`.
+"""
+import bisect
+import collections
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _union(periods):
+    """Merges sorted periods which overlap or touch"""
+    merged = []
+    for start, end in periods:
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class IncrementalSchedule(object):
+
+    def __init__(self):
+        # weekday -> sorted periods (with duplicates) and their sorted union
+        self.periods = {}
+        self.merged = {}
+        self.counts = collections.Counter()
+        self.dirty = set()
+
+    def add(self, weekday, period):
+        """Adds a period, returns True if the effective periods of the weekday changed"""
+        start, end = period
+        self.counts[(weekday, period)] += 1
+        bisect.insort(self.periods.setdefault(weekday, []), period)
+        merged = self.merged.setdefault(weekday, [])
+
+        # the merged periods overlapping or touching the new one
+        i = bisect.bisect_left(merged, (start, ))
+        if i > 0 and merged[i - 1][1] >= start:
+            i -= 1
+        j = i
+        while j < len(merged) and merged[j][0] <= end:
+            j += 1
+
+        if j == i + 1 and merged[i][0] <= start and merged[i][1] >= end:
+            # contained in an existing period
+            return False
+
+        if j > i:
+            start, end = min(start, merged[i][0]), max(end, merged[j - 1][1])
+        merged[i:j] = [(start, end)]
+        self.dirty.add(weekday)
+        return True
+
+    def remove(self, weekday, period):
+        """Removes a period, returns True if the effective periods of the weekday changed"""
+        if not self.counts[(weekday, period)]:
+            raise KeyError((weekday, period))
+        self.counts[(weekday, period)] -= 1
+        if not self.counts[(weekday, period)]:
+            del self.counts[(weekday, period)]
+
+        periods = self.periods[weekday]
+        del periods[bisect.bisect_left(periods, period)]
+        merged = self.merged[weekday]
+
+        # only the merged period the removed one was part of has to be rebuilt, from the periods starting in it. That's
+        # the last one starting at or before the removed period ((start, ) sorts before every (start, end)).
+        i = bisect.bisect_left(merged, (period[0], ))
+        if i == len(merged) or merged[i][0] != period[0]:
+            i -= 1
+        block_start, block_end = merged[i]
+
+        lo = bisect.bisect_left(periods, (block_start, ))
+        hi = lo
+        while hi < len(periods) and periods[hi][0] <= block_end:
+            hi += 1
+        rebuilt = _union(periods[lo:hi])
+
+        if rebuilt == [merged[i]]:
+            return False
+        merged[i:i + 1] = rebuilt
+        if not periods:
+            del self.periods[weekday]
+            del self.merged[weekday]
+        self.dirty.add(weekday)
+        return True
+
+    def update(self, schedule):
+        """
+        Changes the periods to the ones of `schedule` by adding and removing only the periods which differ. Returns
+        the weekdays whose effective periods changed.
+        """
+        target = collections.Counter((weekday, period) for weekday, periods in schedule.items() for period in periods)
+        removed = self.counts - target
+        added = target - self.counts
+
+        changed = set()
+        for (weekday, period), count in removed.items():
+            for _ in range(count):
+                if self.remove(weekday, period):
+                    changed.add(weekday)
+        for (weekday, period), count in added.items():
+            for _ in range(count):
+                if self.add(weekday, period):
+                    changed.add(weekday)
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Schedule update: %s period(s) removed, %s added", sum(removed.values()), sum(added.values()))
+        return changed
+
+    def take_dirty(self):
+        dirty, self.dirty = self.dirty, set()
+        return dirty
+
+    def schedule(self):
+        from maxd.worker import Schedule
+        return Schedule(dict((weekday, list(periods)) for weekday, periods in self.periods.items()))
+
+    def effective(self):
+        from maxd.worker import Schedule
+        return Schedule(dict((weekday, list(periods)) for weekday, periods in self.merged.items()), merged=True)
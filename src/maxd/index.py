@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+import bisect
+import datetime
+import logging
+
+logger = logging.getLogger(__name__)
+
+# the properties which make up the identity and the content of a VEVENT as far as maxd is concerned
+KEY_PROPERTIES = ('UID', 'RECURRENCE-ID', 'SEQUENCE', 'DTSTART', 'DTEND', 'DURATION', 'RRULE', 'EXDATE', 'SUMMARY')
+
+
+def event_key(cal_event):
+    """Returns a hashable key which changes when one of the relevant properties of the VEVENT changes"""
+    key = []
+    for name in KEY_PROPERTIES:
+        value = cal_event.get(name)
+        if value is None:
+            key.append(None)
+        elif isinstance(value, list):
+            key.append(tuple(v.to_ical() for v in value))
+        else:
+            key.append((value.to_ical() if hasattr(value, 'to_ical') else str(value),
+                        tuple(sorted(getattr(value, 'params', {}).items()))))
+    return tuple(key)
+
+
+class IntervalIndex(object):
+    """
+    Events sorted by their start. Together with the duration of the longest event, this allows to find all events
+    overlapping a time window with two bisections.
+    """
+
+    # adding more events than this at once rebuilds the index instead of inserting them one by one
+    bulk_threshold = 16
+
+    def __init__(self):
+        self.starts = []
+        self.items = []
+        self.max_duration = datetime.timedelta(0)
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, event):
+        i = bisect.bisect_right(self.starts, event.start)
+        self.starts.insert(i, event.start)
+        self.items.insert(i, event)
+        self.max_duration = max(self.max_duration, event.end - event.start)
+
+    def add_many(self, events):
+        events = list(events)
+        if len(events) <= self.bulk_threshold:
+            for event in events:
+                self.add(event)
+            return
+
+        self.items = sorted(self.items + events, key=lambda e: e.start)
+        self.starts = [e.start for e in self.items]
+        for event in events:
+            self.max_duration = max(self.max_duration, event.end - event.start)
+
+    def remove(self, event):
+        i = bisect.bisect_left(self.starts, event.start)
+        while i < len(self.items) and self.starts[i] == event.start:
+            if self.items[i] == event:
+                del self.starts[i]
+                del self.items[i]
+                return
+            i += 1
+        raise ValueError("%s not in index" % (event, ))
+
+    def clear(self):
+        self.starts = []
+        self.items = []
+        self.max_duration = datetime.timedelta(0)
+
+    def query(self, start, end):
+        """Returns the events which overlap the window from start to end (both inclusive), ordered by start"""
+        lo = bisect.bisect_left(self.starts, start - self.max_duration)
+        hi = bisect.bisect_right(self.starts, end)
+        return [e for e in self.items[lo:hi] if e.start >= start or e.end > start]
+
+
+class CalendarIndex(object):
+    """
+    Keeps the expanded occurrences of the VEVENTs of a calendar across ticks. Occurrences are expanded for the
+    requested window plus `horizon`, so the index only has to be rebuilt when the window moves past that range. In
+    between, only new or changed VEVENTs are expanded and only their occurrences are (re-)indexed.
+    """
+
+    horizon = datetime.timedelta(days=7)
+
+    def __init__(self):
+        self.index = IntervalIndex()
+        self.occurrences = {}
+        self.start = None
+        self.end = None
+
+    def update(self, cal_events, start, end, expand):
+        """
+        Indexes the occurrences of `cal_events` in the window from start to end. `expand` is called with the list of new
+        or changed VEVENTs and has to return a list of occurrences for each of them.
+        """
+        if self.start is None or start < self.start or end > self.end:
+            logger.debug("Window %s - %s not covered by index, rebuilding", start, end)
+            self.index.clear()
+            self.occurrences = {}
+            self.start, self.end = start, end + self.horizon
+
+        seen = set()
+        new = {}
+        for cal_event in cal_events:
+            key = event_key(cal_event)
+            seen.add(key)
+            if key not in self.occurrences:
+                new[key] = cal_event
+
+        added = []
+        if new:
+            keys = list(new)
+            for key, occurrences in zip(keys, expand([new[k] for k in keys], self.start, self.end)):
+                self.occurrences[key] = occurrences
+                added.extend(occurrences)
+
+        removed = [key for key in self.occurrences if key not in seen]
+        for key in removed:
+            for event in self.occurrences.pop(key):
+                self.index.remove(event)
+
+        self.index.add_many(added)
+
+        if added or removed:
+            logger.debug("Indexed %s new occurrence(s), removed %s VEVENT(s)", len(added), len(removed))
+
+    def query(self, start, end):
+        return self.index.query(start, end)
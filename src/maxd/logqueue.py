@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Logging off the worker threads. Records are put into a bounded queue and handed to the real handlers (e.g. syslog) by
+a listener thread, so a slow or blocked handler never stalls a tick; records are dropped when the queue is full.
+"""
+import logging
+import logging.handlers
+import threading
+import time
+
+try:
+    import queue
+except ImportError: # pragma: nocover
+    import Queue as queue
+
+logger = logging.getLogger(__name__)
+
+QueueHandler = getattr(logging.handlers, 'QueueHandler', None)
+QueueListener = getattr(logging.handlers, 'QueueListener', None)
+
+
+if QueueHandler is not None:
+    class DroppingQueueHandler(QueueHandler):
+        """A QueueHandler which drops records instead of blocking (or failing) when the queue is full"""
+
+        def __init__(self, q):
+            QueueHandler.__init__(self, q)
+            self.dropped = 0
+
+        def enqueue(self, record):
+            try:
+                self.queue.put_nowait(record)
+            except queue.Full:
+                self.dropped += 1
+
+    class FlushingQueueListener(QueueListener):
+        """A QueueListener which waits for room in a full queue when it is stopped, rather than failing"""
+
+        def enqueue_sentinel(self):
+            self.queue.put(self._sentinel)
+else: # pragma: nocover
+    DroppingQueueHandler = FlushingQueueListener = None
+
+
+def start_queue_logging(handlers, level=logging.NOTSET, queue_size=10000):
+    """
+    Sends the records of the root logger through a queue of `queue_size` records to `handlers`. Returns the started
+    listener (stop() it to flush the queue) or None if the logging module has no queue support (Python 2), in which
+    case the handlers are attached to the root logger directly.
+    """
+    root = logging.getLogger()
+    root.setLevel(level)
+
+    if DroppingQueueHandler is None: # pragma: nocover
+        for handler in handlers:
+            root.addHandler(handler)
+        return None
+
+    q = queue.Queue(queue_size)
+    root.addHandler(DroppingQueueHandler(q))
+    listener = FlushingQueueListener(q, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+class RateLimiter(object):
+    """
+    Lets at most `burst` messages per key through every `interval` seconds. allow() returns None for a message which
+    should be suppressed, otherwise the number of messages suppressed since the last one let through.
+    """
+
+    def __init__(self, burst, interval, clock=time.time):
+        self.burst = burst
+        self.interval = interval
+        self.clock = clock
+        self.lock = threading.Lock()
+        # key -> [window start, messages let through, messages suppressed]
+        self.windows = {}
+
+    def allow(self, key):
+        with self.lock:
+            now = self.clock()
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window else 0
+                self.windows[key] = [now, 1, 0]
+                return suppressed
+
+            if window[1] < self.burst:
+                window[1] += 1
+                suppressed, window[2] = window[2], 0
+                return suppressed
+
+            window[2] += 1
+            return None
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+The processing of a calendar as a chain of lazily evaluated stages: fetch (and parse) -> expand -> filter. Each stage
+gets the iterator of the previous stage and returns an iterator, nothing is evaluated until the output of the last
+stage is consumed. Every stage is instrumented (item count and time) and the output of a stage can be cached.
+"""
+import collections
+import logging
+import time
+
+from maxd.budget import ExpansionBudget
+from maxd.resilience import call_with_retries
+
+logger = logging.getLogger(__name__)
+
+Context = collections.namedtuple('Context', ('calendar_config', 'start', 'end', 'deadline'))
+
+
+class Stage(object):
+    """
+    A step of a Pipeline. process() gets the items of the previous stage and returns an iterable with the items for
+    the next stage; it should consume its input lazily.
+    """
+
+    name = None
+
+    def process(self, items, context):
+        raise NotImplementedError # pragma: nocover
+
+    def cache_key(self, context):
+        """
+        Returns the key to cache the output of this stage under or None if it can't be cached. A cache hit skips this
+        stage and all stages before it, so the output must only depend on the context.
+        """
+        return None
+
+
+class FunctionStage(Stage):
+    """A stage calling func(items, context)"""
+
+    def __init__(self, name, func):
+        self.name = name
+        self.func = func
+
+    def process(self, items, context):
+        return self.func(items, context)
+
+
+class FetchStage(Stage):
+    """Fetches the VEVENTs of the calendar. The fetcher parses the documents with its parse() method."""
+
+    name = 'fetch'
+
+    def __init__(self, worker):
+        self.worker = worker
+
+    def cache_key(self, context):
+        # the window is part of the key, the fetchers of CalDAV and indexed local calendars only return its events
+        return context.calendar_config, context.start, context.end
+
+    def process(self, items, context):
+        calendar_config = context.calendar_config
+        fetcher = self.worker.get_fetcher(calendar_config)
+
+        def _fetch():
+            return list(fetcher.fetch(calendar_config, context.start, context.end, deadline=context.deadline))
+
+        if fetcher.retryable:
+            config = self.worker.config
+            return call_with_retries(_fetch, config.io_retries, config.retry_backoff, context.deadline,
+                                     self.worker.get_breaker(calendar_config.name), self.worker.sleep)
+        return _fetch()
+
+
+class ExpandStage(Stage):
+    """Expands the VEVENTs into the calendar's index and returns the occurrences in the window"""
+
+    name = 'expand'
+
+    def __init__(self, worker):
+        self.worker = worker
+
+    def process(self, items, context):
+        from maxd.worker import _day_window
+
+        calendar_config = context.calendar_config
+        logger.info("Updating event index of %s", calendar_config.name)
+        start, end = _day_window(context.start, context.end)
+        budget = ExpansionBudget.for_calendar(calendar_config)
+
+        index = self.worker.get_index(calendar_config)
+        index.update(items, start, end, lambda cal_events, s, e: self.worker.expand_events(cal_events, s, e, budget))
+
+        if budget.exceeded:
+            overflows = self.worker.expansion_overflows.setdefault(calendar_config.name, collections.Counter())
+            overflows.update(budget.exceeded)
+        return index.query(start, end)
+
+
+class FilterStage(Stage):
+    """Applies the user filter of the calendar"""
+
+    name = 'filter'
+
+    def __init__(self, worker):
+        self.worker = worker
+
+    def process(self, items, context):
+        query_string = context.calendar_config.filter
+        logger.info("Applying user filter \"%s\" to events of %s", query_string, context.calendar_config.name)
+        return self.worker.apply_user_filter(query_string, items)
+
+
+class DictCache(object):
+    """An unbounded cache for stage outputs"""
+
+    def __init__(self):
+        self.items = {}
+
+    def get(self, key):
+        return self.items.get(key)
+
+    def set(self, key, value):
+        self.items[key] = value
+
+    def discard(self, key):
+        self.items.pop(key, None)
+
+    def clear(self):
+        self.items.clear()
+
+
+class RefreshCache(DictCache):
+    """
+    Keeps the output of a stage for the number of seconds `interval(key)` returns when it is stored. Outputs with no
+    interval (None or 0) are not kept.
+    """
+
+    def __init__(self, interval, clock=time.time):
+        super(RefreshCache, self).__init__()
+        self.interval = interval
+        self.clock = clock
+
+    def get(self, key):
+        entry = self.items.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if self.clock() >= expires:
+            del self.items[key]
+            return None
+        return value
+
+    def set(self, key, value):
+        now = self.clock()
+        # drop the outputs nobody asked for again (e.g. of a previous window)
+        for k in [k for k, (expires, _) in self.items.items() if now >= expires]:
+            del self.items[k]
+
+        interval = self.interval(key)
+        if interval:
+            self.items[key] = (now + interval, value)
+        else:
+            self.items.pop(key, None)
+
+    def expires(self, key):
+        entry = self.items.get(key)
+        return entry[0] if entry else None
+
+
+class StageStats(object):
+
+    def __init__(self):
+        self.items = 0
+        self.seconds = 0.0 # including the time spent in the previous stages
+        self.cached = False
+
+    def as_dict(self):
+        return {'items': self.items, 'seconds': self.seconds, 'cached': self.cached}
+
+
+class Pipeline(object):
+
+    def __init__(self, stages=()):
+        self.stages = []
+        self.stats = collections.OrderedDict()
+        for stage in stages:
+            self.add(stage)
+
+    def add(self, stage, cache=None, before=None):
+        """
+        Adds a stage with an optional cache (an object with get(key) and set(key, value)). The stage is appended or
+        inserted before the stage named `before`.
+        """
+        entry = (stage, cache)
+        if before is None:
+            self.stages.append(entry)
+        else:
+            self.stages.insert([s.name for s, _ in self.stages].index(before), entry)
+        return self
+
+    def replace(self, name, stage, cache=None):
+        i = [s.name for s, _ in self.stages].index(name)
+        self.stages[i] = (stage, cache)
+        return self
+
+    def __contains__(self, name):
+        return any(s.name == name for s, _ in self.stages)
+
+    def run(self, context, items=()):
+        """Returns an iterator over the output of the last stage. The stages run while it is consumed."""
+        self.stats = collections.OrderedDict()
+        for stage, cache in self.stages:
+            stats = self.stats[stage.name] = StageStats()
+            items = self._run_stage(stage, cache, items, context, stats)
+        return items
+
+    def timings(self):
+        """Returns the time spent in each stage alone"""
+        timings = {}
+        previous = 0.0
+        for name, stats in self.stats.items():
+            timings[name] = max(stats.seconds - previous, 0.0)
+            previous = stats.seconds
+        return timings
+
+    def _run_stage(self, stage, cache, items, context, stats):
+        key = stage.cache_key(context) if cache is not None else None
+        if key is not None:
+            cached = cache.get(key)
+            if cached is not None:
+                stats.cached = True
+                stats.items = len(cached)
+                return iter(cached)
+
+        output = self._instrument(stage, items, context, stats)
+        if key is not None:
+            output = self._store(cache, key, output)
+        return output
+
+    def _instrument(self, stage, items, context, stats):
+        t = time.time()
+        output = iter(stage.process(items, context))
+        stats.seconds += time.time() - t
+
+        while True:
+            t = time.time()
+            try:
+                item = next(output)
+            except StopIteration:
+                stats.seconds += time.time() - t
+                return
+            stats.seconds += time.time() - t
+            stats.items += 1
+            yield item
+
+    def _store(self, cache, key, output):
+        items = []
+        for item in output:
+            items.append(item)
+            yield item
+        cache.set(key, items)
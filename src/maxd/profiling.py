@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Profiling of the running daemon: cProfile for a number of worker ticks and tracemalloc snapshot diffs. Nothing is
+traced until a profile or a snapshot is requested.
+"""
+import datetime
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def _filename(directory, prefix, suffix):
+    return os.path.join(directory, '%s-%s.%s' % (prefix, datetime.datetime.now().strftime('%Y%m%dT%H%M%S%f'), suffix))
+
+
+class TickProfiler(object):
+    """
+    Profiles the next `ticks` calls of run() with cProfile and writes the accumulated statistics as a pstats file
+    (load it with python -m pstats <file>). request() may be called from any thread, run() has to be called from the
+    thread to profile.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.remaining = 0
+        self.profile = None
+        self.files = []
+
+    def request(self, ticks):
+        with self.lock:
+            self.remaining = ticks
+        logger.info("Profiling the next %s tick(s)" % ticks)
+
+    def run(self, func, *args, **kwargs):
+        if not self.remaining:
+            return func(*args, **kwargs)
+
+        import cProfile
+
+        if self.profile is None:
+            self.profile = cProfile.Profile()
+
+        self.profile.enable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.profile.disable()
+            with self.lock:
+                self.remaining = max(self.remaining - 1, 0)
+                done = not self.remaining
+            if done:
+                self.write()
+
+    def write(self):
+        profile, self.profile = self.profile, None
+        if profile is None:
+            return None
+
+        path = _filename(self.directory, 'profile', 'pstats')
+        try:
+            profile.dump_stats(path)
+        except (IOError, OSError):
+            logger.exception("Failed to write profile to %s" % path)
+            return None
+        logger.info("Wrote profile to %s" % path)
+        self.files.append(path)
+        return path
+
+
+class MemorySnapshots(object):
+    """
+    Takes tracemalloc snapshots and writes the `limit` allocation sites which grew the most since the previous snapshot.
+    The first snapshot starts tracing, so it has nothing to compare to.
+    """
+
+    def __init__(self, directory, limit=25):
+        self.directory = directory
+        self.limit = limit
+        self.previous = None
+
+    def snapshot(self):
+        try:
+            import tracemalloc
+        except ImportError: # pragma: nocover
+            logger.warning("tracemalloc is not available")
+            return None
+
+        if not tracemalloc.is_tracing():
+            logger.info("Starting tracemalloc, the next snapshot will be compared to this one")
+            tracemalloc.start()
+
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+        ))
+        previous, self.previous = self.previous, snapshot
+        if previous is None:
+            return None
+
+        path = _filename(self.directory, 'tracemalloc', 'txt')
+        try:
+            with open(path, 'w') as f:
+                f.write("Top %s allocation sites since the previous snapshot\n" % self.limit)
+                for stat in snapshot.compare_to(previous, 'lineno')[:self.limit]:
+                    f.write("%s\n" % stat)
+        except (IOError, OSError):
+            logger.exception("Failed to write tracemalloc snapshot diff to %s" % path)
+            return None
+        logger.info("Wrote tracemalloc snapshot diff to %s" % path)
+        return path
+
+    def stop(self):
+        try:
+            import tracemalloc
+        except ImportError: # pragma: nocover
+            return
+        self.previous = None
+        tracemalloc.stop()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Read-back of the week programs stored on the thermostats. The cube sends the configuration of every device, including
+its week program, to each client that connects. A reconciliation pass compares these programs with the ones written
+last and writes the mismatched (room, weekday) pairs again, a limited number per pass to stay within the duty cycle
+of the radio.
+"""
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+END_OF_DAY = 1440
+
+
+def normalize(programs):
+    """
+    Returns the program of a day as (temperature, end minute) pairs the way a thermostat stores it: temperatures in
+    steps of 0.5 degrees, times in steps of 5 minutes, without empty slots and with adjacent slots of the same
+    temperature merged.
+    """
+    result = []
+    for program in programs:
+        temperature = int(program.temperature * 2.0) / 2.0
+        end = min(int(program.end_minutes / 5) * 5, END_OF_DAY)
+        if end <= (result[-1][1] if result else 0):
+            continue
+        if result and result[-1][0] == temperature:
+            result[-1] = (temperature, end)
+        else:
+            result.append((temperature, end))
+        if end >= END_OF_DAY:
+            break
+    return result
+
+
+def stored_programs(cube):
+    """Returns the week programs (indexed by the cube's weekday numbers) of all devices with a configuration, by rf address"""
+    programs = {}
+    for device in getattr(cube, 'devices', None) or []:
+        configuration = device.get('configuration')
+        week_program = getattr(configuration, 'week_program', None)
+        if week_program:
+            programs[str(device.get('rf_address'))] = week_program
+    return programs
+
+
+class Reconciler(object):
+    """
+    Keeps the programs written for every (room, weekday) and re-sends those which the thermostats of the room don't
+    hold. Programs are only checked `settle` seconds after they were written. Pairs which were re-sent least recently
+    go first.
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        # (room id, room rf address, weekday) -> (room, programs, time written)
+        self.expected = {}
+        self.resent = {}
+        self.last_pass = None
+        self.stats = {'checked': 0, 'mismatched': 0, 'resent': 0}
+
+    def expect(self, room, weekday, programs):
+        self.expected[(room.room_id, str(room.rf_address), weekday)] = (room, list(programs), self.clock())
+
+    def clear(self):
+        self.expected.clear()
+        self.resent.clear()
+
+    def due(self, interval):
+        return bool(interval) and bool(self.expected) and \
+            (self.last_pass is None or self.clock() - self.last_pass >= interval)
+
+    def mismatches(self, cube, settle=0):
+        """Returns the keys of all (room, weekday) pairs whose thermostats hold a different program"""
+        from pymax.util import py_day_to_cube_day
+
+        stored = stored_programs(cube)
+        now = self.clock()
+        checked = 0
+        mismatched = []
+        for key, (room, programs, written) in sorted(self.expected.items(), key=lambda item: item[0]):
+            if now - written < settle:
+                continue
+            desired = normalize(programs)
+            weekday = py_day_to_cube_day(key[2])
+            for device in getattr(room, 'devices', None) or []:
+                week_program = stored.get(str(device.get('rf_address')))
+                if week_program is None:
+                    continue
+                checked += 1
+                if normalize(week_program[weekday]) != desired:
+                    mismatched.append(key)
+                    break
+
+        self.stats['checked'] = checked
+        return mismatched
+
+    def run(self, cube, max_writes, settle=0, deadline=None):
+        """Re-sends at most `max_writes` mismatched programs and returns their keys"""
+        self.last_pass = self.clock()
+        mismatched = self.mismatches(cube, settle)
+        self.stats['mismatched'] = len(mismatched)
+        if not mismatched:
+            logger.info("Programs of all thermostats match")
+            return []
+
+        mismatched.sort(key=lambda key: self.resent.get(key, 0))
+        resend = mismatched[:max_writes]
+        logger.warning("%s program(s) on the thermostats don't match, re-sending %s", len(mismatched), len(resend))
+        for key in resend:
+            if deadline:
+                deadline.check()
+            room, programs, _ = self.expected[key]
+            logger.info("Re-sending program of room %s on day %s", room.room_id, key[2])
+            cube.set_program(room.room_id, room.rf_address, key[2], programs)
+            self.expected[key] = (room, programs, self.clock())
+            self.resent[key] = self.clock()
+            self.stats['resent'] += 1
+        return resend
+
+    def status(self):
+        status = dict(self.stats)
+        status['last_pass'] = self.last_pass
+        return status
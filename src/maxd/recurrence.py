@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Arithmetic expansion of plain DAILY and WEEKLY recurrence rules.
+
+Each series is split into sub-series with a fixed step (one for DAILY rules, one per weekday for WEEKLY rules). The
+occurrences of a sub-series which fall into a window can then be computed directly instead of iterating over all
+occurrences since DTSTART. If NumPy is available, many sub-series are expanded at once.
+"""
+import collections
+import datetime
+import logging
+
+logger = logging.getLogger(__name__)
+
+WEEKDAYS = ('MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU')
+
+# expand with NumPy when there are at least this many sub-series, below that the setup costs more than it saves
+numpy_threshold = 64
+
+_epoch = datetime.datetime(1970, 1, 1)
+_day = 86400 * 1000000
+_week = 7 * _day
+
+
+class SimpleRule(collections.namedtuple('SimpleRule', ('freq', 'interval', 'byday', 'until', 'count'))):
+    pass
+
+
+def _to_us(dt):
+    delta = dt - _epoch
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def _from_us(us):
+    return _epoch + datetime.timedelta(microseconds=us)
+
+
+def _parse_until(value):
+    value = value.rstrip('Z')
+    for fmt in ('%Y%m%dT%H%M%S', '%Y%m%d'):
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    return None
+
+
+def parse_rule(rule_str, dtstart=None):
+    """
+    Returns a SimpleRule for a FREQ=DAILY or FREQ=WEEKLY rule with optional INTERVAL, BYDAY (plain weekdays, WEEKLY
+    only), UNTIL and COUNT. Returns None for all other rules, they have to be expanded with dateutil. Without
+    `dtstart`, weekly rules with an interval, BYDAY and a week start other than Monday are never simple.
+    """
+    parts = {}
+    for part in rule_str.split(';'):
+        if '=' not in part:
+            return None
+        name, value = part.split('=', 1)
+        parts[name.strip().upper()] = value.strip().upper()
+
+    freq = parts.pop('FREQ', None)
+    if freq not in ('DAILY', 'WEEKLY'):
+        return None
+
+    try:
+        interval = int(parts.pop('INTERVAL', 1))
+        count = int(parts.pop('COUNT')) if 'COUNT' in parts else None
+    except ValueError:
+        return None
+    if interval < 1:
+        return None
+
+    byday = None
+    if 'BYDAY' in parts:
+        days = parts.pop('BYDAY').split(',')
+        if freq != 'WEEKLY' or any(day not in WEEKDAYS for day in days):
+            return None
+        byday = tuple(sorted(set(WEEKDAYS.index(day) for day in days)))
+
+    # the week start decides which weeks an interval skips, unless the rule repeats on the weekday of DTSTART only
+    if parts.pop('WKST', 'MO') != 'MO' and interval > 1 and byday and \
+            (dtstart is None or byday != (dtstart.weekday(), )):
+        return None
+
+    until = None
+    if 'UNTIL' in parts:
+        until = _parse_until(parts.pop('UNTIL'))
+        if until is None or count is not None:
+            return None
+
+    if parts:
+        return None
+
+    return SimpleRule(freq=freq, interval=interval, byday=byday, until=until, count=count)
+
+
+def _sub_series(dtstart, rule):
+    """
+    Yields (first, step, first_index, index_step) for each sub-series of the rule: the n-th occurrence of a sub-series
+    is at first + n * step and is occurrence number first_index + n * index_step of the whole series.
+    """
+    if rule.freq == 'DAILY':
+        yield _to_us(dtstart), rule.interval * _day, 0, 1
+        return
+
+    days = rule.byday or (dtstart.weekday(), )
+    step = rule.interval * _week
+    week_start = _to_us(dtstart) - dtstart.weekday() * _day
+    # the days of the first week before DTSTART are no occurrences
+    skipped = len([day for day in days if day < dtstart.weekday()])
+
+    for rank, day in enumerate(days):
+        if day < dtstart.weekday():
+            yield week_start + day * _day + step, step, len(days) + rank - skipped, len(days)
+        else:
+            yield week_start + day * _day, step, rank - skipped, len(days)
+
+
+def _expand_python(sub_series):
+    result = collections.defaultdict(list)
+    for series, first, step, first_index, index_step, after, before, until, count in sub_series:
+        n_min = max(0, -((first - after) // step))
+        n_max = (before - first) // step
+        if until is not None:
+            n_max = min(n_max, (until - first) // step)
+        if count is not None:
+            n_max = min(n_max, (count - 1 - first_index) // index_step)
+        result[series].extend(first + n * step for n in range(n_min, n_max + 1))
+    return result
+
+
+def _import_numpy():
+    # NumPy takes about as long to import as the rest of maxd; it's only imported for a batch large enough to use it
+    try:
+        import numpy
+    except ImportError: # pragma: nocover
+        return None
+    return numpy
+
+
+def _expand_numpy(sub_series, numpy):
+    none = numpy.iinfo(numpy.int64).max
+    series, first, step, first_index, index_step, after, before, until, count = [
+        numpy.array([none if v is None else v for v in column], dtype=numpy.int64) for column in zip(*sub_series)
+    ]
+
+    n_min = numpy.maximum(0, -((first - after) // step))
+    n_max = (before - first) // step
+    n_max = numpy.where(until != none, numpy.minimum(n_max, (until - first) // step), n_max)
+    n_max = numpy.where(count != none, numpy.minimum(n_max, (count - 1 - first_index) // index_step), n_max)
+
+    counts = numpy.maximum(n_max - n_min + 1, 0)
+    total = int(counts.sum())
+    # one row per occurrence: the sub-series it belongs to and its position within the sub-series
+    rows = numpy.repeat(numpy.arange(len(counts)), counts)
+    positions = numpy.arange(total) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    times = first[rows] + (n_min[rows] + positions) * step[rows]
+
+    result = collections.defaultdict(list)
+    for s, t in zip(series[rows].tolist(), times.tolist()):
+        result[s].append(t)
+    return result
+
+
+def expand(series):
+    """
+    Expands a list of (dtstart, rule, after, before) tuples with naive datetimes and a SimpleRule each. Returns a list
+    with the sorted occurrences between after and before (both inclusive) of every series, like
+    dateutil.rrule.between(after, before, inc=True).
+    """
+    sub_series = []
+    for i, (dtstart, rule, after, before) in enumerate(series):
+        after, before = _to_us(after), _to_us(before)
+        until = _to_us(rule.until) if rule.until else None
+        for first, step, first_index, index_step in _sub_series(dtstart, rule):
+            sub_series.append((i, first, step, first_index, index_step, after, before, until, rule.count))
+
+    if not sub_series:
+        return [[] for _ in series]
+
+    numpy = _import_numpy() if len(sub_series) >= numpy_threshold else None
+    if numpy is not None:
+        occurrences = _expand_numpy(sub_series, numpy)
+    else:
+        occurrences = _expand_python(sub_series)
+
+    return [[_from_us(t) for t in sorted(occurrences.get(i, ()))] for i in range(len(series))]
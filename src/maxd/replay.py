@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+import collections
+import difflib
+import json
+import logging
+import os
+import tempfile
+
+try:
+    from StringIO import StringIO
+except ImportError: # pragma: nocover
+    from io import StringIO
+
+from maxd.config import Configuration
+from maxd.fetcher import EventFetcher
+from maxd.worker import Worker
+
+logger = logging.getLogger(__name__)
+
+RECORD_VERSION = 1
+
+Room = collections.namedtuple('Room', ('room_id', 'name', 'rf_address'))
+
+
+def _config_text(config):
+    """Returns the configuration as text with all passwords removed"""
+    out = StringIO()
+    for section in config.cfg_parser.sections():
+        out.write("[%s]\n" % section)
+        for option, value in config.cfg_parser.items(section, raw=True):
+            if option in ('password', 'record', 'snapshot', 'control_socket'):
+                continue
+            out.write("%s = %s\n" % (option, value))
+        out.write("\n")
+    return out.getvalue()
+
+
+def _document_text(document):
+    if isinstance(document, bytes):
+        return document.decode('utf-8', 'replace')
+    return document
+
+
+def _program_items(programs):
+    return [[p.temperature, p.begin_minutes, p.end_minutes] for p in programs]
+
+
+def _json_copy(value):
+    return json.loads(json.dumps(value))
+
+
+class RecordingCube(object):
+    """Wraps a cube and records the rooms and every set_program call into `programs`"""
+
+    def __init__(self, cube, record, programs):
+        self.cube = cube
+        self.record = record
+        self.programs = programs
+
+    @property
+    def rooms(self):
+        rooms = self.cube.rooms
+        self.record.recorder.rooms = [[r.room_id, r.name, r.rf_address] for r in rooms]
+        return rooms
+
+    def set_program(self, room, rf_addr, weekday, programs):
+        self.programs.append([room, rf_addr, weekday, _program_items(programs)])
+        return self.cube.set_program(room, rf_addr, weekday, programs)
+
+    def __getattr__(self, item):
+        return getattr(self.cube, item)
+
+
+class TickRecord(object):
+    """
+    The record of a single tick. The inputs are added by Worker.compute(), the outputs by Worker.write() of the same
+    DesiredState, which may run in another thread while the next tick is computed.
+    """
+
+    def __init__(self, recorder, now):
+        self.recorder = recorder
+        self.started = now
+        # None if the tick didn't write a schedule to the cube
+        self.programs = None
+        # the programs re-sent by the reconciliation, which depend on the thermostats and can't be replayed
+        self.resent = []
+        self.tick = {
+            'version': RECORD_VERSION,
+            'now': now.isoformat(),
+            'config': _config_text(recorder.config),
+            'calendars': {},
+            'written_programs': [],
+        }
+
+    def calendar(self, name, documents):
+        self.tick['calendars'][name] = [_document_text(d) for d in documents]
+
+    def written(self, written_programs):
+        """
+        Records the programs written before this tick (Worker._written_programs), as the writer skips the weekdays
+        whose program didn't change since
+        """
+        self.tick['written_programs'] = [
+            [label, weekday, [list(item) for item in key]]
+            for label, weekdays in written_programs.items() for weekday, key in weekdays.items()
+        ]
+
+    def wrap_cube(self, cube, reconcile=False):
+        if reconcile:
+            return RecordingCube(cube, self, self.resent)
+        if self.programs is None:
+            self.programs = []
+        return RecordingCube(cube, self, self.programs)
+
+    def finish(self, effective_schedule, timings):
+        self.tick.update({
+            'rooms': self.recorder.rooms,
+            'programs': self.programs,
+            'resent': self.resent,
+            'effective_schedule': effective_schedule,
+            'timings': timings,
+        })
+        self.recorder.save(self)
+
+
+class TickRecorder(object):
+    """
+    Records the inputs (calendar documents, configuration, current time, the rooms of the cube and the programs
+    written before) and the outputs (effective schedule and set_program calls) of each tick into a JSON file in `directory`. Only the last
+    record_keep files are kept.
+    """
+
+    def __init__(self, directory, config):
+        self.directory = directory
+        self.config = config
+        # the rooms are only known after a connection to the cube. Keep them for the ticks without a cube connection
+        self.rooms = []
+        # distinguishes ticks started at the same time
+        self.sequence = 0
+        # the recorded files, oldest first
+        self.files = collections.deque()
+        if os.path.isdir(directory):
+            self.files.extend(sorted(name for name in os.listdir(directory)
+                                     if name.startswith('tick-') and name.endswith('.json')))
+
+    def start(self, now):
+        """Returns the TickRecord of a tick started at `now`"""
+        return TickRecord(self, now)
+
+    def save(self, record):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.sequence += 1
+        name = 'tick-%s-%06d.json' % (record.started.strftime('%Y%m%dT%H%M%S%f'), self.sequence % 1000000)
+        path = os.path.join(self.directory, name)
+        try:
+            with open(path, 'w') as f:
+                json.dump(record.tick, f)
+            logger.debug("Recorded tick to %s", path)
+        except (IOError, OSError):
+            logger.exception("Failed to record tick to %s" % path)
+            return
+
+        self.files.append(name)
+        while len(self.files) > max(self.config.record_keep, 1):
+            try:
+                os.unlink(os.path.join(self.directory, self.files.popleft()))
+            except OSError:
+                pass
+
+
+class RecordedFetcher(EventFetcher):
+
+    def __init__(self, documents):
+        super(RecordedFetcher, self).__init__()
+        self.recorded_documents = documents
+
+    def fetch(self, calendar_config, start=None, end=None, deadline=None):
+        if self.recorded_documents is None:
+            raise Exception("Calendar %s was not fetched in the recorded tick" % calendar_config.name)
+
+        self.documents = []
+        for document in self.recorded_documents:
+            for item in self.parse(document):
+                yield item
+
+
+class ReplayCube(object):
+
+    def __init__(self, rooms):
+        self.rooms = [Room(*r) for r in rooms]
+        self.programs = []
+
+    def set_program(self, room, rf_addr, weekday, programs):
+        self.programs.append([room, rf_addr, weekday, _program_items(programs)])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+class ReplayWorker(Worker):
+    """A Worker which takes all its inputs from a recorded tick"""
+
+    def __init__(self, config, tick):
+        super(ReplayWorker, self).__init__(config)
+        import dateutil.parser
+        self.tick = tick
+        self.recorded_now = dateutil.parser.parse(tick['now'])
+        self.cube = ReplayCube(tick.get('rooms') or [])
+        # start from the programs written before the tick, so that the same weekdays are skipped as unchanged
+        for label, weekday, key in tick.get('written_programs') or []:
+            self._written_programs.setdefault(label, {})[weekday] = [tuple(item) for item in key]
+
+    def now(self):
+        return self.recorded_now
+
+    def get_fetcher(self, calendar_config):
+        if calendar_config.name not in self._fetchers:
+            self._fetchers[calendar_config.name] = RecordedFetcher(self.tick['calendars'].get(calendar_config.name))
+        return self._fetchers[calendar_config.name]
+
+    def connect_to_cube(self):
+        return self.cube
+
+
+def replay_tick(path):
+    """
+    Runs the tick recorded in `path` with the current code. Returns a dict with the timings of the replay, the
+    recorded timings and a list of differences between the recorded and the replayed outputs.
+    """
+    with open(path, 'r') as f:
+        tick = json.load(f)
+
+    if tick.get('version') != RECORD_VERSION:
+        raise ValueError("Unsupported record version %s in %s" % (tick.get('version'), path))
+
+    fd, config_path = tempfile.mkstemp(suffix='.cfg')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(tick['config'])
+        worker = ReplayWorker(Configuration(config_path), tick)
+        worker.execute()
+    finally:
+        os.unlink(config_path)
+
+    diffs = []
+
+    def _diff(name, recorded, replayed):
+        recorded, replayed = _json_copy(recorded), _json_copy(replayed)
+        if recorded != replayed:
+            diffs.extend(difflib.unified_diff(
+                json.dumps(recorded, indent=1, sort_keys=True).splitlines(),
+                json.dumps(replayed, indent=1, sort_keys=True).splitlines(),
+                'recorded %s' % name, 'replayed %s' % name, lineterm=''
+            ))
+
+    _diff('effective_schedule', tick.get('effective_schedule'), worker.effective_schedule)
+    # the cube is only written if the schedule changed - the program can only be compared for those ticks
+    if tick.get('programs') is not None:
+        _diff('programs', tick['programs'], worker.cube.programs)
+
+    return {
+        'path': path,
+        'timings': worker.timings,
+        'recorded_timings': tick.get('timings', {}),
+        'diffs': diffs,
+    }
+
+
+def replay(path):
+    """Replays a single recorded tick or all ticks in a directory, in the order they were recorded"""
+    if os.path.isdir(path):
+        paths = [os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith('.json')]
+    else:
+        paths = [path]
+
+    for p in paths:
+        yield replay_tick(p)
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class Deadline(object):
+    """A point in time all I/O of a tick has to be finished by"""
+
+    def __init__(self, seconds, clock=time.time):
+        self.clock = clock
+        self.expires = clock() + seconds if seconds else None
+
+    def remaining(self):
+        if self.expires is None:
+            return None
+        return max(self.expires - self.clock(), 0)
+
+    def expired(self):
+        return self.expires is not None and self.clock() >= self.expires
+
+    def check(self):
+        if self.expired():
+            raise DeadlineExceeded("Deadline exceeded")
+
+    def timeout(self, timeout):
+        """Returns `timeout`, limited to the remaining time. Raises DeadlineExceeded if there is no time left."""
+        self.check()
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        return remaining if timeout is None else min(timeout, remaining)
+
+
+class CircuitBreaker(object):
+    """
+    Stops calls to a failing dependency. After `threshold` consecutive failures the breaker opens and rejects all
+    calls for `reset_timeout` seconds. Then a single trial call is let through (half open): if it succeeds the
+    breaker closes, otherwise it opens again.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, threshold=3, reset_timeout=300, clock=time.time):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened = None
+
+    @property
+    def state(self):
+        if self.opened is None:
+            return self.CLOSED
+        if self.clock() - self.opened >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def allow(self):
+        if self.state == self.OPEN:
+            raise CircuitOpen("Circuit breaker for %s is open" % self.name)
+
+    def success(self):
+        if self.opened is not None:
+            logger.info("Circuit breaker for %s closed" % self.name)
+        self.failures = 0
+        self.opened = None
+
+    def failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or (self.opened is None and self.failures >= self.threshold):
+            logger.warning("Circuit breaker for %s opened after %s failure(s)" % (self.name, self.failures))
+            self.opened = self.clock()
+
+
+def call_with_retries(func, retries=0, backoff=1, deadline=None, breaker=None, sleep=time.sleep):
+    """
+    Calls `func` and retries it up to `retries` times with exponential backoff (backoff, 2 * backoff, ...) if it
+    raises an exception. Retries stop early if the deadline doesn't leave enough time for the backoff. The circuit
+    breaker counts a call as one failure once its retries are used up; the trial call of a half open breaker isn't
+    retried.
+    """
+    trial = breaker is not None and breaker.state == CircuitBreaker.HALF_OPEN
+    attempt = 0
+    while True:
+        if breaker:
+            breaker.allow()
+        if deadline:
+            deadline.check()
+
+        try:
+            result = func()
+        except DeadlineExceeded:
+            if breaker:
+                breaker.failure()
+            raise
+        except Exception:
+            delay = backoff * (2 ** attempt)
+            remaining = deadline.remaining() if deadline else None
+            if attempt >= retries or (remaining is not None and delay >= remaining) or trial:
+                if breaker:
+                    breaker.failure()
+                raise
+
+            attempt += 1
+            logger.info("Attempt %s failed, retrying in %s seconds", attempt, delay)
+            sleep(delay)
+        else:
+            if breaker:
+                breaker.success()
+            return result
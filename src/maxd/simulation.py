@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Drives a Worker through virtual time against a stub cube to find problems which only show up after many ticks:
+growing memory, write storms, DST switches and day rollovers.
+"""
+import collections
+import logging
+import os
+import time
+
+from maxd.clock import VirtualClock
+from maxd.replay import Room
+from maxd.worker import Worker
+
+logger = logging.getLogger(__name__)
+
+TickResult = collections.namedtuple('TickResult', ('now', 'cpu', 'rss', 'writes', 'failed'))
+
+try:
+    _cpu_time = time.process_time
+except AttributeError: # pragma: nocover
+    _cpu_time = time.clock
+
+
+def rss():
+    """Returns the resident set size of this process in bytes or None if it can't be determined"""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+
+    try:
+        import resource
+        # ru_maxrss is the peak, not the current size. It's in kilobytes on Linux and in bytes on OS X.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except ImportError: # pragma: nocover
+        return None
+
+
+class StubCube(object):
+    """A cube which accepts all programs and overrides and counts the set_program calls"""
+
+    def __init__(self, rooms):
+        self.rooms = rooms
+        self.writes = 0
+        self.programs = {}
+        self.overrides = {}
+
+    def set_program(self, room, rf_addr, weekday, programs):
+        self.writes += 1
+        self.programs[(room, weekday)] = programs
+
+    def set_mode_vacation(self, room, rf_addr, temperature, end):
+        self.overrides[room] = (temperature, end)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+class SimulatedWorker(Worker):
+
+    def __init__(self, config, clock, cube):
+        super(SimulatedWorker, self).__init__(config, clock=clock)
+        self.cube = cube
+
+    def connect_to_cube(self):
+        return self.cube
+
+
+def _default_rooms(config):
+    if config.has_room_settings:
+        return [Room(config.room_id or 1, config.room_name or 'Simulated', config.room_rf_addr or 1)]
+    return [Room(1, 'Simulated', 1)]
+
+
+class Simulation(object):
+    """Runs the worker every `interval` seconds of virtual time, starting at `start`"""
+
+    def __init__(self, config, start, interval=600, rooms=None):
+        self.clock = VirtualClock(start)
+        self.interval = interval
+        self.cube = StubCube(rooms if rooms is not None else _default_rooms(config))
+        self.worker = SimulatedWorker(config, self.clock, self.cube)
+        self.ticks = []
+
+    def tick(self):
+        writes = self.cube.writes
+        cpu_start = _cpu_time()
+        failed = False
+        try:
+            self.worker.execute()
+        except Exception:
+            logger.exception("Simulated tick at %s failed" % self.clock.now())
+            failed = True
+        result = TickResult(now=self.clock.now(), cpu=_cpu_time() - cpu_start, rss=rss(),
+                            writes=self.cube.writes - writes, failed=failed)
+        self.ticks.append(result)
+        self.clock.advance(self.interval)
+        return result
+
+    def run(self, duration):
+        """Runs the ticks for `duration` (a timedelta) of virtual time"""
+        end = self.clock.now() + duration
+        while self.clock.now() < end:
+            self.tick()
+        return self.ticks
+
+    def summary(self):
+        if not self.ticks:
+            return {}
+
+        writes_per_day = collections.Counter()
+        for t in self.ticks:
+            writes_per_day[t.now.date()] += t.writes
+
+        cpu = [t.cpu for t in self.ticks]
+        rss_values = [t.rss for t in self.ticks if t.rss is not None]
+        return {
+            'ticks': len(self.ticks),
+            'failed_ticks': len([t for t in self.ticks if t.failed]),
+            'start': self.ticks[0].now.isoformat(),
+            'end': self.ticks[-1].now.isoformat(),
+            'cube_writes': sum(t.writes for t in self.ticks),
+            'max_writes_per_day': max(writes_per_day.values()),
+            'cpu_mean': sum(cpu) / len(cpu),
+            'cpu_max': max(cpu),
+            'rss_start': rss_values[0] if rss_values else None,
+            'rss_end': rss_values[-1] if rss_values else None,
+            'rss_growth': rss_values[-1] - rss_values[0] if rss_values else None,
+        }
+
+
+def simulate(config, start, duration, interval=600, rooms=None):
+    """Runs a simulation and returns its summary"""
+    simulation = Simulation(config, start, interval, rooms)
+    simulation.run(duration)
+    return simulation.summary()
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import calendar
+import datetime
+import json
+import logging
+import os
+
+import pytz
+
+logger = logging.getLogger(__name__)
+
+
+def _to_timestamp(dt):
+    return calendar.timegm(dt.utctimetuple())
+
+
+def _from_timestamp(ts):
+    return datetime.datetime.fromtimestamp(ts, tz=pytz.UTC)
+
+
+class EventSnapshot(object):
+    """
+    Keeps the last successfully fetched events of every calendar and persists them to a JSON file. Each event is
+    stored as [name, start, end] with start and end as UNIX timestamps.
+    """
+
+    version = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.calendars = {}
+        self.dirty = False
+
+    def load(self):
+        if not os.path.exists(self.path):
+            logger.info("No event snapshot at %s" % self.path)
+            return False
+
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            logger.exception("Failed to read event snapshot %s" % self.path)
+            return False
+
+        if data.get('version') != self.version:
+            logger.warning("Ignoring event snapshot %s with unknown version %s" % (self.path, data.get('version')))
+            return False
+
+        self.calendars = data.get('calendars', {})
+        self.dirty = False
+        logger.info("Loaded event snapshot for %s calendar(s) from %s" % (len(self.calendars), self.path))
+        return True
+
+    def save(self):
+        if not self.dirty:
+            return
+
+        tmp_path = '%s.tmp' % self.path
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'version': self.version,
+                'calendars': self.calendars,
+            }, f, separators=(',', ':'))
+        os.rename(tmp_path, self.path)
+        self.dirty = False
+
+    def update(self, name, events):
+        items = [[event.name, _to_timestamp(event.start), _to_timestamp(event.end)] for event in events]
+        if self.calendars.get(name) != items:
+            self.calendars[name] = items
+            self.dirty = True
+
+    def discard(self, name):
+        if name in self.calendars:
+            del self.calendars[name]
+            self.dirty = True
+
+    def events(self, name, start, end):
+        """Returns the events of calendar `name` which overlap the window between `start` and `end`"""
+        from maxd.worker import Event
+
+        start, end = _to_timestamp(start), _to_timestamp(end)
+        return [
+            Event(name=event_name, start=_from_timestamp(event_start), end=_from_timestamp(event_end))
+            for event_name, event_start, event_end in self.calendars.get(name, [])
+            if event_start <= end and event_end >= start
+        ]
+
+    def __contains__(self, name):
+        return name in self.calendars
@@ -1,18 +1,28 @@
 # -*- coding: utf-8 -*-
 import logging
 import collections
+import contextlib
 import datetime
-from dateutil import rrule
+import re
+import time
 
 import pytz
 import dateutil.tz
 
-from phylter.parser import Parser
-from pymax.cube import Discovery, Cube
-from pymax.objects import ProgramSchedule
-
 from maxd.fetcher import HTTPCalendarEventFetcher
 from maxd.fetcher import LocalCalendarEventFetcher
+from maxd.fetcher import CalDAVCalendarEventFetcher
+from maxd.budget import COLLAPSE
+from maxd.clock import SystemClock
+from maxd.config import Configuration
+from maxd.snapshot import EventSnapshot
+from maxd.incremental import IncrementalSchedule
+from maxd.index import CalendarIndex, IntervalIndex
+from maxd.logqueue import RateLimiter
+from maxd.pipeline import Context, Pipeline, FetchStage, ExpandStage, FilterStage, RefreshCache
+from maxd.reconcile import Reconciler
+from maxd import recurrence
+from maxd.resilience import CircuitBreaker, Deadline, call_with_retries
 
 try:
     from urlparse import urlsplit
@@ -23,6 +33,29 @@ logger = logging.getLogger(__name__)
 
 weekday_names = ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday')
 
+# settings which change the program written to the cube
+SCHEDULE_SETTINGS = ('warmup_duration', 'high_temperature', 'low_temperature', 'static_schedule', 'allday_range',
+                     'cube_timezone', 'room_id', 'room_name', 'room_rf_addr')
+
+CUBE_SETTINGS = ('cube_serial', 'cube_address', 'cube_port')
+
+# the schedule (or the schedules of the mapped rooms, by label) computed by a run of the worker, to be written to the cube
+DesiredState = collections.namedtuple('DesiredState', ('schedule', 'room_schedules', 'timings', 'started', 'record',
+                                                       'config'))
+
+# number of program entries a thermostat accepts per day
+MAX_PROGRAM_SLOTS = 13
+
+_utc_until = re.compile(r'(UNTIL=\d{8}T\d{6})Z')
+
+
+def _day_window(start, end):
+    """Extends the window from start to end to whole days in UTC"""
+    start = start.astimezone(pytz.UTC) if start.tzinfo else start.replace(tzinfo=pytz.UTC)
+    end = end.astimezone(pytz.UTC) if end.tzinfo else end.replace(tzinfo=pytz.UTC)
+    return start.replace(hour=0, minute=0, second=0, microsecond=0), end.replace(hour=23, minute=59, second=59, microsecond=0)
+
+
 def _to_utc_datetime(dt):
     if dt is None:
         return None
@@ -32,6 +65,34 @@ def _to_utc_datetime(dt):
     return dt.astimezone(pytz.UTC)
 
 
+def compact_periods(periods, max_periods):
+    """
+    Merges the periods separated by the shortest gaps until no more than `max_periods` are left. Merging the n
+    shortest gaps loses the least possible time at low temperature. Ties are broken by the position of the gap to
+    keep the result deterministic.
+    """
+    periods = sorted(periods)
+    if len(periods) <= max_periods:
+        return periods
+
+    merge_count = len(periods) - max(max_periods, 1)
+    gaps = sorted(range(len(periods) - 1), key=lambda i: (periods[i + 1][0] - periods[i][1], i))
+    merge = set(gaps[:merge_count])
+
+    compacted = []
+    current_start, current_end = periods[0]
+    for i in range(1, len(periods)):
+        start, end = periods[i]
+        if i - 1 in merge:
+            current_end = max(current_end, end)
+        else:
+            compacted.append((current_start, current_end))
+            current_start, current_end = start, end
+    compacted.append((current_start, current_end))
+
+    return compacted
+
+
 class Event(collections.namedtuple('Event', ('name', 'start', 'end'))):
 
     def __new__(cls, **kwargs):
@@ -43,8 +104,10 @@ class Event(collections.namedtuple('Event', ('name', 'start', 'end'))):
 
 class Schedule(object):
 
-    def __init__(self, weekday_events={}):
+    def __init__(self, weekday_events={}, merged=False):
         self.events = weekday_events or {}
+        # whether the periods are already effective (as returned by IncrementalSchedule.effective())
+        self.merged = merged
 
     def __add__(self, other):
         if not isinstance(other, Schedule):
@@ -59,6 +122,9 @@ class Schedule(object):
         return self.events.items()
 
     def effective(self):
+        if self.merged:
+            return Schedule(dict((weekday, list(periods)) for weekday, periods in self.events.items()), merged=True)
+
         new = {}
 
         for weekday, periods in self.events.items():
@@ -72,7 +138,7 @@ class Schedule(object):
                 # remove current period if another period starts before and ends after
                 if any((p[0] < current[0] and p[1] > current[1] for p in other)) or \
                     any((p[0] < current[0] and p[1] > current[1] for p in new_periods)):
-                    logger.debug("Removing period %s because it's contained in a larger period" % (current, ))
+                    logger.debug("Removing period %s because it's contained in a larger period", current)
                     continue
 
                 new_periods.append(current)
@@ -91,7 +157,7 @@ class Schedule(object):
                 if candidates:
                     new_start = min(p[0] for p in candidates + [current])
                     new_end = max(p[1] for p in candidates + [current])
-                    logger.debug("Replacing %s and %s with new: %s to %s" % (current, candidates, new_start, new_end))
+                    logger.debug("Replacing %s and %s with new: %s to %s", current, candidates, new_start, new_end)
                     new_periods.append((new_start, new_end))
                     for c in candidates:
                         del periods[periods.index(c)]
@@ -108,8 +174,16 @@ class Schedule(object):
                 (start.astimezone(tz), end.astimezone(tz)) for start, end in periods
             ]
 
-    def to_program(self, weekday, low_temp, high_temp):
-        periods = self.events[weekday]
+    def to_program(self, weekday, low_temp, high_temp, max_slots=MAX_PROGRAM_SLOTS):
+        from pymax.objects import ProgramSchedule
+
+        periods = self.events.get(weekday, [])
+
+        # every period needs a low and a high temperature slot, plus the low temperature slot at the end of the day
+        max_periods = (max_slots - 1) // 2
+        if len(periods) > max_periods:
+            logger.info("%s: compacting %s periods to fit into %s program slots", weekday_names[weekday], len(periods), max_slots)
+            periods = compact_periods(periods, max_periods)
 
         start = datetime.time()
         for pstart, pend in periods:
@@ -127,35 +201,157 @@ class Schedule(object):
 
 class Worker(object):
 
-    def __init__(self, config):
+    def __init__(self, config, clock=None):
         self.config = config
+        self.clock = clock or SystemClock()
         self.exception = None
         self._current_schedule = None
+        # the schedule and room settings last written for every mapped room, by label
+        self._room_schedules = {}
+        # the programs last written by weekday, for every mapped room by label (None without mapped rooms)
+        self._written_programs = {}
+        # the schedule kept up to date period by period, and the weekdays which changed with the last run
+        self.schedule_state = IncrementalSchedule()
+        self.changed_weekdays = []
+        self._fetchers = {}
+        self.http_cache = None
+        self._indexes = {}
+        # caches for the output of pipeline stages, by stage name. Fetched calendars are kept until their refresh is due.
+        self.caches = {
+            FetchStage.name: RefreshCache(lambda key: self.refresh_interval(key[0]), self.clock.time),
+        }
+        self.pipelines = {}
+        # number of series which exceeded their expansion budget, by calendar and reason
+        self.expansion_overflows = {}
+        self.effective_schedule = None
+        self.last_fetch = {}
+        self.timings = {}
+        self.snapshot = None
+        if config.snapshot_file:
+            self.snapshot = EventSnapshot(config.snapshot_file)
+            self.snapshot.load()
+        self._breakers = {}
+        self.cube_breaker = CircuitBreaker('cube', config.breaker_threshold, config.breaker_reset, self.clock.time)
+        # the programs written to the cube, compared with the ones stored on the thermostats now and then
+        self.reconciler = Reconciler(self.clock.time)
+        # limits the messages about failures which repeat for many events
+        self.failure_log = RateLimiter(5, 300, self.clock.time)
+        # the end of the temporary setpoint of every boosted cube room, by room name
+        self.overrides = {}
+        self.sleep = self.clock.sleep
+        self.recorder = None
+        if config.record_dir:
+            from maxd.replay import TickRecorder
+            self.recorder = TickRecorder(config.record_dir, config)
+
+    def now(self):
+        return self.clock.now()
+
+    def get_window(self):
+        start = self.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        end = start + datetime.timedelta(days=7) - datetime.timedelta(seconds=1)
+        return start, end
+
+    def warm_start(self):
+        """
+        Writes the schedule built from the event snapshot to the cube without fetching any calendar. Returns False if
+        there is no snapshot to start from.
+        """
+        if not self.snapshot or not self.snapshot.calendars:
+            return False
+
+        start, end = self.get_window()
+        logger.info("Warm start from event snapshot %s", self.snapshot.path)
+
+        calendar_events = dict((calendar_config.name, self.snapshot.events(calendar_config.name, start, end))
+                               for calendar_config in self.config.calendars)
 
-    def execute(self):
+        if self.config.rooms:
+            self.apply_room_schedules(self.create_room_schedules(start, calendar_events))
+        else:
+            events = [event for calendar_config in self.config.calendars
+                      for event in calendar_events[calendar_config.name]]
+            self.apply_schedule(self.get_static_schedule(start) + self.create_schedule(events))
+        return True
+
+    def execute(self, refresh=()):
+        """
+        Fetches all calendars, creates the schedule and writes it to the cube. The calendars named in `refresh` are
+        fetched without using cached data.
+        """
+        # all I/O of this tick has to finish before the deadline
+        deadline = Deadline(self.config.tick_timeout, self.clock.time)
+        self.write(self.compute(refresh, deadline), deadline)
+
+    def compute(self, refresh=(), deadline=None):
+        """
+        Fetches all calendars and returns the DesiredState of the cube for write(). The calendars named in `refresh`
+        are fetched without using cached data.
+        """
         logger.info("Running...")
+        timings = {}
+        tick_start = time.time()
 
-        start = datetime.datetime.now(tz=pytz.UTC).replace(hour=0, minute=0, second=0, microsecond=0)
-        end = start + datetime.timedelta(days=7) - datetime.timedelta(seconds=1)
+        # the TickRecord of this tick, finished by write()
+        record = self.recorder.start(self.now()) if self.recorder else None
 
-        logger.info("Start: %s, end: %s" % (start, end))
+        deadline = deadline or Deadline(self.config.tick_timeout, self.clock.time)
+        start, end = self.get_window()
+
+        logger.info("Start: %s, end: %s", start, end)
 
         events = []
+        calendar_events = {}
         for calendar_config in self.config.calendars:
+            if calendar_config.name in refresh:
+                logger.info("Refreshing %s", calendar_config.name)
+                self.get_fetcher(calendar_config).invalidate()
+                fetch_cache = self.caches.get(FetchStage.name)
+                if fetch_cache is not None and hasattr(fetch_cache, 'discard'):
+                    fetch_cache.discard(FetchStage(self).cache_key(Context(calendar_config, start, end, deadline)))
+
+            fetch_start = time.time()
             try:
-                events.extend(self.fetch_events(calendar_config, start, end))
+                fetched = self.fetch_events(calendar_config, start, end, deadline)
+                if not self.pipelines[calendar_config.name].stats[FetchStage.name].cached:
+                    self.last_fetch[calendar_config.name] = self.now()
+                if record:
+                    record.calendar(calendar_config.name, self.get_fetcher(calendar_config).documents)
+                if self.snapshot:
+                    self.snapshot.update(calendar_config.name, fetched)
+                calendar_events[calendar_config.name] = fetched
             except:
-                logger.exception("Failed to read events from %s" % calendar_config.name)
+                logger.exception("Failed to read events from %s", calendar_config.name)
+                if self.snapshot and calendar_config.name in self.snapshot:
+                    logger.warning("Using events from snapshot for %s", calendar_config.name)
+                    calendar_events[calendar_config.name] = self.snapshot.events(calendar_config.name, start, end)
+            events.extend(calendar_events.get(calendar_config.name, []))
+            timings['fetch:%s' % calendar_config.name] = time.time() - fetch_start
+            if calendar_config.name in self.pipelines:
+                for stage, seconds in self.pipelines[calendar_config.name].timings().items():
+                    timings['%s:%s' % (stage, calendar_config.name)] = seconds
+        timings['fetch'] = time.time() - tick_start
+
+        if self.snapshot:
+            try:
+                self.snapshot.save()
+            except (IOError, OSError):
+                logger.exception("Failed to write event snapshot %s", self.snapshot.path)
 
-        static_schedule = self.get_static_schedule(start)
-        calendar_schedule = self.create_schedule(events)
+        schedule_start = time.time()
+        if self.config.rooms:
+            room_schedules = self.create_room_schedules(start, calendar_events)
+        else:
+            static_schedule = self.get_static_schedule(start)
+            calendar_schedule = self.create_schedule(events)
+        timings['schedule'] = time.time() - schedule_start
 
-        if logger.isEnabledFor(logging.DEBUG):
+        if not self.config.rooms and logger.isEnabledFor(logging.DEBUG):
             def _debug_schedule(schedule):
                 for wd in sorted(schedule.events.keys()):
-                    logger.debug("  %s:" % weekday_names[wd])
+                    logger.debug("  %s:", weekday_names[wd])
                     for start, end in sorted(schedule.events[wd]):
-                        logger.debug("    %s -> %s" % (start, end))
+                        logger.debug("    %s -> %s", start, end)
 
             logger.debug("Static schedule:")
             _debug_schedule(static_schedule)
@@ -163,7 +359,178 @@ class Worker(object):
             logger.debug("Calendar events schedule:")
             _debug_schedule(calendar_schedule)
 
-        self.apply_schedule(static_schedule + calendar_schedule)
+        if self.config.rooms:
+            return DesiredState(None, room_schedules, timings, tick_start, record, self.config)
+
+        schedule = static_schedule + calendar_schedule
+        self.schedule_state.update(schedule.events)
+        changed = self.schedule_state.take_dirty()
+        self.changed_weekdays = [weekday_names[wd] for wd in sorted(changed)]
+        if changed:
+            logger.info("Changed weekdays: %s", ', '.join(self.changed_weekdays))
+
+        effective_schedule = self.schedule_state.effective()
+        for weekday in schedule.events:
+            effective_schedule.events.setdefault(weekday, [])
+        return DesiredState(effective_schedule, None, timings, tick_start, record, self.config)
+
+    def write(self, state, deadline=None):
+        """
+        Writes the DesiredState returned by compute() to the cube and reconciles the programs of the thermostats. A state
+        computed with another configuration than the current one (i.e. before a reload) is dropped.
+        """
+        if state.config is not self.config:
+            logger.info("Dropping desired state computed before the configuration was reloaded")
+            return
+
+        timings = dict(state.timings)
+        deadline = deadline or Deadline(self.config.tick_timeout, self.clock.time)
+
+        if state.record:
+            state.record.written(self._written_programs)
+
+        apply_start = time.time()
+        try:
+            if state.room_schedules is not None:
+                self.apply_room_schedules(state.room_schedules, deadline, state.record)
+            else:
+                self.apply_schedule(state.schedule, deadline, state.record)
+            timings['apply'] = time.time() - apply_start
+
+            reconcile_start = time.time()
+            try:
+                self.reconcile(deadline, state.record)
+            except:
+                logger.exception("Failed to reconcile the programs of the thermostats")
+            timings['reconcile'] = time.time() - reconcile_start
+        finally:
+            timings.setdefault('apply', time.time() - apply_start)
+            timings['total'] = time.time() - state.started
+            self.timings = timings
+
+            if state.record:
+                state.record.finish(self.effective_schedule, timings)
+
+    def status(self):
+        """Returns the current state of the worker as a JSON serializable dict"""
+        return {
+            'effective_schedule': self.effective_schedule,
+            'changed_weekdays': self.changed_weekdays,
+            'last_fetch': dict((name, dt.isoformat()) for name, dt in self.last_fetch.items()),
+            'timings': dict(self.timings),
+            'breakers': dict((b.name, b.state) for b in [self.cube_breaker] + list(self._breakers.values())),
+            'expansion_overflows': dict((name, dict(c)) for name, c in self.expansion_overflows.items()),
+            'reconciliation': self.reconciler.status(),
+            'http_cache': self.http_cache.stats() if self.http_cache else None,
+            'overrides': self.active_overrides(),
+        }
+
+    def active_overrides(self):
+        now = self.now()
+        return dict((name, end.isoformat()) for name, end in list(self.overrides.items()) if end > now)
+
+    def reload_config(self):
+        """
+        Re-reads the configuration file and drops only the state affected by the changes: the fetcher, index and
+        breaker of every added, changed or removed calendar (of all calendars if the all day range changed), the written
+        program of every changed mapped room and all programs if a setting which affects them changed. Returns the names
+        of the changed calendars and rooms and whether all programs have to be rewritten, or None if the new
+        configuration is invalid (the old one stays active then).
+        """
+        try:
+            config = Configuration(self.config.path)
+            problems = config.check()
+        except Exception as ex:
+            problems = [str(ex)]
+
+        if problems:
+            for problem in problems:
+                logger.error("Not reloading configuration: %s", problem)
+            return None
+
+        old_config, self.config = self.config, config
+
+        def _settings(cfg, names):
+            return [getattr(cfg, name) for name in names]
+
+        old_calendars = dict((c.name, c) for c in old_config.calendars)
+        new_calendars = dict((c.name, c) for c in config.calendars)
+        changed = sorted(name for name in set(old_calendars) | set(new_calendars)
+                         if old_calendars.get(name) != new_calendars.get(name))
+
+        for name in changed:
+            logger.info("Configuration of calendar %s changed", name)
+            for key in [k for k in self._fetchers if k[0] == name]:
+                del self._fetchers[key]
+            self._indexes.pop(name, None)
+            self._breakers.pop(name, None)
+            self.pipelines.pop(name, None)
+            if name not in new_calendars:
+                self.last_fetch.pop(name, None)
+
+        schedule_changed = _settings(old_config, SCHEDULE_SETTINGS) != _settings(config, SCHEDULE_SETTINGS)
+        if schedule_changed:
+            logger.info("Program settings changed, rewriting the program with the next run")
+            self._current_schedule = None
+            self._room_schedules = {}
+            self._written_programs = {}
+
+        # the occurrences of all day events are expanded with the all day range, in the indexes, the stage caches and
+        # the snapshot
+        allday_changed = old_config.allday_range != config.allday_range
+        if allday_changed:
+            logger.info("All day range changed, expanding the events of all calendars again")
+            self._indexes = {}
+            for cache in self.caches.values():
+                cache.clear()
+
+        old_rooms = dict((r.label, r) for r in old_config.rooms)
+        new_rooms = dict((r.label, r) for r in config.rooms)
+        changed_rooms = sorted(label for label in set(old_rooms) | set(new_rooms)
+                               if old_rooms.get(label) != new_rooms.get(label))
+        for label in changed_rooms:
+            logger.info("Configuration of room %s changed", label)
+            self._room_schedules.pop(label, None)
+            self._written_programs.pop(label, None)
+
+        cube_changed = _settings(old_config, CUBE_SETTINGS) != _settings(config, CUBE_SETTINGS)
+        if cube_changed:
+            self._written_programs = {}
+            self.cube_breaker = CircuitBreaker('cube', config.breaker_threshold, config.breaker_reset, self.clock.time)
+
+        if self.http_cache is not None:
+            if old_config.http_cache_dir != config.http_cache_dir:
+                logger.warning("The HTTP cache directory changes with the next start of maxd")
+            self.http_cache.resize(config.http_cache_size, config.http_cache_disk_size)
+
+        if schedule_changed or changed_rooms or cube_changed:
+            # the programs written so far may not be the ones wanted any more
+            self.reconciler.clear()
+
+        for breaker in [self.cube_breaker] + list(self._breakers.values()):
+            breaker.threshold = config.breaker_threshold
+            breaker.reset_timeout = config.breaker_reset
+
+        if old_config.snapshot_file != config.snapshot_file:
+            self.snapshot = None
+            if config.snapshot_file:
+                self.snapshot = EventSnapshot(config.snapshot_file)
+                self.snapshot.load()
+        if self.snapshot:
+            # the snapshot of a changed calendar may hold events of its old url or credentials
+            for name in list(self.snapshot.calendars) if allday_changed else changed:
+                self.snapshot.discard(name)
+
+        if old_config.record_dir != config.record_dir:
+            self.recorder = None
+            if config.record_dir:
+                from maxd.replay import TickRecorder
+                self.recorder = TickRecorder(config.record_dir, config)
+        elif self.recorder:
+            self.recorder.config = config
+
+        logger.info("Configuration reloaded")
+        return {'calendars': changed, 'rooms': changed_rooms, 'schedule': schedule_changed}
 
     def get_static_schedule(self, start):
         d = {}
@@ -185,94 +552,231 @@ class Worker(object):
 
         return Schedule(d)
 
-    def fetch_events(self, calendar_config, start, end):
-        chunks = urlsplit(calendar_config.url)
-
-        if chunks.scheme and chunks.netloc:
-            fetcher = HTTPCalendarEventFetcher()
-        else:
-            fetcher = LocalCalendarEventFetcher()
-
-        # fetch all ical event for this calendar
-        events = fetcher.fetch(calendar_config)
-
-        # filter the fetched events for the current period and convert them to Event instances
-        logger.info("Applying range filter to fetched events from %s" % calendar_config.name)
-        events = self.apply_range_filter(events, start, end)
+    def get_fetcher(self, calendar_config):
+        # fetchers are kept for the lifetime of the worker to reuse HTTP connections, caches and CalDAV sync state
+        key = (calendar_config.name, calendar_config.url, calendar_config.caldav)
+        if key not in self._fetchers:
+            chunks = urlsplit(calendar_config.url)
 
+            if chunks.scheme and chunks.netloc:
+                if calendar_config.caldav:
+                    self._fetchers[key] = CalDAVCalendarEventFetcher(self.get_http_cache())
+                else:
+                    self._fetchers[key] = HTTPCalendarEventFetcher(self.get_http_cache())
+            else:
+                self._fetchers[key] = LocalCalendarEventFetcher()
+
+            if calendar_config.fast_parse:
+                from maxd.fastparse import EVENT_PROPERTIES
+                self._fetchers[key].event_properties = EVENT_PROPERTIES
+        return self._fetchers[key]
+
+    def refresh_interval(self, calendar_config):
+        """
+        Returns the number of seconds fetched events of the calendar are used before it is fetched again: the refresh
+        option of the calendar or the TTL the feed or the HTTP server announced with the last fetch. None fetches the
+        calendar with every run.
+        """
+        if calendar_config.refresh is not None:
+            return calendar_config.refresh
+        return self.get_fetcher(calendar_config).ttl
+
+    def get_http_cache(self):
+        """Returns the HTTP cache shared by the fetchers of all calendars"""
+        if self.http_cache is None:
+            from maxd.httpcache import BoundedCache
+            self.http_cache = BoundedCache(self.config.http_cache_size, self.config.http_cache_dir,
+                                           self.config.http_cache_disk_size)
+        return self.http_cache
+
+    def get_breaker(self, name):
+        if name not in self._breakers:
+            self._breakers[name] = CircuitBreaker(name, self.config.breaker_threshold, self.config.breaker_reset,
+                                                  self.clock.time)
+        return self._breakers[name]
+
+    def get_index(self, calendar_config):
+        if calendar_config.name not in self._indexes:
+            self._indexes[calendar_config.name] = CalendarIndex()
+        return self._indexes[calendar_config.name]
+
+    def build_pipeline(self, calendar_config):
+        """
+        Returns the pipeline which turns the calendar into events. Override this (or set a cache for a stage name in
+        `caches`) to plug in other stages.
+        """
+        pipeline = Pipeline()
+        pipeline.add(FetchStage(self), self.caches.get(FetchStage.name))
+        pipeline.add(ExpandStage(self), self.caches.get(ExpandStage.name))
         if calendar_config.filter is not None:
-            logger.info("Applying user filter \"%s\" to %s events" % (calendar_config.filter, len(events)))
-            events = self.apply_user_filter(calendar_config.filter, events)
-            logger.debug("Event list contains now %s events from calendar %s" % (len(events), calendar_config.name))
+            pipeline.add(FilterStage(self), self.caches.get(FilterStage.name))
         else:
             logger.debug("Filter query not set in calendar config")
+        return pipeline
 
-        return events
+    def fetch_events(self, calendar_config, start, end, deadline=None):
+        """Runs the pipeline of the calendar and returns the events in the window"""
+        pipeline = self.build_pipeline(calendar_config)
+        self.pipelines[calendar_config.name] = pipeline
+        return list(pipeline.run(Context(calendar_config, start, end, deadline)))
 
     def apply_user_filter(self, query_string, events):
+        from phylter.parser import Parser
+
         q = Parser().parse(query_string)
         return q.apply(events)
 
     def apply_range_filter(self, events, start, end):
-        start = (start.astimezone(pytz.UTC) if start.tzinfo else start).replace(hour=0, minute=0, second=0)
-        end = (end.astimezone(pytz.UTC) if end.tzinfo else end).replace(hour=23, minute=59, second=59)
-
-        def _to_all_day(date):
-            allday_start, allday_end = self.config.allday_range
-            day_start = datetime.datetime.combine(date, allday_start).replace(tzinfo=dateutil.tz.tzlocal())
-            day_end = datetime.datetime.combine(date, allday_end).replace(tzinfo=dateutil.tz.tzlocal())
-            return day_start.astimezone(pytz.UTC), day_end.astimezone(pytz.UTC)
-
-        def _build_all_events():
-            for cal_event in events:
+        start, end = _day_window(start, end)
+
+        index = IntervalIndex()
+        for occurrences in self.expand_events(events, start, end):
+            index.add_many(occurrences)
+        return index.query(start, end)
+
+    def _to_all_day(self, date):
+        allday_start, allday_end = self.config.allday_range
+        day_start = datetime.datetime.combine(date, allday_start).replace(tzinfo=dateutil.tz.tzlocal())
+        day_end = datetime.datetime.combine(date, allday_end).replace(tzinfo=dateutil.tz.tzlocal())
+        return day_start.astimezone(pytz.UTC), day_end.astimezone(pytz.UTC)
+
+    def _recurrence(self, cal_event):
+        """Returns the start (naive UTC), the duration and the all day flag of a recurring VEVENT and its rule"""
+        all_day = cal_event['DTSTART'].dt.__class__ == datetime.date
+
+        if all_day:
+            all_day_start, all_day_end = self._to_all_day(cal_event['DTSTART'].dt)
+            event_start_utc = all_day_start
+            duration = all_day_end - all_day_start
+        else:
+            event_start_utc = cal_event['DTSTART'].dt.astimezone(pytz.UTC)
+            if 'duration' in cal_event:
+                duration = cal_event['duration'].dt # it's already a timedelta
+            else:
+                duration = cal_event['DTEND'].dt - cal_event['DTSTART'].dt
+
+        # The until identifier in the RRULE may be in UTC. Remove the Z, the rule is expanded in naive UTC
+        rule_str = _utc_until.sub(r'\1', cal_event.get('RRULE').to_ical().decode('utf-8'))
+        return event_start_utc.replace(tzinfo=None), duration, all_day, rule_str
+
+    def _occurrence(self, cal_event, dt, duration, all_day):
+        if all_day:
+            s, e = self._to_all_day(dt.date())
+            return Event(name=str(cal_event['SUMMARY']), start=s, end=e)
+        dt = dt.replace(tzinfo=pytz.UTC)
+        return Event(name=str(cal_event['SUMMARY']), start=dt, end=dt + duration)
+
+    def _collapse(self, first, start, end, all_day):
+        """
+        Returns one event per day (the all day range for all day series, the whole day otherwise) from the day of the
+        occurrence `first` to `end`, clamped to the window between `first` (or start) and end. A single event would be
+        cut off at the end of its first day by create_schedule().
+        """
+        start, end = max(first.start, _to_utc_datetime(start)), _to_utc_datetime(end)
+        day = first.start.replace(hour=0, minute=0, second=0, microsecond=0)
+        while day <= end:
+            if all_day:
+                day_start, day_end = self._to_all_day(day.date())
+            else:
+                day_start, day_end = day, day + datetime.timedelta(days=1) - datetime.timedelta(seconds=1)
+            day_start, day_end = max(day_start, start), min(day_end, end)
+            if day_start < day_end:
+                yield Event(name=first.name, start=day_start, end=day_end)
+            day += datetime.timedelta(days=1)
+
+    def expand_event(self, cal_event, start, end, budget=None):
+        """
+        Converts a VEVENT into Event instances. Recurring events are expanded into all occurrences which overlap the
+        window between start and end. If the series exceeds the ExpansionBudget `budget`, it is collapsed into one
+        event per day from its first occurrence to the end of the window or skipped.
+        """
+        from dateutil import rrule
+
+        try:
+            all_day = cal_event['DTSTART'].dt.__class__ == datetime.date
+
+            all_day_start, all_day_end = self._to_all_day(cal_event['DTSTART'].dt)
+
+            if 'RRULE' in cal_event:
+                dtstart, duration, all_day, rule_str = self._recurrence(cal_event)
+                rule = rrule.rrulestr(rule_str, dtstart=dtstart)
+
+                # occurrences starting up to one duration before the window still overlap it
+                after, before = (start - duration).replace(tzinfo=None), end.replace(tzinfo=None)
+                if budget is None:
+                    occurrences, exceeded = rule.between(after, before, inc=True), None
+                else:
+                    occurrences, exceeded = budget.expand(rule, after, before)
+
+                if exceeded:
+                    budget.record(exceeded, cal_event.get('SUMMARY'))
+                    if budget.overflow == COLLAPSE and occurrences:
+                        first = self._occurrence(cal_event, occurrences[0], duration, all_day)
+                        for event in self._collapse(first, start, end, all_day):
+                            yield event
+                    return
+
+                for dt in occurrences:
+                    yield self._occurrence(cal_event, dt, duration, all_day)
+            else:
+                if all_day:
+                    yield Event(name=str(cal_event['SUMMARY']), start=all_day_start, end=all_day_end)
+                else:
+                    yield Event(name=str(cal_event['SUMMARY']), start=cal_event['DTSTART'].dt.astimezone(pytz.UTC), end=cal_event['DTEND'].dt.astimezone(pytz.UTC))
+        except:
+            # a broken series fails again with every tick; only log a few of them per calendar (so that one broken
+            # feed doesn't hide the failures of the others), and not the whole VEVENT
+            calendar_name = budget.name if budget else None
+            suppressed = self.failure_log.allow(('expand', calendar_name))
+            if suppressed is not None:
+                logger.exception("Failed to expand event %s (%s) of calendar %s%s", cal_event.get('UID'),
+                                 cal_event.get('SUMMARY'), calendar_name,
+                                 " - %s similar message(s) suppressed" % suppressed if suppressed else '')
+
+    def expand_events(self, cal_events, start, end, budget=None):
+        """
+        Expands a list of VEVENTs like expand_event() and returns the list of occurrences of each VEVENT. Plain DAILY
+        and WEEKLY rules of all VEVENTs are expanded together by maxd.recurrence, all other VEVENTs one by one.
+        """
+        cal_events = list(cal_events)
+        expanded = [None] * len(cal_events)
+
+        simple = []
+        for i, cal_event in enumerate(cal_events):
+            rule = None
+            if 'RRULE' in cal_event:
                 try:
-                    all_day = cal_event['DTSTART'].dt.__class__ == datetime.date
-
-                    all_day_start, all_day_end = _to_all_day(cal_event['DTSTART'].dt)
-
-                    if 'RRULE' in cal_event:
-                        if all_day:
-                            event_start_utc = all_day_start
-                        else:
-                            event_start_utc = cal_event['DTSTART'].dt.astimezone(pytz.UTC)
-
-                        rule = rrule.rrulestr(cal_event.get('RRULE').to_ical().decode('utf-8'), dtstart=event_start_utc.replace(tzinfo=None))
-                        if rule._until:
-                            # The until identifier in the RRULE may contain a timezone (even if it's UTC).
-                            # Make sure its UTC and remove the tzinfo
-                            rule._until = rule._until.astimezone(pytz.UTC).replace(tzinfo=None)
-
-                        for dt in rule.between(start.replace(tzinfo=None), end.replace(tzinfo=None), inc=True):
-                            if all_day:
-                                s, e = _to_all_day(dt.date())
-                                yield Event(name=str(cal_event['SUMMARY']), start=s, end=e)
-                            else:
-                                dt = dt.replace(tzinfo=pytz.UTC)
-                                if 'duration' in cal_event:
-                                    duration = cal_event['duration'].dt # it's already a timedelta
-                                else:
-                                    duration = cal_event['DTEND'].dt - cal_event['DTSTART'].dt
-                                yield Event(name=str(cal_event['SUMMARY']), start=dt, end=dt + duration)
-                    else:
-                        if all_day:
-                            s, e = _to_all_day(cal_event['DTSTART'].dt)
-                            yield Event(name=str(cal_event['SUMMARY']), start=s, end=e)
-                        else:
-                            yield Event(name=str(cal_event['SUMMARY']), start=cal_event['DTSTART'].dt.astimezone(pytz.UTC), end=cal_event['DTEND'].dt.astimezone(pytz.UTC))
+                    dtstart, duration, all_day, rule_str = self._recurrence(cal_event)
+                    rule = recurrence.parse_rule(rule_str, dtstart)
                 except:
-                    logger.exception("Failed to apply range filter to event %s" % cal_event)
+                    rule = None # expand_event() logs the problem
 
-        for event in _build_all_events():
-            if start <= event.start <= end:
-                yield event
+            if rule is None:
+                expanded[i] = list(self.expand_event(cal_event, start, end, budget))
+            else:
+                simple.append((i, dtstart, rule, duration, all_day))
+
+        occurrences = recurrence.expand([
+            # occurrences starting up to one duration before the window still overlap it
+            (dtstart, rule, (start - duration).replace(tzinfo=None), end.replace(tzinfo=None))
+            for _, dtstart, rule, duration, _ in simple
+        ])
+        for (i, _, _, duration, all_day), dts in zip(simple, occurrences):
+            expanded[i] = [self._occurrence(cal_events[i], dt, duration, all_day) for dt in dts]
+            if budget:
+                budget.add(len(dts))
+
+        return expanded
 
     def create_schedule(self, events):
         schedule = {}
 
         warmup = self.config.warmup_duration
+        debug = logger.isEnabledFor(logging.DEBUG)
 
         for event in events:
-            logger.debug(event)
+            if debug:
+                logger.debug("%s", event)
 
             start = event.start - warmup
             if start.date() != event.start.date():
@@ -286,27 +790,68 @@ class Worker(object):
 
         return Schedule(schedule)
 
-    def apply_schedule(self, schedule):
+    def _schedule_dict(self, effective_schedule):
+        return dict(
+            (weekday_names[wd], [(s.isoformat(), e.isoformat()) for s, e in sorted(periods)])
+            for wd, periods in effective_schedule.items()
+        )
+
+    def _cube_timezone(self):
+        # i would like to use the 'v' message to get the timezone from the cube
+        # unfortunately, at least my cube doesn't set the timezone properly when using the max cube software
+        if self.config.cube_timezone:
+            cube_tz = pytz.timezone(self.config.cube_timezone)
+        else:
+            cube_tz = dateutil.tz.tzlocal()
+        logger.info("Cube time zone: %s", cube_tz)
+        return cube_tz
+
+    def _write_program(self, cube, rooms, effective_schedule, low_temp, high_temp, deadline=None, written=None):
+        """
+        Writes the program of every weekday of `effective_schedule` to `rooms`. With `written` (the programs written
+        last, by weekday) all seven days are considered, but only the ones whose program differs are written.
+        """
+        logger.info("Writing program to cube for rooms %s", rooms)
+        weekdays = effective_schedule.events.keys() if written is None else range(7)
+
+        for weekday_num in sorted(weekdays):
+            programs = list(effective_schedule.to_program(weekday_num, low_temp, high_temp))
+            if written is not None:
+                key = [(x.temperature, x.begin_minutes, x.end_minutes) for x in programs]
+                if written.get(weekday_num) == key:
+                    logger.debug("%10s: program unchanged", weekday_names[weekday_num])
+                    continue
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("%10s: %s", weekday_names[weekday_num],
+                            ', '.join(["%s-%s (%s)" % (x.begin_minutes, x.end_minutes, x.temperature) for x in programs]))
+
+            for room in rooms:
+                if deadline:
+                    deadline.check()
+                logger.debug("Setting program for room %s, rf addr: %s on day %s", room.room_id, room.rf_address, weekday_num)
+                cube.set_program(room.room_id, room.rf_address, weekday_num, programs)
+                self.reconciler.expect(room, weekday_num, programs)
+            if written is not None:
+                written[weekday_num] = key
+
+    def apply_schedule(self, schedule, deadline=None, record=None):
         effective_schedule = schedule.effective()
+        self.effective_schedule = self._schedule_dict(effective_schedule)
 
         if logger.isEnabledFor(logging.INFO):
             logger.info("Effective schedule:")
             for weekday_num, items in effective_schedule.items():
-                logger.info("%10s: %s" % (weekday_names[weekday_num], ', '.join("%s to %s" % x for x in items)))
+                logger.info("%10s: %s", weekday_names[weekday_num], ', '.join("%s to %s" % x for x in items))
 
         if self._current_schedule == schedule:
             logger.info("Schedule unchanged")
             return
 
-        with self.connect_to_cube() as cube:
-            # i would like to use the 'v' message to get the timezone from the cube
-            # unfortunately, at least my cube doesn't set the timezone properly when using the max cube software
-            if self.config.cube_timezone:
-                cube_tz = pytz.timezone(self.config.cube_timezone)
-            else:
-                cube_tz = dateutil.tz.tzlocal()
-            logger.info("Cube time zone: %s" % cube_tz)
-            effective_schedule.as_timezone(cube_tz)
+        with self.cube_session(deadline) as cube:
+            if record:
+                cube = record.wrap_cube(cube)
+
+            effective_schedule.as_timezone(self._cube_timezone())
 
             if self.config.has_room_settings:
                 rooms = []
@@ -319,22 +864,144 @@ class Worker(object):
                 rooms = [r for r in cube.rooms]
 
             if rooms:
-                logger.info("Writing program to cube for rooms %s" % rooms)
-                low_temp = self.config.low_temperature
-                high_temp = self.config.high_temperature
-                for weekday_num in effective_schedule.events.keys():
-                    programs = list(effective_schedule.to_program(weekday_num, low_temp, high_temp))
-                    logger.info("%10s: %s" % (weekday_names[weekday_num], ', '.join(["%s-%s (%s)" % (x.begin_minutes, x.end_minutes, x.temperature) for x in programs])))
-
-                    for room in rooms:
-                        logger.debug("Setting program for room %s, rf addr: %s on day %s" % (room.room_id, room.rf_address, weekday_num))
-                        cube.set_program(room.room_id, room.rf_address, weekday_num, programs)
+                self._write_program(cube, rooms, effective_schedule, self.config.low_temperature,
+                                    self.config.high_temperature, deadline, self._written_programs.setdefault(None, {}))
             else:
                 logger.warning("Could not find any rooms to write the program for")
 
         self._current_schedule = schedule
 
+    def create_room_schedules(self, start, calendar_events):
+        """
+        Returns the schedule of every room mapped in a [room:<label>] section, built from the events of its
+        calendars (already fetched and expanded once per calendar) and the static schedule. Rooms with the same
+        calendars and filter share one schedule.
+        """
+        shared = {}
+        schedules = collections.OrderedDict()
+        for room in self.config.rooms:
+            key = (room.calendars, room.filter)
+            if key not in shared:
+                events = [event for name in room.calendars for event in calendar_events.get(name, [])]
+                if room.filter is not None:
+                    events = list(self.apply_user_filter(room.filter, events))
+                shared[key] = self.get_static_schedule(start) + self.create_schedule(events)
+            schedules[room.label] = shared[key]
+        return schedules
+
+    def apply_room_schedules(self, schedules, deadline=None, record=None):
+        """
+        Writes the schedule of every mapped room whose schedule or settings changed since it was written last.
+        effective_schedule holds the effective schedule of each room, by label.
+        """
+        changed = []
+        self.effective_schedule = {}
+        for room in self.config.rooms:
+            schedule = schedules[room.label]
+            effective_schedule = schedule.effective()
+            self.effective_schedule[room.label] = self._schedule_dict(effective_schedule)
+            if self._room_schedules.get(room.label) != (schedule, room):
+                changed.append((room, schedule, effective_schedule))
+
+        if not changed:
+            logger.info("Schedules of all rooms unchanged")
+            return
+
+        with self.cube_session(deadline) as cube:
+            if record:
+                cube = record.wrap_cube(cube)
+
+            cube_tz = self._cube_timezone()
+            cube_rooms = list(cube.rooms)
+            for room, schedule, effective_schedule in changed:
+                rooms = [r for r in cube_rooms if room.matches(r)]
+                if rooms:
+                    effective_schedule.as_timezone(cube_tz)
+                    self._write_program(cube, rooms, effective_schedule, room.low_temperature, room.high_temperature,
+                                        deadline, self._written_programs.setdefault(room.label, {}))
+                else:
+                    logger.warning("Could not find any rooms matching room %s", room.label)
+                self._room_schedules[room.label] = (schedule, room)
+
+    def reconcile(self, deadline=None, record=None):
+        """
+        Reads the week programs stored on the thermostats and re-sends the mismatched ones, at most every
+        reconcile_interval seconds and at most reconcile_writes programs per pass.
+        """
+        interval = self.config.reconcile_interval
+        if not self.reconciler.due(interval):
+            return
+
+        logger.info("Reconciling the programs of the thermostats")
+        with self.cube_session(deadline) as cube:
+            if record:
+                cube = record.wrap_cube(cube, reconcile=True)
+            self.reconciler.run(cube, self.config.reconcile_writes, interval, deadline)
+
+    def _override_rooms(self, cube_rooms, names):
+        """
+        Returns (cube room, temperature) for the rooms named in `names`: labels of [room:<label>] sections (with the
+        high temperature of the section), names or ids of cube rooms (with the high temperature)
+        """
+        labels = dict((room.label, room) for room in self.config.rooms)
+        rooms = []
+        for name in names:
+            if name in labels:
+                matched = [(r, labels[name].high_temperature) for r in cube_rooms if labels[name].matches(r)]
+            else:
+                matched = [(r, self.config.high_temperature) for r in cube_rooms
+                           if r.name == name or str(r.room_id) == name]
+            if not matched:
+                raise Exception("Unknown room: %s" % name)
+            rooms.extend(matched)
+        return rooms
+
+    def boost(self, names, duration=None, temperature=None, deadline=None):
+        """
+        Sets a temporary temperature on the rooms named in `names` right away, without running the calendar pipeline.
+        The thermostats hold it until the override ends (`duration` or boost_duration from now, rounded up to the
+        half hour the cube supports) and return to their week program afterwards. Returns the names of the boosted
+        cube rooms and the end of the override.
+        """
+        if temperature is not None and not 5 <= temperature <= 30:
+            raise Exception("Temperature must be between 5 and 30: %s" % temperature)
+
+        duration = duration or self.config.boost_duration
+        deadline = deadline or Deadline(self.config.tick_timeout, self.clock.time)
+
+        end = self.now().astimezone(self._cube_timezone()) + duration
+        if end.minute % 30 or end.second or end.microsecond:
+            end = end.replace(minute=end.minute - end.minute % 30, second=0, microsecond=0) + \
+                datetime.timedelta(minutes=30)
+
+        with self.cube_session(deadline) as cube:
+            rooms = self._override_rooms(list(cube.rooms), names)
+            for room, high_temperature in rooms:
+                deadline.check()
+                room_temperature = temperature if temperature is not None else high_temperature
+                logger.info("Boosting room %s to %s until %s", room.name, room_temperature, end)
+                cube.set_mode_vacation(room.room_id, room.rf_address, room_temperature, end)
+                self.overrides[room.name] = end
+
+        return {'rooms': [room.name for room, _ in rooms], 'until': end.isoformat()}
+
+    @contextlib.contextmanager
+    def cube_session(self, deadline=None):
+        """Connects to the cube with retries, guarded by the cube's circuit breaker"""
+        def _connect():
+            cube = self.connect_to_cube()
+            return cube, cube.__enter__()
+
+        cube, session = call_with_retries(_connect, self.config.io_retries, self.config.retry_backoff, deadline,
+                                          self.cube_breaker, self.sleep)
+        try:
+            yield session
+        finally:
+            cube.__exit__(None, None, None)
+
     def connect_to_cube(self):
+        from pymax.cube import Discovery, Cube
+
         cube_addr = None
         cube_port = self.config.cube_port
 
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+import datetime
+
+import icalendar
+import pytz
+from dateutil import rrule
+
+from maxd.budget import ExpansionBudget, SKIP
+from maxd.config import Configuration, CalendarConfig
+from maxd.worker import Worker
+
+START = datetime.datetime(2015, 12, 21)
+
+
+def _minutely(dtstart=START):
+    return rrule.rrule(rrule.MINUTELY, dtstart=dtstart)
+
+
+class FakeClock(object):
+
+    def __init__(self, step):
+        self.now = 0
+        self.step = step
+
+    def __call__(self):
+        self.now += self.step
+        return self.now
+
+
+class TestExpansionBudget(object):
+
+    def test_within_budget(self):
+        budget = ExpansionBudget('test')
+        occurrences, exceeded = budget.expand(_minutely(), START, START + datetime.timedelta(minutes=9))
+        assert len(occurrences) == 10 and exceeded is None
+        assert budget.occurrences == 10
+
+    def test_series_limit(self):
+        budget = ExpansionBudget('test', series_occurrences=100)
+        occurrences, exceeded = budget.expand(_minutely(), START, START + datetime.timedelta(days=1))
+        assert len(occurrences) == 100 and exceeded == 'series'
+
+    def test_calendar_limit(self):
+        budget = ExpansionBudget('test', calendar_occurrences=150)
+        budget.add(100)
+        occurrences, exceeded = budget.expand(_minutely(), START, START + datetime.timedelta(days=1))
+        assert len(occurrences) == 50 and exceeded == 'calendar'
+
+    def test_time_limit(self):
+        # every read of the clock takes a second: the series runs out of time at the first check
+        budget = ExpansionBudget('test', series_seconds=1, clock=FakeClock(1))
+        occurrences, exceeded = budget.expand(_minutely(START - datetime.timedelta(days=365)), START,
+                                              START + datetime.timedelta(days=1))
+        assert occurrences == [] and exceeded == 'time'
+
+    def test_record(self):
+        budget = ExpansionBudget('test')
+        budget.record('series', 'Event')
+        budget.record('series', 'Event')
+        assert budget.exceeded == {'series': 2}
+
+
+class TestWorkerBudget(object):
+
+    def _calendar(self):
+        cal = icalendar.Calendar()
+        event = icalendar.Event()
+        event.add('UID', 'minutely')
+        event.add('SUMMARY', 'Every minute')
+        event.add('DTSTART', datetime.datetime(2015, 12, 22, 9, tzinfo=pytz.UTC))
+        event.add('DTEND', datetime.datetime(2015, 12, 22, 9, 1, tzinfo=pytz.UTC))
+        event.add('RRULE', {'FREQ': 'MINUTELY'})
+        cal.add_component(event)
+        return [event]
+
+    def _expand(self, **kwargs):
+        w = Worker(Configuration('/dev/null'))
+        cc = CalendarConfig(name='test', url='test.ics', **kwargs)
+        budget = ExpansionBudget.for_calendar(cc)
+        start = datetime.datetime(2015, 12, 21, tzinfo=pytz.UTC)
+        end = datetime.datetime(2015, 12, 27, 23, 59, 59, tzinfo=pytz.UTC)
+        return w.expand_events(self._calendar(), start, end, budget)[0], budget
+
+    def test_collapse(self):
+        events, budget = self._expand(max_occurrences=500)
+        # one event per day from the first occurrence to the end of the window
+        assert len(events) == 6
+        assert events[0].start == datetime.datetime(2015, 12, 22, 9, tzinfo=pytz.UTC)
+        assert events[0].end == datetime.datetime(2015, 12, 22, 23, 59, 59, tzinfo=pytz.UTC)
+        assert events[1].start == datetime.datetime(2015, 12, 23, tzinfo=pytz.UTC)
+        assert events[-1].end == datetime.datetime(2015, 12, 27, 23, 59, 59, tzinfo=pytz.UTC)
+        assert budget.exceeded == {'series': 1}
+
+    def test_collapse_schedule(self):
+        events, budget = self._expand(max_occurrences=500)
+        w = Worker(Configuration('/dev/null'))
+        schedule = w.create_schedule(events).effective()
+
+        # every day from the first occurrence on is heated, not just the first one
+        assert sorted(schedule.events.keys()) == [1, 2, 3, 4, 5, 6]
+        assert schedule.events[1] == [(datetime.datetime(2015, 12, 22, 9, tzinfo=pytz.UTC) - w.config.warmup_duration,
+                                       datetime.datetime(2015, 12, 22, 23, 59, 59, tzinfo=pytz.UTC))]
+        for weekday in range(2, 7):
+            day = datetime.datetime(2015, 12, 21 + weekday, tzinfo=pytz.UTC)
+            assert schedule.events[weekday] == [(day, day.replace(hour=23, minute=59, second=59))]
+
+    def test_skip(self):
+        events, budget = self._expand(max_occurrences=500, expand_overflow=SKIP)
+        assert events == []
+        assert budget.exceeded == {'series': 1}
+
+    def test_status(self, tmpdir):
+        path = tmpdir.join('minutely.ics')
+        path.write_binary(b"BEGIN:VCALENDAR\r\n" + self._calendar()[0].to_ical() + b"END:VCALENDAR\r\n")
+
+        w = Worker(Configuration('/dev/null'))
+        cc = CalendarConfig(name='test', url=str(path), max_calendar_occurrences=200)
+        events = w.fetch_events(cc, datetime.datetime(2015, 12, 21, tzinfo=pytz.UTC),
+                                datetime.datetime(2015, 12, 27, tzinfo=pytz.UTC))
+        # the collapsed series, one event for each day of the window from its first occurrence on
+        assert len(events) == 6
+        assert w.status()['expansion_overflows'] == {'test': {'calendar': 1}}
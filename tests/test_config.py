@@ -5,7 +5,8 @@ try:
     from StringIO import StringIO
 except ImportError:
     from io import StringIO
-from maxd.config import Configuration, timediff, max_value, min_value, time_range
+from maxd.config import Configuration, RoomConfig, timediff, max_value, min_value, time_range, byte_size
+from maxd.replay import Room
 
 
 class TestConfig(object):
@@ -48,6 +49,10 @@ class TestConfig(object):
         assert cfg.calendars[1].username == 'foo'
         assert cfg.calendars[1].password == 'bar'
 
+    def test_calendar_property_caldav(self):
+        assert not Configuration('tests/fixtures/config/basic2.cfg').calendars[0].caldav
+        assert Configuration('tests/fixtures/config/caldav.cfg').calendars[0].caldav
+
     def test_basic_config(self):
         cfg = Configuration('tests/fixtures/config/basic.cfg')
         assert cfg.cfg_parser is not None
@@ -196,3 +201,53 @@ monday = 08:00 - 10:00
         ]
 
         assert list(time_range('08:30 - 09:00,')) == [(8, 30, 9, 0)]
+
+    def test_check(self):
+        assert Configuration('tests/fixtures/config/basic2.cfg').check() == []
+
+    def test_check_problems(self):
+        problems = Configuration('tests/fixtures/config/invalid.cfg').check()
+        assert "Calendar 'cal1' has no url" in problems
+        assert "Calendar section 'cal2' is missing" in problems
+        assert any(p.startswith('Invalid value for warmup_duration') for p in problems)
+        assert any(p.startswith('Invalid value for allday_range') for p in problems)
+        assert "Unknown cube timezone: Mars/Olympus_Mons" in problems
+
+    def test_byte_size(self):
+        assert byte_size(None) is None
+        assert byte_size(100) == 100
+        assert byte_size('100') == 100
+        assert byte_size('512k') == 512 * 1024
+        assert byte_size('10 MB') == 10 * 1024 * 1024
+        assert byte_size('1G') == 1024 ** 3
+
+        with pytest.raises(ValueError):
+            byte_size('lots')
+
+    def test_calendar_http_settings(self):
+        cal = Configuration('tests/fixtures/config/caldav.cfg').calendars[0]
+        assert cal.connect_timeout == 5
+        assert cal.read_timeout == 30
+        assert cal.max_size == 2 * 1024 * 1024
+
+    def test_rooms(self):
+        cfg = Configuration('tests/fixtures/config/rooms.cfg')
+        office, hall, meeting = cfg.rooms
+        assert office == RoomConfig(label='office', room_id=1, name=None, rf_addr=None, calendars=('weekly', ),
+                                    filter=None, high_temperature=21, low_temperature=10)
+        assert hall.rf_addr == 3 and hall.high_temperature == 22
+        assert meeting.calendars == ('weekly', 'single')
+        assert meeting.filter == "name == 'Ending repeating event'"
+        assert cfg.check() == []
+
+        assert meeting.matches(Room(room_id=5, name='Meeting room', rf_address=9))
+        assert not office.matches(Room(room_id=5, name='Meeting room', rf_address=9))
+
+    def test_rooms_check(self):
+        cfg = Configuration('tests/fixtures/config/rooms.cfg')
+        cfg.cfg_parser.set('room:office', 'calendars', 'weekly, missing')
+        cfg.cfg_parser.remove_option('room:hall', 'rf_addr')
+        assert cfg.check() == ["Room 'office' uses unknown calendar 'missing'", "Room 'hall' has no id, name or rf_addr"]
+
+    def test_no_rooms(self):
+        assert Configuration('tests/fixtures/config/basic.cfg').rooms == []
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+import datetime
+import os
+import tempfile
+import threading
+
+import pytest
+
+from maxd.control import ControlServer, send_command
+
+
+class FakeDaemon(object):
+
+    def __init__(self):
+        self.refreshed = []
+        self.reloaded = 0
+        self.boosted = []
+
+    def status(self):
+        return {'timings': {'total': 1.5}}
+
+    def refresh(self, calendars=None):
+        self.refreshed.append(calendars)
+        done = threading.Event()
+        done.set()
+        return done
+
+    def reload(self):
+        self.reloaded += 1
+        done = threading.Event()
+        done.set()
+        return done
+
+    def boost(self, names, duration=None, temperature=None):
+        self.boosted.append((names, duration, temperature))
+        return {'rooms': names, 'until': '2015-12-28T10:30:00+00:00'}
+
+
+@pytest.fixture
+def control_server():
+    path = os.path.join(tempfile.mkdtemp(), 'control.sock')
+    server = ControlServer(path, FakeDaemon())
+    server.start()
+    yield server
+    server.stop()
+
+
+class TestControlServer(object):
+
+    def test_status(self, control_server):
+        assert send_command(control_server.path, 'status', timeout=5) == {'timings': {'total': 1.5}}
+
+    def test_refresh(self, control_server):
+        response = send_command(control_server.path, 'refresh', timeout=5)
+        assert response == {'result': 'ok', 'status': {'timings': {'total': 1.5}}}
+
+        send_command(control_server.path, 'REFRESH cal1 cal2', timeout=5)
+        assert control_server.daemon.refreshed == [None, ['cal1', 'cal2']]
+
+    def test_refresh_timeout(self, control_server):
+        control_server.daemon.refresh = lambda calendars: threading.Event()
+        control_server.refresh_timeout = 0.01
+        assert 'error' in send_command(control_server.path, 'refresh', timeout=5)
+
+    def test_reload(self, control_server):
+        assert send_command(control_server.path, 'reload', timeout=5)['result'] == 'ok'
+        assert control_server.daemon.reloaded == 1
+
+    def test_boost(self, control_server):
+        response = send_command(control_server.path, 'boost office,hall', timeout=5)
+        assert response == {'result': 'ok', 'rooms': ['office', 'hall'], 'until': '2015-12-28T10:30:00+00:00'}
+
+        send_command(control_server.path, 'boost office 90 21.5', timeout=5)
+        assert control_server.daemon.boosted == [(['office', 'hall'], None, None),
+                                                 (['office'], datetime.timedelta(minutes=90), 21.5)]
+
+    def test_unknown_command(self, control_server):
+        assert send_command(control_server.path, 'reboot', timeout=5) == {'error': 'Unknown command: reboot'}
+
+    def test_bad_arguments(self, control_server):
+        assert 'error' in send_command(control_server.path, 'status now', timeout=5)
+
+    def test_stop_removes_socket(self):
+        path = os.path.join(tempfile.mkdtemp(), 'control.sock')
+        server = ControlServer(path, FakeDaemon())
+        server.start()
+        assert os.path.exists(path)
+        server.stop()
+        assert not os.path.exists(path)
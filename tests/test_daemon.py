@@ -1,5 +1,16 @@
 # -*- coding: utf-8 -*-
+import subprocess
+import sys
+
 from maxd.__main__ import Daemon
+from maxd.config import CalendarConfig
+from maxd.daemon import WorkerThread, LatestValue
+import threading
+
+if sys.version_info.major == 2 or (sys.version_info.major == 3 and sys.version_info.minor <= 2):
+    from mock import patch, Mock
+else:
+    from unittest.mock import patch, Mock
 
 
 class TestDaemon(object):
@@ -7,3 +18,144 @@ class TestDaemon(object):
     def test_constructor(self):
         d = Daemon('tests/fixtures/config/basic.cfg')
 
+    def test_lazy_imports(self):
+        code = "import sys; import maxd.__main__; " \
+               "print(','.join(m for m in ('icalendar', 'requests', 'cachecontrol', 'pymax', 'phylter', 'maxd.worker') if m in sys.modules))"
+        output = subprocess.check_output([sys.executable, '-c', code], env={'PYTHONPATH': 'src'})
+        assert output.strip() == b''
+
+    def test_lazy_numpy(self):
+        code = "import sys; import maxd.worker; print('numpy' in sys.modules)"
+        output = subprocess.check_output([sys.executable, '-c', code], env={'PYTHONPATH': 'src'})
+        assert output.strip() == b'False'
+
+    @patch('maxd.worker.Worker')
+    def test_run_once(self, worker_mock):
+        assert Daemon('tests/fixtures/config/basic.cfg').run_once()
+        assert worker_mock.return_value.execute.call_count == 1
+
+    @patch('maxd.worker.Worker')
+    def test_run_once_failure(self, worker_mock):
+        worker_mock.return_value.execute.side_effect = Exception("cube not found")
+        assert not Daemon('tests/fixtures/config/basic.cfg').run_once()
+
+    @patch('maxd.worker.Worker')
+    def test_worker_thread_refresh(self, worker_mock):
+        worker_mock.return_value.config.calendars = [CalendarConfig(name='cal1', url='a'), CalendarConfig(name='cal2', url='b')]
+
+        thread = WorkerThread('tests/fixtures/config/basic.cfg')
+        thread.interval = 60
+        thread.daemon = True
+        thread.start()
+
+        assert thread.request_refresh(['cal1']).wait(5)
+        assert worker_mock.return_value.compute.call_args[1] == {'refresh': set(['cal1'])}
+        assert worker_mock.return_value.write.call_count >= 1
+
+        assert thread.request_refresh().wait(5)
+        assert worker_mock.return_value.compute.call_args[1] == {'refresh': set(['cal1', 'cal2'])}
+
+        thread.stop()
+        thread.join(5)
+        assert not thread.is_alive()
+
+    @patch('maxd.worker.Worker')
+    def test_worker_thread_profiler(self, worker_mock):
+        thread = WorkerThread('tests/fixtures/config/basic.cfg')
+        thread.profiler = Mock()
+        thread.interval = 60
+        thread.daemon = True
+        thread.start()
+
+        assert thread.request_refresh().wait(5)
+        thread.stop()
+        thread.join(5)
+        assert thread.profiler.run.call_args[0] == (worker_mock.return_value.compute, )
+
+    @patch('maxd.worker.Worker')
+    def test_worker_thread_reload(self, worker_mock):
+        thread = WorkerThread('tests/fixtures/config/basic.cfg')
+        thread.interval = 60
+        thread.daemon = True
+        thread.start()
+
+        assert thread.request_reload().wait(5)
+        assert worker_mock.return_value.reload_config.call_count == 1
+        assert thread.request_refresh().wait(5)
+        assert worker_mock.return_value.reload_config.call_count == 1
+
+        thread.stop()
+        thread.join(5)
+
+    @patch('maxd.worker.Worker')
+    def test_worker_thread_slow_writes(self, worker_mock):
+        computed = []
+        written = []
+        writing = threading.Event()
+        release = threading.Event()
+
+        def _compute(refresh):
+            computed.append(len(computed))
+            return computed[-1]
+
+        def _write(state):
+            writing.set()
+            release.wait(5)
+            written.append(state)
+
+        worker_mock.return_value.compute.side_effect = _compute
+        worker_mock.return_value.write.side_effect = _write
+
+        thread = WorkerThread('tests/fixtures/config/basic.cfg')
+        thread.interval = 60
+        thread.daemon = True
+        thread.start()
+        assert writing.wait(5)
+
+        def _wait_computed(n):
+            for _ in range(50):
+                if len(computed) == n and thread.desired.full:
+                    return True
+                threading.Event().wait(0.1)
+            return False
+
+        # the calendars are fetched again while the first state is still being written, the newer state replaces
+        # the unsent one
+        first = thread.request_refresh()
+        assert _wait_computed(2)
+        second = thread.request_refresh()
+        assert _wait_computed(3)
+        assert not first.is_set()
+
+        release.set()
+        assert first.wait(5) and second.wait(5)
+        assert written == [0, 2]
+
+        thread.stop()
+        thread.join(5)
+        assert not thread.is_alive()
+
+    def test_status_without_worker(self):
+        assert Daemon('tests/fixtures/config/basic.cfg').status() == {}
+
+
+class TestLatestValue(object):
+
+    def test_replace(self):
+        slot = LatestValue()
+        assert slot.take(0) is None
+        slot.put(1)
+        slot.put(2)
+        assert slot.take(0) == 2
+        assert slot.take(0) is None
+
+    def test_merge(self):
+        slot = LatestValue()
+        slot.put([1])
+        slot.put([2], lambda unsent, latest: unsent + latest)
+        assert slot.take(0) == [1, 2]
+
+    def test_wait(self):
+        slot = LatestValue()
+        threading.Timer(0.05, slot.put, (1, )).start()
+        assert slot.take(5) == 1
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import datetime
+
+import pytest
+import pytz
+
+from maxd.config import Configuration, CalendarConfig
+from maxd.fastparse import reduce_document, EVENT_PROPERTIES
+from maxd.fetcher import LocalCalendarEventFetcher, _vevents
+from maxd.index import event_key
+from maxd.worker import Worker
+
+NOISY = b"""BEGIN:VCALENDAR\r
+VERSION:2.0\r
+PRODID:-//Example//Exchange//EN\r
+X-PUBLISHED-TTL:PT1H\r
+BEGIN:VTIMEZONE\r
+TZID:Europe/Berlin\r
+BEGIN:STANDARD\r
+DTSTART:19701025T030000\r
+RRULE:FREQ=YEARLY;BYMONTH=10;BYDAY=-1SU\r
+TZOFFSETFROM:+0200\r
+TZOFFSETTO:+0100\r
+END:STANDARD\r
+BEGIN:DAYLIGHT\r
+DTSTART:19700329T020000\r
+RRULE:FREQ=YEARLY;BYMONTH=3;BYDAY=-1SU\r
+TZOFFSETFROM:+0100\r
+TZOFFSETTO:+0200\r
+END:DAYLIGHT\r
+END:VTIMEZONE\r
+BEGIN:VTODO\r
+UID:todo\r
+SUMMARY:Not an event\r
+DTSTART:20151221T090000Z\r
+END:VTODO\r
+BEGIN:VEVENT\r
+UID:meeting\r
+SUMMARY:Weekly\r
+  meeting\r
+DESCRIPTION:A long description\\, folded over\r
+  several lines\r
+ATTENDEE;CN=Someone:mailto:someone@example.com\r
+ATTACH;ENCODING=BASE64;VALUE=BINARY:aGVsbG8gd29y\r
+ bGQ=\r
+DTSTART;TZID=Europe/Berlin:20151221T090000\r
+DTEND;TZID=Europe/Berlin:20151221T100000\r
+RRULE:FREQ=WEEKLY;BYDAY=MO\r
+BEGIN:VALARM\r
+ACTION:DISPLAY\r
+DESCRIPTION:Reminder\r
+TRIGGER:-PT15M\r
+END:VALARM\r
+END:VEVENT\r
+END:VCALENDAR\r
+"""
+
+
+class TestReduceDocument(object):
+
+    def test_skips_unused(self):
+        reduced = reduce_document(NOISY, calendar_properties=('X-PUBLISHED-TTL', ))
+        for skipped in (b'VTODO', b'VALARM', b'DESCRIPTION', b'ATTENDEE', b'ATTACH', b'PRODID'):
+            assert skipped not in reduced
+        for kept in (b'TZOFFSETFROM', b'X-PUBLISHED-TTL', b'RRULE:FREQ=WEEKLY', b'SUMMARY:Weekly\r\n  meeting'):
+            assert kept in reduced
+
+    def test_same_events(self):
+        properties = {}
+        full = list(_vevents(NOISY))
+        fast = list(_vevents(NOISY, properties, EVENT_PROPERTIES))
+        assert [event_key(e) for e in fast] == [event_key(e) for e in full]
+        assert str(fast[0]['SUMMARY']) == 'Weekly meeting'
+        assert fast[0]['DTSTART'].dt == datetime.datetime(2015, 12, 21, 8, tzinfo=pytz.UTC)
+        assert 'DESCRIPTION' not in fast[0] and not fast[0].subcomponents
+        assert 'X-PUBLISHED-TTL' in properties
+
+    @pytest.mark.parametrize('name', ['feiertage.ics', 'repeating.ics', 'single_event.ics'])
+    def test_fixtures(self, name):
+        with open('tests/fixtures/calendars/%s' % name, 'r') as f:
+            data = f.read()
+        assert [event_key(e) for e in _vevents(data, None, EVENT_PROPERTIES)] == \
+            [event_key(e) for e in _vevents(data)]
+
+
+class TestFastParseFetcher(object):
+
+    def test_worker(self, tmpdir):
+        path = tmpdir.join('noisy.ics')
+        path.write_binary(NOISY)
+        start = datetime.datetime(2015, 12, 21, tzinfo=pytz.UTC)
+        end = datetime.datetime(2015, 12, 27, 23, 59, 59, tzinfo=pytz.UTC)
+
+        w = Worker(Configuration('/dev/null'))
+        cc = CalendarConfig(name='noisy', url=str(path), fast_parse=True)
+        assert w.get_fetcher(cc).event_properties == EVENT_PROPERTIES
+        assert LocalCalendarEventFetcher().event_properties is None
+
+        events = w.fetch_events(cc, start, end)
+        assert [(e.name, e.start) for e in events] == [('Weekly meeting', datetime.datetime(2015, 12, 21, 8, tzinfo=pytz.UTC))]
@@ -1,15 +1,25 @@
 # -*- coding: utf-8 -*-
 from maxd.config import CalendarConfig
-from maxd.fetcher import LocalCalendarEventFetcher, HTTPCalendarEventFetcher
+from maxd.fetcher import LocalCalendarEventFetcher, HTTPCalendarEventFetcher, CalDAVCalendarEventFetcher, _http_ttl
+from maxd.resilience import DeadlineExceeded
 import requests
 import datetime
+import gzip
+import pytest
 import pytz
 import sys
+import threading
+from io import BytesIO
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
 
 if sys.version_info.major == 2 or (sys.version_info.major == 3 and sys.version_info.minor <= 2):
-    from mock import Mock
+    from mock import Mock, patch
 else:
-    from unittest.mock import Mock
+    from unittest.mock import Mock, patch
 
 class TestLocalFetcher(object):
 
@@ -24,6 +34,24 @@ class TestLocalFetcher(object):
         assert event['DTSTART'].dt == datetime.datetime(2015, 12, 20, 9, 0, tzinfo=pytz.UTC)
         assert event['DTEND'].dt == datetime.datetime(2015, 12, 20, 10, 0, tzinfo=pytz.UTC)
 
+    def test_feed_ttl(self, tmpdir):
+        path = tmpdir.join('ttl.ics')
+        f = LocalCalendarEventFetcher()
+        cc = CalendarConfig(name='test', url=str(path))
+
+        path.write("BEGIN:VCALENDAR\r\nVERSION:2.0\r\nX-PUBLISHED-TTL:PT1H\r\nEND:VCALENDAR\r\n")
+        list(f.fetch(cc))
+        assert f.ttl == 3600
+
+        path.write("BEGIN:VCALENDAR\r\nVERSION:2.0\r\nX-PUBLISHED-TTL:PT1H\r\n"
+                   "REFRESH-INTERVAL;VALUE=DURATION:PT30M\r\nEND:VCALENDAR\r\n")
+        list(f.fetch(cc))
+        assert f.ttl == 1800
+
+        path.write("BEGIN:VCALENDAR\r\nVERSION:2.0\r\nX-PUBLISHED-TTL:never\r\nEND:VCALENDAR\r\n")
+        list(f.fetch(cc))
+        assert f.ttl is None
+
 
 class TestHTTPFetcher(object):
 
@@ -31,10 +59,15 @@ class TestHTTPFetcher(object):
         f = HTTPCalendarEventFetcher()
         assert isinstance(f.session, requests.sessions.Session)
 
-    def test_fetch_without_auth(self):
+    def _response_mock(self):
         response_mock = Mock()
-        with open('tests/fixtures/calendars/single_event.ics', 'r') as f:
-            response_mock.content = f.read()
+        response_mock.headers = {}
+        with open('tests/fixtures/calendars/single_event.ics', 'rb') as f:
+            response_mock.iter_content = Mock(return_value=[f.read()])
+        return response_mock
+
+    def test_fetch_without_auth(self):
+        response_mock = self._response_mock()
 
         f = HTTPCalendarEventFetcher()
         f.session = Mock()
@@ -42,8 +75,9 @@ class TestHTTPFetcher(object):
 
         response = list(f.fetch(CalendarConfig(name='test', url='http://example.com/test.ics')))
         f.session.get.assert_called_with('http://example.com/test.ics', headers={
-            'Accept': 'text/calendar'
-        })
+            'Accept': 'text/calendar',
+            'Accept-Encoding': 'gzip, deflate',
+        }, stream=True, timeout=(10, 30))
         assert len(response) == 1
 
     def test_fetch_with_auth(self):
@@ -52,17 +86,311 @@ class TestHTTPFetcher(object):
 
         def get_mock(*args, **kwargs): # stupid way to get around the not implemented __eq__ for HttpBasicAuth
             assert len(args) == 1 and args[0] == 'http://example.com/test.ics'
-            assert len(kwargs) == 2 and \
+            assert len(kwargs) == 4 and \
                    ('auth' in kwargs and kwargs['auth'].username == 'foo' and kwargs['auth'].password == 'bar') and \
                    ('headers' in kwargs and kwargs['headers'] == {
-                        'Accept': 'text/calendar'
+                        'Accept': 'text/calendar',
+                        'Accept-Encoding': 'gzip, deflate',
                     }), "A HTTPBasicAuth instance should be passed to requests"
-            response_mock = Mock()
-            with open('tests/fixtures/calendars/single_event.ics', 'r') as f:
-                response_mock.content = f.read()
-            return response_mock
+            return self._response_mock()
 
         f.session.get = Mock(side_effect=get_mock)
         response = list(f.fetch(CalendarConfig(name='test', url='http://example.com/test.ics', username='foo', password='bar')))
         assert f.session.get.called
         assert len(response) == 1
+
+    def test_fetch_timeouts(self):
+        f = HTTPCalendarEventFetcher()
+        f.session = Mock()
+        f.session.get = Mock(return_value=self._response_mock())
+
+        list(f.fetch(CalendarConfig(name='test', url='http://example.com/test.ics', connect_timeout=1, read_timeout=2)))
+        assert f.session.get.call_args[1]['timeout'] == (1, 2)
+
+    def test_fetch_deadline(self):
+        f = HTTPCalendarEventFetcher()
+        f.session = Mock()
+        f.session.get = Mock(return_value=self._response_mock())
+
+        deadline = Mock()
+        deadline.timeout = lambda t: min(t, 15)
+        deadline.expired = Mock(return_value=False)
+        list(f.fetch(CalendarConfig(name='test', url='http://example.com/test.ics'), deadline=deadline))
+        assert f.session.get.call_args[1]['timeout'] == (10, 15)
+
+        deadline.expired = Mock(return_value=True)
+        with pytest.raises(DeadlineExceeded):
+            list(f.fetch(CalendarConfig(name='test', url='http://example.com/test.ics'), deadline=deadline))
+
+    def test_fetch_invalidated(self):
+        f = HTTPCalendarEventFetcher()
+        f.session = Mock()
+        f.session.get = Mock(return_value=self._response_mock())
+        cc = CalendarConfig(name='test', url='http://example.com/test.ics')
+
+        f.invalidate()
+        list(f.fetch(cc))
+        assert f.session.get.call_args[1]['headers']['Cache-Control'] == 'no-cache'
+
+        list(f.fetch(cc))
+        assert 'Cache-Control' not in f.session.get.call_args[1]['headers']
+
+    def test_fetch_compressed(self, ics_server):
+        with open('tests/fixtures/calendars/single_event.ics', 'rb') as f:
+            ics_server.body = f.read()
+        ics_server.compress = True
+
+        f = HTTPCalendarEventFetcher()
+        response = list(f.fetch(CalendarConfig(name='test', url=ics_server.url)))
+        assert len(response) == 1
+        assert 'gzip' in ics_server.accept_encoding
+        assert ics_server.sent < len(ics_server.body)
+
+    def test_fetch_cache_headers(self, ics_server):
+        with open('tests/fixtures/calendars/single_event.ics', 'rb') as f:
+            ics_server.body = f.read()
+        f = HTTPCalendarEventFetcher()
+        cc = CalendarConfig(name='test', url=ics_server.url)
+
+        list(f.fetch(cc))
+        assert f.ttl is None
+
+        ics_server.headers = {'Cache-Control': 'public, max-age=600', 'Age': '100'}
+        list(f.fetch(cc))
+        assert f.ttl == 500
+
+        ics_server.headers = {'Cache-Control': 'no-cache, max-age=600'}
+        f.invalidate()
+        list(f.fetch(cc))
+        assert f.ttl is None
+
+    def test_fetch_bounded_cache(self, ics_server):
+        from maxd.httpcache import BoundedCache
+
+        with open('tests/fixtures/calendars/single_event.ics', 'rb') as f:
+            ics_server.body = f.read()
+        ics_server.headers = {'Cache-Control': 'max-age=600'}
+        cache = BoundedCache(1024 * 1024)
+        f = HTTPCalendarEventFetcher(cache)
+        cc = CalendarConfig(name='test', url=ics_server.url)
+
+        assert len(list(f.fetch(cc))) == 1
+        assert len(list(f.fetch(cc))) == 1
+        stats = cache.stats()
+        assert stats['entries'] == 1 and stats['resident_bytes'] > len(ics_server.body)
+        assert stats['hits'] >= 1
+
+    def test_http_ttl_expires(self):
+        assert _http_ttl({'Date': 'Mon, 21 Dec 2015 09:00:00 GMT', 'Expires': 'Mon, 21 Dec 2015 10:00:00 GMT'}) == 3600
+        assert _http_ttl({'Date': 'Mon, 21 Dec 2015 09:00:00 GMT', 'Expires': 'Mon, 21 Dec 2015 08:00:00 GMT'}) is None
+        assert _http_ttl({'Expires': '0'}) is None
+
+    def test_fetch_content_length_too_large(self, ics_server):
+        ics_server.body = b'x' * 2048
+
+        f = HTTPCalendarEventFetcher()
+        with pytest.raises(Exception) as ex:
+            list(f.fetch(CalendarConfig(name='test', url=ics_server.url, max_size=1024)))
+        assert 'too large' in str(ex.value)
+
+    def test_fetch_body_too_large(self, ics_server):
+        # a gzip bomb: the compressed body is small, the decompressed one exceeds max_size
+        ics_server.body = b'x' * (1024 * 1024)
+        ics_server.compress = True
+
+        f = HTTPCalendarEventFetcher()
+        f.chunk_size = 1024
+        with pytest.raises(Exception) as ex:
+            list(f.fetch(CalendarConfig(name='test', url=ics_server.url, max_size=64 * 1024)))
+        assert 'exceeds max_size' in str(ex.value)
+
+
+def _ical_event(uid, summary, start):
+    return "BEGIN:VCALENDAR\r\nVERSION:2.0\r\nBEGIN:VEVENT\r\nUID:%s\r\nSUMMARY:%s\r\n" \
+           "DTSTART:%sZ\r\nDTEND:%sZ\r\nEND:VEVENT\r\nEND:VCALENDAR\r\n" % (uid, summary, start, start.replace('T09', 'T10'))
+
+
+def _multistatus(responses, sync_token=None):
+    body = '<?xml version="1.0" encoding="utf-8"?>\n<D:multistatus xmlns:D="DAV:" xmlns:C="urn:ietf:params:xml:ns:caldav">'
+    for href, data in responses:
+        if data is None:
+            body += '<D:response><D:href>%s</D:href><D:status>HTTP/1.1 404 Not Found</D:status></D:response>' % href
+        else:
+            body += '<D:response><D:href>%s</D:href><D:propstat><D:prop><D:getetag>"1"</D:getetag>' \
+                    '<C:calendar-data>%s</C:calendar-data></D:prop><D:status>HTTP/1.1 200 OK</D:status>' \
+                    '</D:propstat></D:response>' % (href, data)
+    if sync_token:
+        body += '<D:sync-token>%s</D:sync-token>' % sync_token
+    return body + '</D:multistatus>'
+
+
+class CalDAVHandler(BaseHTTPRequestHandler):
+    """A minimal stand-in for a CalDAV server which knows calendar-query, sync-collection and calendar-multiget"""
+
+    def log_message(self, *args):
+        pass
+
+    def do_REPORT(self):
+        body = self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8')
+        self.server.requests.append((self.headers['Depth'], body))
+
+        if 'calendar-query' in body:
+            if self.server.supports_query and ('expand' not in body or self.server.supports_expand):
+                status, content = 207, _multistatus([('/cal/1.ics', _ical_event('1', 'In window', '20151221T090000'))])
+            else:
+                status, content = 501, ''
+        elif 'sync-collection' in body:
+            if '<D:sync-token></D:sync-token>' in body:
+                status, content = 207, _multistatus([
+                    ('/cal/1.ics', _ical_event('1', 'First', '20151221T090000')),
+                    ('/cal/2.ics', _ical_event('2', 'Second', '20151222T090000')),
+                ], sync_token='token-1')
+            elif 'token-1' in body:
+                # 1.ics deleted, 3.ics created (announced without data)
+                status, content = 207, _multistatus([('/cal/1.ics', None)], sync_token='token-2') \
+                    .replace('</D:multistatus>', '<D:response><D:href>/cal/3.ics</D:href><D:propstat><D:prop>'
+                             '<D:getetag>"1"</D:getetag></D:prop><D:status>HTTP/1.1 200 OK</D:status></D:propstat>'
+                             '</D:response></D:multistatus>')
+            else:
+                status, content = 403, ''
+        elif 'calendar-multiget' in body:
+            status, content = 207, _multistatus([('/cal/3.ics', _ical_event('3', 'Third', '20151223T090000'))])
+        else:
+            status, content = 400, ''
+
+        content = content.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class ICSHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.accept_encoding = self.headers.get('Accept-Encoding', '')
+        body = self.server.body
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/calendar')
+        for name, value in self.server.headers.items():
+            self.send_header(name, value)
+        if self.server.compress:
+            body = gzip_compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.server.sent = len(body)
+        self.wfile.write(body)
+
+
+def gzip_compress(data):
+    buf = BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+def _serve(handler):
+    server = HTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05})
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+@pytest.fixture
+def ics_server():
+    server = _serve(ICSHandler)
+    server.body = b''
+    server.compress = False
+    server.headers = {}
+    server.url = 'http://127.0.0.1:%s/test.ics' % server.server_address[1]
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def caldav_server():
+    server = _serve(CalDAVHandler)
+    server.requests = []
+    server.supports_query = True
+    server.supports_expand = True
+    server.url = 'http://127.0.0.1:%s/cal/' % server.server_address[1]
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class TestCalDAVFetcher(object):
+    start = datetime.datetime(2015, 12, 21, tzinfo=pytz.UTC)
+    end = datetime.datetime(2015, 12, 27, 23, 59, 59, tzinfo=pytz.UTC)
+
+    def test_calendar_query(self, caldav_server):
+        f = CalDAVCalendarEventFetcher()
+        events = list(f.fetch(CalendarConfig(name='test', url=caldav_server.url, caldav=True), self.start, self.end))
+
+        assert [str(e['SUMMARY']) for e in events] == ['In window']
+        assert len(caldav_server.requests) == 1
+        depth, body = caldav_server.requests[0]
+        assert depth == '1'
+        assert '<C:time-range start="20151221T000000Z" end="20151227T235959Z"/>' in body
+        assert '<C:expand start="20151221T000000Z" end="20151227T235959Z"/>' in body
+
+    def test_invalidated(self, caldav_server):
+        f = CalDAVCalendarEventFetcher()
+        cc = CalendarConfig(name='test', url=caldav_server.url, caldav=True)
+
+        with patch.object(f.session, 'request', side_effect=f.session.request) as request_mock:
+            f.invalidate()
+            list(f.fetch(cc, self.start, self.end))
+            assert request_mock.call_args[1]['headers']['Cache-Control'] == 'no-cache'
+
+            list(f.fetch(cc, self.start, self.end))
+            assert 'Cache-Control' not in request_mock.call_args[1]['headers']
+
+    def test_calendar_query_without_expand(self, caldav_server):
+        caldav_server.supports_expand = False
+        f = CalDAVCalendarEventFetcher()
+        cc = CalendarConfig(name='test', url=caldav_server.url, caldav=True)
+
+        assert len(list(f.fetch(cc, self.start, self.end))) == 1
+        assert not f.expand_supported and f.query_supported
+
+        # the second fetch doesn't try to expand again
+        assert len(list(f.fetch(cc, self.start, self.end))) == 1
+        assert len(caldav_server.requests) == 3
+        assert 'expand' not in caldav_server.requests[-1][1]
+
+    def test_sync_collection_fallback(self, caldav_server):
+        caldav_server.supports_query = False
+        f = CalDAVCalendarEventFetcher()
+        cc = CalendarConfig(name='test', url=caldav_server.url, caldav=True)
+
+        events = list(f.fetch(cc, self.start, self.end))
+        assert not f.query_supported
+        assert sorted(str(e['SUMMARY']) for e in events) == ['First', 'Second']
+        assert f.sync_token == 'token-1'
+
+        # incremental sync: the deleted object is removed, the new one fetched with a multiget
+        del caldav_server.requests[:]
+        events = list(f.fetch(cc, self.start, self.end))
+        assert sorted(str(e['SUMMARY']) for e in events) == ['Second', 'Third']
+        assert f.sync_token == 'token-2'
+        assert [body.split('\n')[1].split()[0] for _, body in caldav_server.requests] == [
+            '<D:sync-collection', '<C:calendar-multiget'
+        ]
+
+    def test_invalid_sync_token(self, caldav_server):
+        f = CalDAVCalendarEventFetcher()
+        f.query_supported = False
+        f.sync_token = 'unknown-token'
+        f.objects = {'/cal/old.ics': ('', ['stale'])}
+
+        events = list(f.fetch(CalendarConfig(name='test', url=caldav_server.url, caldav=True), self.start, self.end))
+        assert sorted(str(e['SUMMARY']) for e in events) == ['First', 'Second']
+        assert f.sync_token == 'token-1'
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+import os
+
+from maxd.config import Configuration, CalendarConfig
+from maxd.httpcache import BoundedCache
+from maxd.worker import Worker
+
+
+class TestBoundedCache(object):
+
+    def test_lru_eviction(self):
+        cache = BoundedCache(10)
+        cache.set('a', b'aaaa')
+        cache.set('b', b'bbbb')
+        assert cache.get('a') == b'aaaa'
+        cache.set('c', b'cccc')
+
+        assert cache.get('b') is None
+        assert cache.get('a') == b'aaaa' and cache.get('c') == b'cccc'
+        stats = cache.stats()
+        assert stats['resident_bytes'] == 8 and stats['entries'] == 2
+        assert stats['evictions'] == 1
+        assert stats['hits'] == 3 and stats['misses'] == 1 and stats['hit_rate'] == 0.75
+
+    def test_replace_and_delete(self):
+        cache = BoundedCache(10)
+        cache.set('a', b'aaaa')
+        cache.set('a', b'aa')
+        assert cache.stats()['resident_bytes'] == 2
+        cache.delete('a')
+        assert cache.get('a') is None
+        assert cache.stats()['resident_bytes'] == 0
+
+    def test_too_large(self):
+        cache = BoundedCache(4)
+        cache.set('a', b'aaaaa')
+        assert cache.get('a') is None
+        assert cache.stats()['rejected'] == 1
+
+    def test_spill(self, tmpdir):
+        spill_dir = str(tmpdir.join('cache'))
+        cache = BoundedCache(8, spill_dir, 12)
+        cache.set('a', b'aaaa')
+        cache.set('b', b'bbbb')
+        cache.set('c', b'cccc')
+        assert cache.stats()['disk_entries'] == 1
+
+        # read back from disk and moved to memory again, evicting b
+        assert cache.get('a') == b'aaaa'
+        stats = cache.stats()
+        assert stats['disk_hits'] == 1
+        assert stats['resident_bytes'] == 8 and stats['disk_bytes'] == 4
+
+        # larger than the memory budget: straight to disk, the least recently used file is dropped
+        cache.set('d', b'dddddddddd')
+        assert cache.stats()['disk_bytes'] == 10
+        assert cache.get('b') is None
+        assert cache.get('d') == b'dddddddddd'
+
+        # files spilled before are found after a restart
+        assert BoundedCache(8, spill_dir, 12).get('d') == b'dddddddddd'
+        assert len(os.listdir(spill_dir)) == 1
+
+    def test_resize(self):
+        cache = BoundedCache(10)
+        cache.set('a', b'aaaa')
+        cache.set('b', b'bbbb')
+        cache.resize(5)
+        assert cache.get('a') is None and cache.get('b') == b'bbbb'
+
+
+class TestWorkerHTTPCache(object):
+
+    def test_shared(self):
+        w = Worker(Configuration('/dev/null'))
+        first = w.get_fetcher(CalendarConfig(name='a', url='http://example.com/a.ics'))
+        second = w.get_fetcher(CalendarConfig(name='b', url='http://example.com/b.ics', caldav=True))
+        assert w.http_cache.max_bytes == 32 * 1024 * 1024
+        assert first.session.get_adapter('http://example.com').cache is w.http_cache
+        assert second.session.get_adapter('http://example.com').cache is w.http_cache
+        assert w.status()['http_cache']['resident_bytes'] == 0
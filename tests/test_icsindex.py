@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+import datetime
+import os
+import shutil
+import sys
+
+import pytz
+
+from maxd import icsindex
+from maxd.config import CalendarConfig
+from maxd.fetcher import LocalCalendarEventFetcher
+from maxd.icsindex import CalendarFileIndex, event_span, open_mmap
+
+if sys.version_info.major == 2 or (sys.version_info.major == 3 and sys.version_info.minor <= 2):
+    from mock import patch
+else:
+    from unittest.mock import patch
+
+
+def _ts(*args):
+    return int((datetime.datetime(*args) - datetime.datetime(1970, 1, 1)).total_seconds())
+
+
+def _copy(tmpdir, name):
+    path = str(tmpdir.join(name))
+    shutil.copy(os.path.join('tests/fixtures/calendars', name), path)
+    return path
+
+
+def _window(start_day, end_day):
+    return datetime.datetime(2015, 12, start_day, tzinfo=pytz.UTC), datetime.datetime(2015, 12, end_day, tzinfo=pytz.UTC)
+
+
+class TestEventSpan(object):
+
+    def test_single(self):
+        assert event_span(b"BEGIN:VEVENT\r\nDTSTART:20151220T090000Z\r\nDTEND:20151220T100000Z\r\nEND:VEVENT") == \
+            (_ts(2015, 12, 20, 9), _ts(2015, 12, 20, 10))
+
+    def test_duration_and_alarm(self):
+        block = b"BEGIN:VEVENT\r\nDTSTART;TZID=Europe/Berlin:20151220T090000\r\nBEGIN:VALARM\r\nDURATION:P1W\r\n" \
+                b"END:VALARM\r\nDURATION:PT1H30M\r\nEND:VEVENT"
+        assert event_span(block) == (_ts(2015, 12, 20, 9), _ts(2015, 12, 20, 10, 30))
+
+    def test_all_day(self):
+        assert event_span(b"BEGIN:VEVENT\nDTSTART;VALUE=DATE:20151224\nEND:VEVENT") == \
+            (_ts(2015, 12, 24), _ts(2015, 12, 25))
+
+    def test_recurring(self):
+        block = b"BEGIN:VEVENT\r\nDTSTART:20151224T090000\r\nDTEND:20151224T100000\r\n" \
+                b"RRULE:FREQ=DAILY;\r\n UNTIL=20151231T080000Z\r\nEND:VEVENT"
+        assert event_span(block) == (_ts(2015, 12, 24, 9), _ts(2015, 12, 31, 9))
+        assert event_span(b"BEGIN:VEVENT\r\nDTSTART:20151224T090000\r\nRRULE:FREQ=WEEKLY\r\nEND:VEVENT") == \
+            (_ts(2015, 12, 24, 9), None)
+        assert event_span(b"BEGIN:VEVENT\r\nDTSTART:20151224T090000\r\nRDATE:20100101T090000\r\nEND:VEVENT") == \
+            (None, None)
+
+
+class TestCalendarFileIndex(object):
+
+    def _events(self, path, start=None, end=None):
+        f = LocalCalendarEventFetcher()
+        return [str(e['SUMMARY']) for e in f.fetch(CalendarConfig(name='test', url=path, index=True), start, end)]
+
+    def test_window(self, tmpdir):
+        path = _copy(tmpdir, 'single_event.ics')
+        assert self._events(path, *_window(19, 21)) == ['Test Event']
+        assert self._events(path, *_window(22, 28)) == []
+        assert self._events(path) == ['Test Event']
+        assert os.path.exists(path + '.idx')
+
+    def test_recurring(self, tmpdir):
+        path = _copy(tmpdir, 'repeating.ics')
+        assert sorted(self._events(path, *_window(28, 31))) == ['Ending repeating event', 'Weekly repeating event']
+
+        # the daily series ended before the window
+        assert self._events(path, datetime.datetime(2016, 1, 4, tzinfo=pytz.UTC),
+                            datetime.datetime(2016, 1, 10, tzinfo=pytz.UTC)) == ['Weekly repeating event']
+
+    def test_sidecar_reused(self, tmpdir):
+        path = _copy(tmpdir, 'repeating.ics')
+        self._events(path, *_window(28, 31))
+
+        with patch.object(icsindex, 'build_index', side_effect=icsindex.build_index) as build_mock:
+            self._events(path, *_window(28, 31))
+            assert not build_mock.called
+
+            with open(path, 'a') as f:
+                f.write("\n")
+            self._events(path, *_window(28, 31))
+            assert build_mock.call_count == 1
+
+    def test_in_memory(self, tmpdir):
+        path = _copy(tmpdir, 'single_event.ics')
+        index = CalendarFileIndex(path)
+        index.index_path = str(tmpdir.join('missing', 'index.idx'))
+
+        mm, stat = open_mmap(path)
+        try:
+            assert b'Test Event' in index.document(mm, stat, *_window(19, 21))
+            assert index.index is not None
+        finally:
+            mm.close()
+
+    def test_replaced_while_mapped(self, tmpdir):
+        path = _copy(tmpdir, 'single_event.ics')
+        index = CalendarFileIndex(path)
+        mm, stat = open_mmap(path)
+
+        # the sync job replaces the file after it was mapped
+        replacement = str(tmpdir.join('replacement.ics'))
+        with open(path, 'rb') as src:
+            data = src.read()
+        with open(replacement, 'wb') as f:
+            f.write(data.replace(b'Test Event', b'Other Event') + b'\r\n')
+        os.rename(replacement, path)
+
+        try:
+            assert b'Test Event' in index.document(mm, stat, *_window(19, 21))
+        finally:
+            mm.close()
+        # the index belongs to the mapped file, not to the replacement
+        assert index.stat == stat
+
+        mm, stat = open_mmap(path)
+        try:
+            assert b'Other Event' in index.document(mm, stat, *_window(19, 21))
+        finally:
+            mm.close()
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+import datetime
+import random
+
+import pytest
+import pytz
+
+from maxd.incremental import IncrementalSchedule, _union
+from maxd.worker import Schedule
+
+
+def _dt(hour, minute=0, day=28):
+    return datetime.datetime(2015, 12, day, hour, minute, tzinfo=pytz.UTC)
+
+
+class TestUnion(object):
+
+    def test_union(self):
+        assert _union([]) == []
+        assert _union([(1, 3), (2, 4), (4, 5), (7, 8)]) == [(1, 5), (7, 8)]
+        assert _union([(1, 10), (2, 3)]) == [(1, 10)]
+
+
+class TestIncrementalSchedule(object):
+
+    def test_add(self):
+        s = IncrementalSchedule()
+        assert s.add(0, (_dt(8), _dt(9)))
+        assert s.add(0, (_dt(12), _dt(13)))
+        # merged with both neighbours
+        assert s.add(0, (_dt(9), _dt(12)))
+        assert s.merged == {0: [(_dt(8), _dt(13))]}
+        assert s.take_dirty() == set([0])
+
+        # contained in an existing period
+        assert not s.add(0, (_dt(10), _dt(11)))
+        assert s.take_dirty() == set()
+
+    def test_remove(self):
+        s = IncrementalSchedule()
+        for period in ((_dt(8), _dt(10)), (_dt(9), _dt(11)), (_dt(14), _dt(15))):
+            s.add(0, period)
+        s.take_dirty()
+
+        assert s.remove(0, (_dt(9), _dt(11)))
+        assert s.merged[0] == [(_dt(8), _dt(10)), (_dt(14), _dt(15))]
+
+        # the same period twice counts twice
+        s.add(0, (_dt(14), _dt(15)))
+        assert not s.remove(0, (_dt(14), _dt(15)))
+        assert s.remove(0, (_dt(14), _dt(15)))
+        assert s.remove(0, (_dt(8), _dt(10)))
+        assert s.merged == {} and s.periods == {}
+        assert s.take_dirty() == set([0])
+
+        with pytest.raises(KeyError):
+            s.remove(0, (_dt(8), _dt(10)))
+
+    def test_split(self):
+        s = IncrementalSchedule()
+        for period in ((_dt(8), _dt(10)), (_dt(10), _dt(12)), (_dt(12), _dt(14))):
+            s.add(0, period)
+        assert s.merged[0] == [(_dt(8), _dt(14))]
+        assert s.remove(0, (_dt(10), _dt(12)))
+        assert s.merged[0] == [(_dt(8), _dt(10)), (_dt(12), _dt(14))]
+
+    def test_remove_block_start(self):
+        s = IncrementalSchedule()
+        for period in ((1, 2), (8, 10), (10, 14)):
+            s.add(0, period)
+        assert s.remove(0, (8, 10))
+        assert s.merged[0] == [(1, 2), (10, 14)]
+
+        s = IncrementalSchedule()
+        for period in ((8, 10), (10, 14)):
+            s.add(0, period)
+        assert s.remove(0, (8, 10))
+        assert s.merged[0] == [(10, 14)]
+
+    def test_single_changes(self):
+        rnd = random.Random(7)
+        s = IncrementalSchedule()
+        periods = []
+        for _ in range(500):
+            if periods and rnd.random() < 0.4:
+                period = periods.pop(rnd.randrange(len(periods)))
+                s.remove(0, period)
+            else:
+                start = rnd.randint(0, 40)
+                period = (start, start + rnd.randint(1, 6))
+                periods.append(period)
+                s.add(0, period)
+            assert s.merged.get(0, []) == _union(sorted(periods))
+
+    def test_update_single_change(self):
+        events = dict((wd, [(_dt(8, day=21 + wd), _dt(9, day=21 + wd))]) for wd in range(7))
+        s = IncrementalSchedule()
+        assert s.update(events) == set(range(7))
+        s.take_dirty()
+
+        # moving one event marks exactly its day dirty
+        events[2] = [(_dt(10, day=23), _dt(11, day=23))]
+        assert s.update(events) == set([2])
+        assert s.take_dirty() == set([2])
+        assert s.update(events) == set()
+
+    def test_same_as_effective(self):
+        events = {0: [(_dt(8), _dt(10)), (_dt(9), _dt(11)), (_dt(13), _dt(14)), (_dt(13, 15), _dt(13, 45))],
+                  1: [(_dt(8, day=29), _dt(9, day=29))]}
+        s = IncrementalSchedule()
+        s.update(events)
+        effective = s.effective()
+        assert effective.merged
+        assert effective == Schedule(dict((wd, list(p)) for wd, p in events.items())).effective()
+        assert effective.effective() == effective
+
+    def test_random_updates(self):
+        rnd = random.Random(42)
+        s = IncrementalSchedule()
+        for _ in range(20):
+            events = {}
+            for wd in range(7):
+                for _ in range(rnd.randint(0, 6)):
+                    start = _dt(0, day=21 + wd) + datetime.timedelta(minutes=rnd.randint(0, 88) * 15)
+                    events.setdefault(wd, []).append((start, start + datetime.timedelta(minutes=rnd.randint(1, 16) * 15)))
+            s.update(events)
+
+            assert s.effective().events == dict((wd, _union(sorted(p))) for wd, p in events.items())
+            assert s.schedule().events == dict((wd, sorted(p)) for wd, p in events.items())
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+import datetime
+
+import icalendar
+import pytest
+import pytz
+
+from maxd.index import IntervalIndex, CalendarIndex, event_key
+from maxd.worker import Event
+
+
+def _t(day, h, m=0):
+    return datetime.datetime(2015, 12, day, h, m, tzinfo=pytz.UTC)
+
+
+def _vevent(uid, summary, start, end):
+    e = icalendar.Event()
+    e.add('UID', uid)
+    e.add('SUMMARY', summary)
+    e.add('DTSTART', start)
+    e.add('DTEND', end)
+    return e
+
+
+class TestIntervalIndex(object):
+
+    def test_query(self):
+        index = IntervalIndex()
+        index.add(Event(name='inside', start=_t(22, 9), end=_t(22, 10)))
+        index.add(Event(name='before', start=_t(20, 9), end=_t(20, 10)))
+        index.add(Event(name='overlapping start', start=_t(20, 20), end=_t(21, 2)))
+        index.add(Event(name='overlapping end', start=_t(27, 22), end=_t(28, 2)))
+        index.add(Event(name='after', start=_t(28, 9), end=_t(28, 10)))
+
+        assert [e.name for e in index.query(_t(21, 0), _t(27, 23, 59))] == ['overlapping start', 'inside', 'overlapping end']
+        assert index.query(_t(23, 0), _t(23, 23)) == []
+
+    def test_add_many(self):
+        events = [Event(name=str(i), start=_t(21, 0) + datetime.timedelta(hours=i), end=_t(21, 1) + datetime.timedelta(hours=i))
+                  for i in reversed(range(40))]
+        index = IntervalIndex()
+        index.add_many(events[:3])
+        index.add_many(events[3:])
+        assert len(index) == 40
+        assert index.starts == sorted(index.starts)
+        assert [e.name for e in index.query(_t(21, 5), _t(21, 6))] == ['5', '6']
+
+    def test_remove(self):
+        a = Event(name='a', start=_t(21, 9), end=_t(21, 10))
+        b = Event(name='b', start=_t(21, 9), end=_t(21, 11))
+        index = IntervalIndex()
+        index.add(a)
+        index.add(b)
+        index.remove(b)
+        assert index.items == [a]
+
+        with pytest.raises(ValueError):
+            index.remove(b)
+
+
+class TestCalendarIndex(object):
+
+    def test_only_changed_events_are_expanded(self):
+        expanded = []
+
+        def expand(cal_events, start, end):
+            expanded.extend(str(e['SUMMARY']) for e in cal_events)
+            return [[Event(name=str(e['SUMMARY']), start=e['DTSTART'].dt, end=e['DTEND'].dt)] for e in cal_events]
+
+        a = _vevent('a', 'A', _t(21, 9), _t(21, 10))
+        b = _vevent('b', 'B', _t(22, 9), _t(22, 10))
+
+        index = CalendarIndex()
+        index.update([a, b], _t(21, 0), _t(27, 23), expand)
+        assert expanded == ['A', 'B']
+
+        # unchanged: nothing to do
+        index.update([_vevent('a', 'A', _t(21, 9), _t(21, 10)), b], _t(21, 0), _t(27, 23), expand)
+        assert expanded == ['A', 'B']
+
+        # B moved, A removed
+        index.update([_vevent('b', 'B', _t(23, 9), _t(23, 10))], _t(21, 0), _t(27, 23), expand)
+        assert expanded == ['A', 'B', 'B']
+        assert [(e.name, e.start) for e in index.query(_t(21, 0), _t(27, 23))] == [('B', _t(23, 9))]
+
+    def test_rebuild_when_window_moves(self):
+        expanded = []
+
+        def expand(cal_events, start, end):
+            expanded.append((start, end))
+            return [[] for _ in cal_events]
+
+        a = _vevent('a', 'A', _t(21, 9), _t(21, 10))
+        index = CalendarIndex()
+        index.update([a], _t(21, 0), _t(27, 23), expand)
+        index.update([a], _t(22, 0), _t(28, 23), expand)
+        assert len(expanded) == 1, "window within the expanded horizon"
+
+        index.update([a], _t(29, 0), datetime.datetime(2016, 1, 4, 23, tzinfo=pytz.UTC), expand)
+        assert len(expanded) == 2
+
+    def test_event_key(self):
+        a = _vevent('a', 'A', _t(21, 9), _t(21, 10))
+        assert event_key(a) == event_key(_vevent('a', 'A', _t(21, 9), _t(21, 10)))
+        assert event_key(a) != event_key(_vevent('a', 'A', _t(21, 9), _t(21, 11)))
+        assert event_key(a) != event_key(_vevent('a', 'Renamed', _t(21, 9), _t(21, 10)))
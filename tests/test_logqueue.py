@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+
+import pytest
+from icalendar import Event as VEvent
+
+from maxd.budget import ExpansionBudget
+from maxd.config import Configuration
+from maxd.logqueue import DroppingQueueHandler, RateLimiter, start_queue_logging
+from maxd.worker import Worker
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class BlockingHandler(logging.Handler):
+    """A handler which doesn't return before it is released, like a syslog socket which backed up"""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.unblock = threading.Event()
+        self.messages = []
+
+    def emit(self, record):
+        self.unblock.wait(5)
+        self.messages.append(record.getMessage())
+
+
+@pytest.fixture
+def root_logger():
+    root = logging.getLogger()
+    handlers, level = list(root.handlers), root.level
+    yield root
+    root.handlers = handlers
+    root.setLevel(level)
+
+
+@pytest.mark.skipif(DroppingQueueHandler is None, reason="no QueueHandler")
+class TestQueueLogging(object):
+
+    def test_drops_when_full(self):
+        handler = DroppingQueueHandler(queue.Queue(2))
+        for i in range(5):
+            handler.handle(logging.makeLogRecord({'msg': 'message %s', 'args': (i, )}))
+        assert handler.queue.qsize() == 2
+        assert handler.dropped == 3
+
+    def test_blocked_handler(self, root_logger):
+        handler = BlockingHandler()
+        listener = start_queue_logging([handler], logging.INFO, queue_size=10)
+        try:
+            test_logger = logging.getLogger('maxd.test')
+            for i in range(20):
+                test_logger.info("message %s", i)
+            test_logger.debug("not logged")
+        finally:
+            handler.unblock.set()
+            listener.stop()
+
+        assert handler.messages[0] == 'message 0'
+        assert 'not logged' not in handler.messages
+        assert len(handler.messages) < 20
+
+
+class TestRateLimiter(object):
+
+    def test_burst(self):
+        now = [0]
+        limiter = RateLimiter(2, 60, lambda: now[0])
+        assert [limiter.allow('a') for _ in range(5)] == [0, 0, None, None, None]
+        assert limiter.allow('b') == 0
+
+        now[0] = 60
+        assert limiter.allow('a') == 3
+        assert limiter.allow('a') == 0
+
+
+class TestWorkerFailureLog(object):
+
+    def test_expand_failures(self, caplog):
+        w = Worker(Configuration('/dev/null'))
+        start, end = w.get_window()
+        broken = VEvent()
+        broken.add('UID', 'broken')
+        broken.add('SUMMARY', 'Broken')
+
+        with caplog.at_level(logging.ERROR, logger='maxd.worker'):
+            for _ in range(10):
+                assert list(w.expand_event(broken, start, end, ExpansionBudget('cal1'))) == []
+            # the failures of another calendar are still logged
+            assert list(w.expand_event(broken, start, end, ExpansionBudget('cal2'))) == []
+        assert [r.getMessage() for r in caplog.records] == \
+            ["Failed to expand event broken (Broken) of calendar cal1"] * 5 + \
+            ["Failed to expand event broken (Broken) of calendar cal2"]
+
+    def test_tick_messages_lazy(self, caplog):
+        w = Worker(Configuration('tests/fixtures/config/record.cfg'))
+        with caplog.at_level(logging.DEBUG, logger='maxd'):
+            w.compute()
+
+        # the messages of every tick are only formatted by the handlers which emit them
+        records = [r for r in caplog.records if 'testcal1' in r.getMessage()]
+        assert records
+        assert all('testcal1' not in r.msg for r in records)
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+import datetime
+import sys
+
+import pytz
+
+from maxd.clock import VirtualClock
+from maxd.config import Configuration, CalendarConfig
+from maxd.pipeline import Pipeline, FunctionStage, DictCache, RefreshCache, Context
+from maxd.worker import Worker
+
+if sys.version_info.major == 2 or (sys.version_info.major == 3 and sys.version_info.minor <= 2):
+    from mock import patch
+else:
+    from unittest.mock import patch
+
+
+def _context():
+    return Context(CalendarConfig(name='test', url='tests/fixtures/calendars/repeating.ics'),
+                   datetime.datetime(2015, 12, 28, tzinfo=pytz.UTC), datetime.datetime(2016, 1, 1, tzinfo=pytz.UTC),
+                   None)
+
+
+class KeyedStage(FunctionStage):
+
+    def cache_key(self, context):
+        return context.calendar_config.name
+
+
+class TestPipeline(object):
+
+    def _pipeline(self, calls):
+        def source(items, context):
+            for i in range(5):
+                calls.append(i)
+                yield i
+
+        return Pipeline([
+            FunctionStage('source', source),
+            FunctionStage('double', lambda items, context: (i * 2 for i in items)),
+            FunctionStage('odd', lambda items, context: (i for i in items if i % 4)),
+        ])
+
+    def test_lazy(self):
+        calls = []
+        output = self._pipeline(calls).run(_context())
+        assert calls == []
+        assert next(output) == 2
+        assert calls == [0, 1]
+        assert list(output) == [6]
+
+    def test_stats(self):
+        pipeline = self._pipeline([])
+        list(pipeline.run(_context()))
+        assert list(pipeline.stats.keys()) == ['source', 'double', 'odd']
+        assert [s.items for s in pipeline.stats.values()] == [5, 5, 2]
+        assert sorted(pipeline.timings().keys()) == ['double', 'odd', 'source']
+
+    def test_add_and_replace(self):
+        pipeline = self._pipeline([])
+        pipeline.add(FunctionStage('first', lambda items, context: [3]), before='double')
+        pipeline.replace('source', FunctionStage('source', lambda items, context: []))
+        assert [s.name for s, _ in pipeline.stages] == ['source', 'first', 'double', 'odd']
+        assert list(pipeline.run(_context())) == [6]
+        assert 'first' in pipeline and 'missing' not in pipeline
+
+    def test_cache_skips_previous_stages(self):
+        calls = []
+        cache = DictCache()
+        pipeline = self._pipeline(calls)
+        pipeline.add(KeyedStage('keyed', lambda items, context: items), cache=cache, before='odd')
+
+        assert list(pipeline.run(_context())) == [2, 6]
+        assert cache.items == {'test': [0, 2, 4, 6, 8]}
+        assert len(calls) == 5
+
+        assert list(pipeline.run(_context())) == [2, 6]
+        assert len(calls) == 5
+        assert pipeline.stats['keyed'].cached
+        assert pipeline.stats['source'].items == 0
+
+
+class TestRefreshCache(object):
+
+    def test_expires(self):
+        clock = VirtualClock(datetime.datetime(2015, 12, 21, 9))
+        cache = RefreshCache(lambda key: {'a': 60, 'b': None}[key], clock.time)
+
+        cache.set('a', [1])
+        cache.set('b', [2])
+        assert cache.get('a') == [1]
+        assert cache.get('b') is None
+
+        clock.advance(59)
+        assert cache.get('a') == [1]
+        clock.advance(1)
+        assert cache.get('a') is None
+
+    def test_discard(self):
+        cache = RefreshCache(lambda key: 60)
+        cache.set('a', [1])
+        cache.discard('a')
+        assert cache.get('a') is None
+
+
+class TestWorkerPipeline(object):
+
+    def test_stages(self):
+        w = Worker(Configuration('/dev/null'))
+        cc = CalendarConfig(name='test', url='tests/fixtures/calendars/repeating.ics')
+        assert [s.name for s, _ in w.build_pipeline(cc).stages] == ['fetch', 'expand']
+        assert [s.name for s, _ in w.build_pipeline(cc._replace(filter='name == "x"')).stages] == ['fetch', 'expand', 'filter']
+
+    def test_fetch_events(self):
+        w = Worker(Configuration('/dev/null'))
+        context = _context()
+        events = w.fetch_events(context.calendar_config, context.start, context.end)
+        assert len(events) == 5
+        stats = w.pipelines['test'].stats
+        assert stats['fetch'].items == 2
+        assert stats['expand'].items == 5
+
+    def test_plug_in_cache(self):
+        w = Worker(Configuration('/dev/null'))
+        context = _context()
+        cache = w.caches['fetch'] = DictCache()
+
+        w.fetch_events(context.calendar_config, context.start, context.end)
+        assert list(cache.items) == [(context.calendar_config, context.start, context.end)]
+
+        with patch.object(w, 'get_fetcher') as fetcher_mock:
+            assert len(w.fetch_events(context.calendar_config, context.start, context.end)) == 5
+            assert not fetcher_mock.called
+        assert w.pipelines['test'].stats['fetch'].cached
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import os
+import pstats
+import tempfile
+
+from maxd.profiling import TickProfiler, MemorySnapshots
+
+
+def _work(n):
+    return sum(i * i for i in range(n))
+
+
+class TestTickProfiler(object):
+
+    def test_inactive(self):
+        profiler = TickProfiler(tempfile.mkdtemp())
+        assert profiler.run(_work, 10) == 285
+        assert profiler.profile is None
+        assert profiler.files == []
+
+    def test_profile_ticks(self):
+        directory = tempfile.mkdtemp()
+        profiler = TickProfiler(directory)
+        profiler.request(2)
+
+        profiler.run(_work, 1000)
+        assert profiler.files == [], "written after the last profiled tick"
+        profiler.run(_work, 1000)
+        assert len(profiler.files) == 1
+        assert os.listdir(directory) == [os.path.basename(profiler.files[0])]
+
+        stats = pstats.Stats(profiler.files[0])
+        assert any(func[2] == '_work' and stat[0] == 2 for func, stat in stats.stats.items())
+
+        profiler.run(_work, 1000)
+        assert len(profiler.files) == 1
+
+    def test_exception(self):
+        profiler = TickProfiler(tempfile.mkdtemp())
+        profiler.request(1)
+        try:
+            profiler.run(_work, None)
+        except TypeError:
+            pass
+        assert len(profiler.files) == 1
+
+
+class TestMemorySnapshots(object):
+
+    def test_snapshot_diff(self):
+        snapshots = MemorySnapshots(tempfile.mkdtemp(), limit=5)
+        try:
+            assert snapshots.snapshot() is None
+            data = [list(range(100)) for _ in range(100)]
+            path = snapshots.snapshot()
+            with open(path, 'r') as f:
+                lines = f.read().splitlines()
+            assert 2 <= len(lines) <= 6
+            assert 'test_profiling.py' in lines[1]
+        finally:
+            snapshots.stop()
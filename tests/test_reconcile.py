@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+import datetime
+import sys
+
+import pytz
+from pymax.cube import Room
+from pymax.objects import Device, ProgramSchedule
+from pymax.util import py_day_to_cube_day
+
+from maxd.clock import VirtualClock
+from maxd.config import Configuration
+from maxd.reconcile import Reconciler, normalize
+from maxd.simulation import SimulatedWorker, StubCube
+
+if sys.version_info.major == 2 or (sys.version_info.major == 3 and sys.version_info.minor <= 2):
+    from mock import Mock
+else:
+    from unittest.mock import Mock
+
+
+def _stored(*slots):
+    # the way the cube reports a day: consecutive slots, the last one ending at midnight
+    start = 0
+    programs = []
+    for temperature, end in slots:
+        programs.append(ProgramSchedule(temperature, start, end))
+        start = end
+    return programs
+
+
+class ThermostatCube(StubCube):
+    """A cube with one thermostat per room which stores the programs it receives, except for the `lost` ones"""
+
+    def __init__(self):
+        super(ThermostatCube, self).__init__([
+            Room(1, 'Office', 'aa0001', [Device(rf_address='aa0101')]),
+            Room(2, 'Hall', 'aa0002', [Device(rf_address='aa0102')]),
+        ])
+        self.lost = set()
+        self.stored = dict(('aa010%s' % i, [_stored((10.0, 1440)) for _ in range(7)]) for i in (1, 2))
+
+    def set_program(self, room, rf_addr, weekday, programs):
+        super(ThermostatCube, self).set_program(room, rf_addr, weekday, programs)
+        if (room, weekday) in self.lost:
+            self.lost.discard((room, weekday))
+            return
+        self.stored['aa010%s' % room][py_day_to_cube_day(weekday)] = list(programs)
+
+    @property
+    def devices(self):
+        return [Device(rf_address=rf_addr, configuration=Mock(week_program=week_program))
+                for rf_addr, week_program in self.stored.items()]
+
+
+class TestNormalize(object):
+
+    def test_equal_programs(self):
+        written = [ProgramSchedule(10, 0, 0), ProgramSchedule(21, 0, 482), ProgramSchedule(10, 482, 1020),
+                   ProgramSchedule(10, 1020, 1440)]
+        assert normalize(written) == [(21.0, 480), (10.0, 1440)]
+        assert normalize(_stored((21.0, 480), (10.0, 1440))) == normalize(written)
+
+    def test_different_programs(self):
+        assert normalize(_stored((21.0, 480), (10.0, 1440))) != normalize(_stored((10.0, 1440)))
+        assert normalize(_stored((21.5, 480), (10.0, 1440))) != normalize(_stored((21.0, 480), (10.0, 1440)))
+
+
+class TestReconciler(object):
+
+    def _expect(self, reconciler, cube, programs):
+        for room in cube.rooms:
+            for weekday in range(7):
+                cube.set_program(room.room_id, room.rf_address, weekday, programs)
+                reconciler.expect(room, weekday, programs)
+
+    def test_matching(self):
+        cube = ThermostatCube()
+        reconciler = Reconciler(lambda: 0)
+        self._expect(reconciler, cube, _stored((21.0, 480), (10.0, 1440)))
+        cube.writes = 0
+
+        assert reconciler.run(cube, 7) == []
+        assert cube.writes == 0
+        assert reconciler.stats == {'checked': 14, 'mismatched': 0, 'resent': 0}
+
+    def test_resends_mismatches(self):
+        cube = ThermostatCube()
+        cube.lost = set([(1, 0), (1, 3), (2, 6)])
+        reconciler = Reconciler(lambda: 0)
+        self._expect(reconciler, cube, _stored((21.0, 480), (10.0, 1440)))
+        cube.writes = 0
+
+        assert reconciler.run(cube, 7) == [(1, 'aa0001', 0), (1, 'aa0001', 3), (2, 'aa0002', 6)]
+        assert cube.writes == 3
+        assert reconciler.run(cube, 7) == []
+
+    def test_spread_over_passes(self):
+        cube = ThermostatCube()
+        cube.lost = set([(1, 0), (1, 3), (2, 6)])
+        now = [0]
+        reconciler = Reconciler(lambda: now[0])
+        self._expect(reconciler, cube, _stored((21.0, 480), (10.0, 1440)))
+
+        # nothing is checked before the written programs had time to settle
+        assert reconciler.run(cube, 2, settle=600) == []
+        assert reconciler.stats['checked'] == 0
+
+        now[0] = 600
+        assert not reconciler.due(3600)
+        assert reconciler.run(cube, 2, settle=600) == [(1, 'aa0001', 0), (1, 'aa0001', 3)]
+        now[0] = 4200
+        assert reconciler.due(3600)
+        assert reconciler.run(cube, 2, settle=600) == [(2, 'aa0002', 6)]
+
+    def test_unknown_devices(self):
+        cube = StubCube([Room(1, 'Office', 'aa0001', [Device(rf_address='aa0101')])])
+        reconciler = Reconciler(lambda: 0)
+        reconciler.expect(cube.rooms[0], 0, _stored((10.0, 1440)))
+        assert reconciler.run(cube, 7) == []
+        assert reconciler.stats['checked'] == 0
+
+
+class TestWorkerReconcile(object):
+
+    def test_execute(self):
+        clock = VirtualClock(datetime.datetime(2015, 12, 28, 9, tzinfo=pytz.UTC))
+        cube = ThermostatCube()
+        cube.lost = set([(1, 2)])
+        w = SimulatedWorker(Configuration('tests/fixtures/config/simulation.cfg'), clock, cube)
+
+        w.execute()
+        assert cube.writes == 14
+        assert w.reconciler.status()['mismatched'] == 0
+
+        clock.advance(3600)
+        w.execute()
+        assert cube.writes == 15
+        assert w.reconciler.status() == {'checked': 14, 'mismatched': 1, 'resent': 1, 'last_pass': clock.time()}
+        assert 'reconcile' in w.timings
+
+    def test_disabled(self):
+        clock = VirtualClock(datetime.datetime(2015, 12, 28, 9, tzinfo=pytz.UTC))
+        cube = ThermostatCube()
+        cube.lost = set([(1, 2)])
+        config = Configuration('tests/fixtures/config/simulation.cfg')
+        config.cfg_parser.set('GENERAL', 'reconcile_interval', '0')
+        w = SimulatedWorker(config, clock, cube)
+
+        w.execute()
+        clock.advance(3600)
+        w.execute()
+        assert cube.writes == 14
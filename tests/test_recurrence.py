@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+import datetime
+
+import pytest
+from dateutil import rrule
+
+from maxd import recurrence
+from maxd.recurrence import parse_rule, expand
+
+RULES = [
+    'FREQ=DAILY',
+    'FREQ=DAILY;INTERVAL=3',
+    'FREQ=DAILY;COUNT=10',
+    'FREQ=DAILY;UNTIL=20151231T080000',
+    'FREQ=DAILY;INTERVAL=2;UNTIL=20160110',
+    'FREQ=WEEKLY',
+    'FREQ=WEEKLY;INTERVAL=2',
+    'FREQ=WEEKLY;BYDAY=MO,WE,FR',
+    'FREQ=WEEKLY;BYDAY=SU,MO;INTERVAL=3',
+    'FREQ=WEEKLY;BYDAY=MO,TU,WE,TH,FR;COUNT=12',
+    'FREQ=WEEKLY;INTERVAL=2;BYDAY=TU,SA;COUNT=7',
+    'FREQ=WEEKLY;BYDAY=TH;UNTIL=20160121T093000Z',
+    'FREQ=WEEKLY;INTERVAL=2;WKST=SU',
+]
+
+STARTS = [
+    datetime.datetime(2015, 12, 9, 9, 30),  # Wednesday
+    datetime.datetime(2015, 12, 21, 0, 0),  # Monday
+    datetime.datetime(2015, 12, 27, 23, 15),  # Sunday
+]
+
+WINDOWS = [
+    (datetime.datetime(2015, 12, 21), datetime.datetime(2015, 12, 27, 23, 59, 59)),
+    (datetime.datetime(2015, 12, 28, 9, 30), datetime.datetime(2016, 1, 17, 9, 30)),
+    (datetime.datetime(2015, 11, 1), datetime.datetime(2015, 11, 30)),
+]
+
+
+def _series():
+    for rule_str in RULES:
+        for dtstart in STARTS:
+            for after, before in WINDOWS:
+                yield rule_str, dtstart, after, before
+
+
+class TestParseRule(object):
+
+    def test_simple_rules(self):
+        assert parse_rule('FREQ=DAILY') == recurrence.SimpleRule('DAILY', 1, None, None, None)
+        assert parse_rule('FREQ=WEEKLY;BYDAY=FR,MO;INTERVAL=2') == recurrence.SimpleRule('WEEKLY', 2, (0, 4), None, None)
+        assert parse_rule('FREQ=WEEKLY;UNTIL=20151231T080000Z').until == datetime.datetime(2015, 12, 31, 8)
+        assert parse_rule('FREQ=DAILY;COUNT=3').count == 3
+
+    @pytest.mark.parametrize('rule_str', [
+        'FREQ=YEARLY;BYDAY=-1SU;BYMONTH=3',
+        'FREQ=MONTHLY;BYMONTHDAY=1',
+        'FREQ=WEEKLY;BYDAY=1MO',
+        'FREQ=DAILY;BYDAY=MO',
+        'FREQ=DAILY;BYHOUR=9,17',
+        'FREQ=WEEKLY;BYDAY=MO,TU;INTERVAL=2;WKST=SU',
+        'FREQ=DAILY;INTERVAL=0',
+        'FREQ=DAILY;COUNT=x',
+    ])
+    def test_other_rules(self, rule_str):
+        assert parse_rule(rule_str) is None
+
+    def test_week_start(self):
+        sunday = datetime.datetime(2015, 4, 12, 9, 0)
+        # the week start decides which weeks are skipped if the day differs from the one of DTSTART
+        assert parse_rule('FREQ=WEEKLY;INTERVAL=2;BYDAY=TU;WKST=SA', sunday) is None
+        assert parse_rule('FREQ=WEEKLY;INTERVAL=2;BYDAY=TU;WKST=SA') is None
+        assert parse_rule('FREQ=WEEKLY;INTERVAL=2;BYDAY=TU;WKST=SA', sunday + datetime.timedelta(days=2)) is not None
+        assert parse_rule('FREQ=WEEKLY;INTERVAL=2;BYDAY=SU;WKST=SA', sunday) is not None
+        assert parse_rule('FREQ=WEEKLY;BYDAY=TU;WKST=SA', sunday) is not None
+
+        rule_str = 'FREQ=WEEKLY;INTERVAL=2;BYDAY=TU;WKST=SA'
+        after, before = datetime.datetime(2015, 7, 1), datetime.datetime(2015, 7, 31)
+        # counting the weeks from Monday gives other weeks than dateutil
+        assert expand([(sunday, recurrence.SimpleRule('WEEKLY', 2, (1, ), None, None), after, before)])[0] != \
+            rrule.rrulestr(rule_str, dtstart=sunday).between(after, before, inc=True)
+        for dtstart in (sunday, sunday + datetime.timedelta(days=2)):
+            rule = parse_rule(rule_str, dtstart)
+            if rule is not None:
+                assert expand([(dtstart, rule, after, before)])[0] == \
+                    rrule.rrulestr(rule_str, dtstart=dtstart).between(after, before, inc=True)
+
+
+class TestExpand(object):
+
+    @pytest.mark.parametrize('threshold', [1000000, 0])
+    def test_same_as_dateutil(self, monkeypatch, threshold):
+        if threshold == 0 and recurrence._import_numpy() is None:
+            pytest.skip("NumPy not installed")
+        monkeypatch.setattr(recurrence, 'numpy_threshold', threshold)
+
+        series = list(_series())
+        result = expand([(dtstart, parse_rule(rule_str, dtstart), after, before) for rule_str, dtstart, after, before in series])
+
+        for (rule_str, dtstart, after, before), occurrences in zip(series, result):
+            expected = rrule.rrulestr(rule_str.rstrip('Z'), dtstart=dtstart).between(after, before, inc=True)
+            assert occurrences == expected, "%s from %s between %s and %s" % (rule_str, dtstart, after, before)
+
+    def test_empty(self):
+        assert expand([]) == []
+        assert expand([(STARTS[0], parse_rule('FREQ=DAILY;COUNT=1'), WINDOWS[0][0], WINDOWS[0][1])]) == [[]]
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+import datetime
+import json
+import os
+import tempfile
+
+import pytest
+import pytz
+
+from maxd.config import Configuration
+from maxd.replay import ReplayCube, TickRecorder, replay, replay_tick
+from maxd.worker import Worker
+
+
+def _record(directory):
+    cfg = Configuration('tests/fixtures/config/record.cfg')
+    cfg.cfg_parser.set('GENERAL', 'record', directory)
+
+    w = Worker(cfg)
+    w.now = lambda: datetime.datetime(2015, 12, 28, 12, 0, tzinfo=pytz.UTC)
+    cube = ReplayCube([[1, 'Living room', 12345]])
+    w.connect_to_cube = lambda: cube
+    w.execute()
+    w.execute()  # schedule unchanged: no cube connection
+    return cube, sorted(os.listdir(directory))
+
+
+class TestRecorder(object):
+
+    def test_record(self):
+        directory = tempfile.mkdtemp()
+        cube, files = _record(directory)
+
+        # both ticks were recorded at the same (fake) time, into files of their own
+        assert files == ['tick-20151228T120000000000-000001.json', 'tick-20151228T120000000000-000002.json']
+        with open(os.path.join(directory, files[1])) as f:
+            tick = json.load(f)
+
+        assert tick['now'] == '2015-12-28T12:00:00+00:00'
+        assert 'secret' not in tick['config']
+        assert 'record' not in tick['config']
+        assert len(tick['calendars']['testcal1']) == 1
+        assert 'broken' not in tick['calendars']
+        assert tick['rooms'] == [[1, 'Living room', 12345]]
+        assert tick['programs'] is None
+        assert tick['effective_schedule']['Monday'] == [['2015-12-28T07:30:00+00:00', '2015-12-28T09:00:00+00:00']]
+
+    def test_record_programs(self):
+        directory = tempfile.mkdtemp()
+        recorder = TickRecorder(directory, Configuration('tests/fixtures/config/record.cfg'))
+        record = recorder.start(datetime.datetime(2015, 12, 28, 12, 0, tzinfo=pytz.UTC))
+        cube = record.wrap_cube(ReplayCube([[1, 'Living room', 12345]]))
+        assert [r.room_id for r in cube.rooms] == [1]
+        cube.set_program(1, 12345, 0, [])
+        record.finish({}, {})
+
+        with open(os.path.join(directory, os.listdir(directory)[0])) as f:
+            tick = json.load(f)
+        assert tick['programs'] == [[1, 12345, 0, []]]
+
+    def test_record_overlapping_ticks(self):
+        directory = tempfile.mkdtemp()
+        cfg = Configuration('tests/fixtures/config/record.cfg')
+        cfg.cfg_parser.set('GENERAL', 'record', directory)
+        w = Worker(cfg)
+        cube = ReplayCube([[1, 'Living room', 12345]])
+        w.connect_to_cube = lambda: cube
+
+        # the next tick is computed while the previous one wasn't written yet
+        w.now = lambda: datetime.datetime(2015, 12, 28, 12, 0, tzinfo=pytz.UTC)
+        first = w.compute()
+        w.now = lambda: datetime.datetime(2015, 12, 28, 12, 1, tzinfo=pytz.UTC)
+        second = w.compute()
+        w.write(first)
+        w.write(second)
+
+        ticks = []
+        for name in sorted(os.listdir(directory)):
+            with open(os.path.join(directory, name)) as f:
+                ticks.append(json.load(f))
+        assert [t['now'] for t in ticks] == ['2015-12-28T12:00:00+00:00', '2015-12-28T12:01:00+00:00']
+        assert all(len(t['calendars']['testcal1']) == 1 for t in ticks)
+        assert ticks[0]['programs'] == cube.programs
+        assert ticks[1]['programs'] is None
+
+    def test_record_keep(self):
+        directory = tempfile.mkdtemp()
+        config = Configuration('tests/fixtures/config/record.cfg')
+        config.cfg_parser.set('GENERAL', 'record_keep', '3')
+        recorder = TickRecorder(directory, config)
+        for minute in range(5):
+            recorder.start(datetime.datetime(2015, 12, 28, 12, minute, tzinfo=pytz.UTC)).finish({}, {})
+        assert sorted(os.listdir(directory)) == ['tick-20151228T120200000000-000003.json',
+                                                 'tick-20151228T120300000000-000004.json',
+                                                 'tick-20151228T120400000000-000005.json']
+
+        # the files of a previous run count as well
+        recorder = TickRecorder(directory, config)
+        recorder.start(datetime.datetime(2015, 12, 28, 12, 5, tzinfo=pytz.UTC)).finish({}, {})
+        assert len(os.listdir(directory)) == 3
+        assert 'tick-20151228T120200000000-000003.json' not in os.listdir(directory)
+
+
+class TestReplay(object):
+
+    def _recorded_tick(self):
+        directory = tempfile.mkdtemp()
+        cube, files = _record(directory)
+        # only keep the first tick, which wrote the program
+        os.unlink(os.path.join(directory, files[1]))
+        path = os.path.join(directory, files[0])
+        with open(path) as f:
+            tick = json.load(f)
+        assert tick['programs'] == cube.programs
+        return directory, path, tick
+
+    def test_replay_identical(self):
+        directory, path, tick = self._recorded_tick()
+
+        results = list(replay(directory))
+        assert len(results) == 1
+        assert results[0]['diffs'] == []
+        assert set(['fetch', 'schedule', 'apply', 'total']) <= set(results[0]['timings'].keys())
+        assert results[0]['recorded_timings'] == tick['timings']
+
+    def test_replay_different(self):
+        directory, path, tick = self._recorded_tick()
+        tick['effective_schedule']['Monday'] = []
+        tick['programs'][0][3][0][0] = 30
+        with open(path, 'w') as f:
+            json.dump(tick, f)
+
+        diffs = replay_tick(path)['diffs']
+        assert '--- recorded effective_schedule' in diffs
+        assert '--- recorded programs' in diffs
+
+    def test_replay_ticks(self):
+        directory = tempfile.mkdtemp()
+        cfg = Configuration('tests/fixtures/config/record.cfg')
+        cfg.cfg_parser.set('GENERAL', 'record', directory)
+        w = Worker(cfg)
+        cube = ReplayCube([[1, 'Living room', 12345]])
+        w.connect_to_cube = lambda: cube
+
+        def _resend(cube, max_writes, settle=0, deadline=None):
+            cube.set_program(1, 12345, 3, [])
+
+        w.now = lambda: datetime.datetime(2015, 12, 28, 12, 0, tzinfo=pytz.UTC)
+        w.execute()
+        # the window moved by a day: only the changed weekday is written, and the reconciliation re-sends a program
+        w.now = lambda: datetime.datetime(2015, 12, 29, 12, 0, tzinfo=pytz.UTC)
+        w.reconciler.run = _resend
+        w.reconciler.last_pass = None
+        w.execute()
+
+        ticks = []
+        for name in sorted(os.listdir(directory)):
+            with open(os.path.join(directory, name)) as f:
+                ticks.append(json.load(f))
+        assert len(ticks[0]['programs']) == 7
+        assert 0 < len(ticks[1]['programs']) < 7
+        assert ticks[1]['resent'] == [[1, 12345, 3, []]]
+        assert len(ticks[1]['written_programs']) == 7
+
+        assert [r['diffs'] for r in replay(directory)] == [[], []]
+
+    def test_unknown_version(self):
+        path = os.path.join(tempfile.mkdtemp(), 'tick.json')
+        with open(path, 'w') as f:
+            json.dump({'version': 99}, f)
+        with pytest.raises(ValueError):
+            replay_tick(path)
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from maxd.resilience import Deadline, DeadlineExceeded, CircuitBreaker, CircuitOpen, call_with_retries
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestDeadline(object):
+
+    def test_deadline(self):
+        clock = FakeClock()
+        deadline = Deadline(10, clock=clock)
+        assert deadline.remaining() == 10
+        assert deadline.timeout(30) == 10
+        assert deadline.timeout(5) == 5
+        assert deadline.timeout(None) == 10
+
+        clock.now += 10
+        assert deadline.expired()
+        with pytest.raises(DeadlineExceeded):
+            deadline.timeout(5)
+
+    def test_no_deadline(self):
+        deadline = Deadline(None)
+        assert deadline.remaining() is None
+        assert not deadline.expired()
+        assert deadline.timeout(5) == 5
+
+
+class TestCircuitBreaker(object):
+
+    def test_open_and_reset(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker('test', threshold=2, reset_timeout=60, clock=clock)
+        breaker.failure()
+        assert breaker.state == CircuitBreaker.CLOSED
+        breaker.failure()
+        assert breaker.state == CircuitBreaker.OPEN
+        with pytest.raises(CircuitOpen):
+            breaker.allow()
+
+        clock.now += 60
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        breaker.allow()
+
+        # failed trial call: open again
+        breaker.failure()
+        assert breaker.state == CircuitBreaker.OPEN
+
+        clock.now += 60
+        breaker.success()
+        assert breaker.state == CircuitBreaker.CLOSED
+        assert breaker.failures == 0
+
+
+class TestRetries(object):
+
+    def _failing(self, failures):
+        calls = []
+
+        def func():
+            calls.append(1)
+            if len(calls) <= failures:
+                raise IOError("failure %s" % len(calls))
+            return 'result'
+        return func, calls
+
+    def test_success_after_retries(self):
+        sleeps = []
+        func, calls = self._failing(2)
+        assert call_with_retries(func, retries=2, backoff=1, sleep=sleeps.append) == 'result'
+        assert sleeps == [1, 2]
+
+    def test_retries_exhausted(self):
+        func, calls = self._failing(5)
+        with pytest.raises(IOError):
+            call_with_retries(func, retries=2, backoff=1, sleep=lambda s: None)
+        assert len(calls) == 3
+
+    def test_retries_limited_by_deadline(self):
+        clock = FakeClock()
+        func, calls = self._failing(5)
+        with pytest.raises(IOError):
+            call_with_retries(func, retries=5, backoff=1, deadline=Deadline(3.5, clock=clock), sleep=lambda s: setattr(clock, 'now', clock.now + s))
+        # 1s + 2s of backoff fit into the deadline, 4s don't
+        assert len(calls) == 3
+
+    def test_breaker(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker('test', threshold=2, reset_timeout=60, clock=clock)
+        func, calls = self._failing(10)
+
+        # a call which fails after all its retries counts as one failure
+        with pytest.raises(IOError):
+            call_with_retries(func, retries=2, breaker=breaker, sleep=lambda s: None)
+        assert len(calls) == 3
+        assert breaker.state == CircuitBreaker.CLOSED
+
+        with pytest.raises(IOError):
+            call_with_retries(func, retries=2, breaker=breaker, sleep=lambda s: None)
+        assert len(calls) == 6
+        assert breaker.state == CircuitBreaker.OPEN
+
+        with pytest.raises(CircuitOpen):
+            call_with_retries(func, breaker=breaker)
+        assert len(calls) == 6
+
+        # the trial call of the half open breaker isn't retried
+        clock.now += 60
+        with pytest.raises(IOError):
+            call_with_retries(func, retries=2, breaker=breaker, sleep=lambda s: None)
+        assert len(calls) == 7
+        assert breaker.state == CircuitBreaker.OPEN
+
+    def test_deadline_exceeded_not_retried(self):
+        calls = []
+
+        def func():
+            calls.append(1)
+            raise DeadlineExceeded()
+
+        with pytest.raises(DeadlineExceeded):
+            call_with_retries(func, retries=3, sleep=lambda s: None)
+        assert len(calls) == 1
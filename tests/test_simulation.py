@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import datetime
+
+import pytz
+
+from maxd.clock import VirtualClock
+from maxd.config import Configuration
+from maxd.simulation import Simulation, StubCube, rss
+from maxd.replay import Room
+from maxd.worker import Worker
+
+
+class TestVirtualClock(object):
+
+    def test_advance(self):
+        clock = VirtualClock(datetime.datetime(2015, 12, 21, 9, 0))
+        assert clock.now() == datetime.datetime(2015, 12, 21, 9, 0, tzinfo=pytz.UTC)
+        t = clock.time()
+        clock.sleep(90)
+        assert clock.now() == datetime.datetime(2015, 12, 21, 9, 1, 30, tzinfo=pytz.UTC)
+        assert clock.time() == t + 90
+
+    def test_worker_uses_clock(self):
+        clock = VirtualClock(datetime.datetime(2015, 12, 21, 9, 0, tzinfo=pytz.UTC))
+        w = Worker(Configuration('/dev/null'), clock=clock)
+        assert w.get_window()[0] == datetime.datetime(2015, 12, 21, tzinfo=pytz.UTC)
+
+        # breakers measure their reset timeout in virtual time
+        breaker = w.get_breaker('test')
+        for _ in range(breaker.threshold):
+            breaker.failure()
+        assert breaker.state == breaker.OPEN
+        clock.advance(breaker.reset_timeout)
+        assert breaker.state == breaker.HALF_OPEN
+
+
+class TestSimulation(object):
+
+    def test_run(self):
+        simulation = Simulation(Configuration('tests/fixtures/config/simulation.cfg'),
+                                datetime.datetime(2015, 12, 28, tzinfo=pytz.UTC), interval=6 * 3600)
+        ticks = simulation.run(datetime.timedelta(days=2))
+        assert len(ticks) == 8
+        assert not any(t.failed for t in ticks)
+
+        # the first tick writes all days, later ticks only the days whose program changed when the window moved
+        assert ticks[0].writes == 7
+        assert [t.writes for t in ticks[1:4]] == [0, 0, 0]
+        assert ticks[4].writes == 1
+
+        summary = simulation.summary()
+        assert summary['ticks'] == 8
+        assert summary['cube_writes'] == sum(t.writes for t in ticks)
+        assert summary['max_writes_per_day'] == 7
+        assert summary['failed_ticks'] == 0
+
+    def test_dst_switch(self):
+        simulation = Simulation(Configuration('tests/fixtures/config/simulation.cfg'),
+                                datetime.datetime(2015, 10, 24, tzinfo=pytz.UTC), interval=12 * 3600,
+                                rooms=[Room(1, 'Living room', 1), Room(2, 'Kitchen', 2)])
+        simulation.run(datetime.timedelta(days=3))
+        assert simulation.summary()['failed_ticks'] == 0
+        assert sorted(set(room for room, _ in simulation.cube.programs)) == [1, 2]
+
+    def test_stub_cube(self):
+        cube = StubCube([])
+        with cube as c:
+            c.set_program(1, 1, 0, [])
+        assert cube.writes == 1
+
+    def test_rss(self):
+        assert rss() > 0
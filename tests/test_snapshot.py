@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import datetime
+import json
+import os
+import tempfile
+
+import pytz
+
+from maxd.snapshot import EventSnapshot
+from maxd.worker import Event
+
+
+def _t(day, h):
+    return datetime.datetime(2015, 12, day, h, 0, tzinfo=pytz.UTC)
+
+
+class TestEventSnapshot(object):
+
+    def test_missing_file(self):
+        snapshot = EventSnapshot('/file/does/not/exist')
+        assert not snapshot.load()
+        assert snapshot.calendars == {}
+
+    def test_roundtrip(self):
+        path = os.path.join(tempfile.mkdtemp(), 'events.json')
+        snapshot = EventSnapshot(path)
+        snapshot.update('cal1', [Event(name='Meeting', start=_t(21, 9), end=_t(21, 10))])
+        assert snapshot.dirty
+        snapshot.save()
+        assert not snapshot.dirty
+
+        with open(path) as f:
+            assert json.load(f) == {'version': 1, 'calendars': {'cal1': [['Meeting', 1450688400, 1450692000]]}}
+
+        loaded = EventSnapshot(path)
+        assert loaded.load()
+        assert 'cal1' in loaded
+        assert 'cal2' not in loaded
+        assert loaded.events('cal1', _t(21, 0), _t(27, 23)) == [Event(name='Meeting', start=_t(21, 9), end=_t(21, 10))]
+
+    def test_update_unchanged(self):
+        snapshot = EventSnapshot('/file/does/not/exist')
+        snapshot.calendars = {'cal1': [['Meeting', 1450688400, 1450692000]]}
+        snapshot.update('cal1', [Event(name='Meeting', start=_t(21, 9), end=_t(21, 10))])
+        assert not snapshot.dirty
+        snapshot.save()  # nothing to write
+
+    def test_events_window(self):
+        snapshot = EventSnapshot('/file/does/not/exist')
+        snapshot.update('cal1', [
+            Event(name='Before', start=_t(20, 9), end=_t(20, 10)),
+            Event(name='Overlapping', start=_t(20, 23), end=_t(21, 1)),
+            Event(name='Inside', start=_t(22, 9), end=_t(22, 10)),
+            Event(name='After', start=_t(28, 9), end=_t(28, 10)),
+        ])
+        assert [e.name for e in snapshot.events('cal1', _t(21, 0), _t(27, 23))] == ['Overlapping', 'Inside']
+        assert snapshot.events('cal2', _t(21, 0), _t(27, 23)) == []
+
+    def test_unknown_version(self):
+        path = os.path.join(tempfile.mkdtemp(), 'events.json')
+        with open(path, 'w') as f:
+            json.dump({'version': 99, 'calendars': {'cal1': []}}, f)
+        snapshot = EventSnapshot(path)
+        assert not snapshot.load()
+        assert snapshot.calendars == {}
+
+    def test_broken_file(self):
+        path = os.path.join(tempfile.mkdtemp(), 'events.json')
+        with open(path, 'w') as f:
+            f.write('{"version')
+        assert not EventSnapshot(path).load()
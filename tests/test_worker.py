@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 import datetime
+import os
 import pytest
+import tempfile
 import icalendar
 import pytz
 import sys
@@ -14,7 +16,12 @@ try:
 except ImportError:
     from io import StringIO
 from maxd.config import Configuration
-from maxd.worker import Worker, Schedule, _to_utc_datetime, Event
+from maxd.snapshot import EventSnapshot
+from maxd.resilience import DeadlineExceeded
+from maxd.worker import Worker, Schedule, _to_utc_datetime, Event, compact_periods
+from maxd.clock import VirtualClock
+from maxd.replay import Room
+from maxd.simulation import StubCube
 
 if sys.version_info.major == 2 or (sys.version_info.major == 3 and sys.version_info.minor <= 2):
     from mock import Mock, patch
@@ -49,6 +56,29 @@ class TestWorker(object):
         # daily event: 4 (2015-12-28 till 2015-12-31)
         assert len(filtered) == 5
 
+    def test_apply_range_filter_overlapping(self):
+        w = Worker(Configuration('/dev/null'))
+
+        with open('tests/fixtures/calendars/single_event.ics', 'r') as f:
+            events = [o for o in icalendar.Calendar.from_ical(f.read()).walk() if o.name == 'VEVENT']
+
+        # the event (09:00 - 10:00 UTC) started before 09:30, but overlaps the window
+        assert len(w.apply_range_filter(events, datetime.datetime(2015, 12, 20, tzinfo=pytz.UTC), datetime.datetime(2015, 12, 20, tzinfo=pytz.UTC))) == 1
+        assert len(w.apply_range_filter(events, datetime.datetime(2015, 12, 21, tzinfo=pytz.UTC), datetime.datetime(2015, 12, 21, tzinfo=pytz.UTC))) == 0
+
+    def test_fetch_events_uses_index(self):
+        w = Worker(Configuration('/dev/null'))
+        cc = CalendarConfig(name='test', url='tests/fixtures/calendars/repeating.ics')
+        w.expand_events = Mock(side_effect=w.expand_events)
+
+        start = datetime.datetime(2015, 12, 28, tzinfo=pytz.UTC)
+        end = datetime.datetime(2016, 1, 1, tzinfo=pytz.UTC)
+        assert len(w.fetch_events(cc, start, end)) == 5
+        assert w.expand_events.call_count == 1
+        assert len(w.expand_events.call_args[0][0]) == 2
+        assert len(w.fetch_events(cc, start, end)) == 5
+        assert w.expand_events.call_count == 1
+
     def test_apply_user_filter(self):
         w = Worker(Configuration('/dev/null'))
 
@@ -104,10 +134,10 @@ class TestWorker(object):
                 (datetime.datetime(2015, 12, 28, 7, 30, 00, tzinfo=pytz.UTC), datetime.datetime(2015, 12, 28, 9, 0, 00, tzinfo=pytz.UTC)),
             ],
             1: [ # 2015-12-29
-                # repeating weekly
-                (datetime.datetime(2015, 12, 29, 8, 30, 00, tzinfo=pytz.UTC), datetime.datetime(2015, 12, 29, 10, 0, 00, tzinfo=pytz.UTC)),
                 # repeating daily
                 (datetime.datetime(2015, 12, 29, 7, 30, 00, tzinfo=pytz.UTC), datetime.datetime(2015, 12, 29, 9, 0, 00, tzinfo=pytz.UTC)),
+                # repeating weekly
+                (datetime.datetime(2015, 12, 29, 8, 30, 00, tzinfo=pytz.UTC), datetime.datetime(2015, 12, 29, 10, 0, 00, tzinfo=pytz.UTC)),
             ],
             2: [ # 2015-12-30
                 (datetime.datetime(2015, 12, 30, 7, 30, 00, tzinfo=pytz.UTC), datetime.datetime(2015, 12, 30, 9, 0, 00, tzinfo=pytz.UTC)),
@@ -181,6 +211,391 @@ sunday = 17:00 - 18:00
             6: [(_dt_time(27, 15, 30), _dt_time(27, 17, 0))]
         }
 
+    def test_status(self):
+        w = Worker(Configuration('/dev/null'))
+        assert w.status() == {'effective_schedule': None, 'last_fetch': {}, 'timings': {}, 'breakers': {'cube': 'closed'},
+                              'expansion_overflows': {},
+                              'reconciliation': {'checked': 0, 'mismatched': 0, 'resent': 0, 'last_pass': None},
+                              'http_cache': None, 'changed_weekdays': [], 'overrides': {}}
+
+        w.connect_to_cube = Mock()
+        w.connect_to_cube.return_value.__enter__ = Mock(return_value=Mock(rooms=[]))
+        w.connect_to_cube.return_value.__exit__ = Mock(return_value=False)
+        with patch('maxd.worker.HTTPCalendarEventFetcher'):
+            w.execute()
+
+        status = w.status()
+        assert sorted(status['effective_schedule'].keys()) == ['Friday', 'Monday', 'Saturday', 'Sunday', 'Thursday', 'Tuesday', 'Wednesday']
+        assert set(['fetch', 'schedule', 'apply', 'total']) <= set(status['timings'].keys())
+
+    def test_execute_refresh(self):
+        w = Worker(Configuration('tests/fixtures/config/basic2.cfg'))
+        w.apply_schedule = Mock()
+        with patch('maxd.worker.HTTPCalendarEventFetcher') as http_mock:
+            http_mock.return_value.ttl = None
+            w.execute(refresh=['testcal1'])
+        assert http_mock.return_value.invalidate.call_count == 1
+        assert sorted(w.last_fetch.keys()) == ['testcal1', 'testcal2']
+
+    def test_compute_and_write(self):
+        clock = VirtualClock(datetime.datetime(2015, 12, 28, 9, tzinfo=pytz.UTC))
+        w = Worker(Configuration('tests/fixtures/config/simulation.cfg'), clock=clock)
+        w.apply_schedule = Mock()
+
+        state = w.compute()
+        assert state.room_schedules is None
+        assert set(['fetch', 'schedule']) <= set(state.timings.keys())
+        assert not w.apply_schedule.called
+
+        w.write(state)
+        assert w.apply_schedule.call_args[0][0] == state.schedule
+        assert set(['fetch', 'schedule', 'apply', 'total']) <= set(w.timings.keys())
+
+    def test_execute_refresh_due(self):
+        config = Configuration('tests/fixtures/config/simulation.cfg')
+        config.cfg_parser.set('testcal1', 'refresh', '3600')
+        clock = VirtualClock(datetime.datetime(2015, 12, 28, 9, tzinfo=pytz.UTC))
+        w = Worker(config, clock=clock)
+        w.apply_schedule = Mock()
+        fetcher = w.get_fetcher(config.calendars[0])
+
+        with patch.object(fetcher, 'fetch', side_effect=fetcher.fetch) as fetch_mock:
+            w.execute()
+            fetched = w.last_fetch['testcal1']
+            clock.advance(3599)
+            w.execute()
+            assert fetch_mock.call_count == 1
+            assert w.last_fetch['testcal1'] == fetched
+            assert w.pipelines['testcal1'].stats['fetch'].cached
+
+            clock.advance(1)
+            w.execute()
+            assert fetch_mock.call_count == 2
+
+            w.execute(refresh=['testcal1'])
+            assert fetch_mock.call_count == 3
+
+    def _snapshot_worker(self):
+        path = os.path.join(tempfile.mkdtemp(), 'events.json')
+        cfg = Configuration('tests/fixtures/config/basic2.cfg')
+        cfg.cfg_parser.set('GENERAL', 'snapshot', path)
+
+        now = datetime.datetime.now(tz=pytz.UTC).replace(hour=12, minute=0, second=0, microsecond=0)
+        snapshot = EventSnapshot(path)
+        snapshot.update('testcal1', [Event(name='Snapshot event', start=now, end=now + datetime.timedelta(hours=1))])
+        snapshot.save()
+
+        w = Worker(cfg)
+        w.apply_schedule = Mock()
+        w.sleep = Mock()
+        return w, now
+
+    def test_warm_start(self):
+        w, now = self._snapshot_worker()
+        assert w.warm_start()
+
+        schedule = w.apply_schedule.call_args[0][0]
+        assert (now - w.config.warmup_duration, now + datetime.timedelta(hours=1)) in schedule.events[now.weekday()]
+
+    def test_warm_start_without_snapshot(self):
+        assert not Worker(Configuration('tests/fixtures/config/basic2.cfg')).warm_start()
+
+    def test_warm_start_rooms(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'maxd.cfg')
+        with open(path, 'w') as f:
+            f.write("[GENERAL]\ncalendars = a, b\nsnapshot = %s\n\n"
+                    "[a]\nurl = tests/fixtures/calendars/repeating.ics\n\n"
+                    "[b]\nurl = tests/fixtures/calendars/single_event.ics\n\n"
+                    "[room:one]\nid = 1\ncalendars = a\n\n"
+                    "[room:two]\nid = 2\ncalendars = b\n\n"
+                    "[cube]\ntimezone = UTC\n" % os.path.join(directory, 'events.json'))
+
+        monday = datetime.datetime(2015, 12, 28, 12, tzinfo=pytz.UTC)
+        snapshot = EventSnapshot(os.path.join(directory, 'events.json'))
+        snapshot.update('a', [Event(name='A', start=monday, end=monday + datetime.timedelta(hours=1))])
+        tuesday = monday + datetime.timedelta(days=1)
+        snapshot.update('b', [Event(name='B', start=tuesday, end=tuesday + datetime.timedelta(hours=1))])
+        snapshot.save()
+
+        w = Worker(Configuration(path), VirtualClock(datetime.datetime(2015, 12, 28, tzinfo=pytz.UTC)))
+        cube = StubCube([Room(1, 'One', 1), Room(2, 'Two', 2), Room(9, 'Unmapped', 9)])
+        w.connect_to_cube = Mock(return_value=cube)
+        assert w.warm_start()
+
+        # every room gets the events of its own calendar, the unmapped room is left alone
+        assert sorted(set(room for room, _ in cube.programs)) == [1, 2]
+        assert len(cube.programs[(1, 0)]) == 3 and len(cube.programs[(1, 1)]) == 1
+        assert len(cube.programs[(2, 0)]) == 1 and len(cube.programs[(2, 1)]) == 3
+        assert w.effective_schedule['one']['Monday'] == [('2015-12-28T11:30:00+00:00', '2015-12-28T13:00:00+00:00')]
+
+    def test_execute_uses_snapshot(self):
+        w, now = self._snapshot_worker()
+
+        with patch('maxd.worker.HTTPCalendarEventFetcher') as http_mock:
+            http_mock.return_value.fetch.side_effect = Exception("Server down")
+            w.execute()
+
+        schedule = w.apply_schedule.call_args[0][0]
+        assert (now - w.config.warmup_duration, now + datetime.timedelta(hours=1)) in schedule.events[now.weekday()]
+
+    def test_execute_updates_snapshot(self):
+        w, now = self._snapshot_worker()
+
+        with patch('maxd.worker.HTTPCalendarEventFetcher') as http_mock:
+            http_mock.return_value.fetch.return_value = []
+            http_mock.return_value.ttl = None
+            w.execute()
+
+        loaded = EventSnapshot(w.snapshot.path)
+        loaded.load()
+        assert loaded.calendars == {'testcal1': [], 'testcal2': []}
+
+    def test_fetch_retries_and_breaker(self):
+        w = Worker(Configuration('tests/fixtures/config/basic2.cfg'))
+        w.apply_schedule = Mock()
+        w.sleep = Mock()
+
+        with patch('maxd.worker.HTTPCalendarEventFetcher') as http_mock:
+            http_mock.return_value.fetch.side_effect = Exception("Server down")
+            w.execute()
+            # two calendars, three attempts each, counted as one failure per calendar
+            assert http_mock.return_value.fetch.call_count == 6
+            assert [c[0][0] for c in w.sleep.call_args_list] == [1, 2, 1, 2]
+            assert w.status()['breakers'] == {'cube': 'closed', 'testcal1': 'closed', 'testcal2': 'closed'}
+
+            # the breakers open after breaker_threshold (3) failed ticks
+            w.execute()
+            w.execute()
+            assert http_mock.return_value.fetch.call_count == 18
+            assert w.status()['breakers'] == {'cube': 'closed', 'testcal1': 'open', 'testcal2': 'open'}
+
+            # open breakers: the calendars are not fetched at all
+            w.execute()
+            assert http_mock.return_value.fetch.call_count == 18
+
+    def test_fetch_deadline(self):
+        w = Worker(Configuration('tests/fixtures/config/basic2.cfg'))
+        w.apply_schedule = Mock()
+
+        with patch('maxd.worker.HTTPCalendarEventFetcher') as http_mock:
+            http_mock.return_value.fetch.return_value = []
+            w.execute()
+        deadline = http_mock.return_value.fetch.call_args[1]['deadline']
+        assert 119 < deadline.remaining() <= 120
+        assert w.apply_schedule.call_args[0][1] is deadline
+
+    def test_cube_session_retries(self):
+        w = Worker(Configuration('/dev/null'))
+        w.sleep = Mock()
+        cube = Mock()
+        cube.__enter__ = Mock(side_effect=[Exception("No route to host"), cube])
+        cube.__exit__ = Mock(return_value=False)
+        w.connect_to_cube = Mock(return_value=cube)
+
+        with w.cube_session() as session:
+            assert session is cube
+        assert w.connect_to_cube.call_count == 2
+        assert cube.__exit__.called
+
+    def test_apply_schedule_deadline(self):
+        w = Worker(Configuration('/dev/null'))
+        cube = Mock(rooms=[Mock(room_id=1, rf_address=1)])
+        cube.__enter__ = Mock(return_value=cube)
+        cube.__exit__ = Mock(return_value=False)
+        w.connect_to_cube = Mock(return_value=cube)
+
+        deadline = Mock()
+        deadline.check.side_effect = DeadlineExceeded()
+        with pytest.raises(DeadlineExceeded):
+            w.apply_schedule(w.get_static_schedule(datetime.datetime(2015, 12, 21, tzinfo=pytz.UTC)), deadline)
+        assert not cube.set_program.called
+        assert w._current_schedule is None
+
+    def _reload_worker(self, text):
+        path = os.path.join(tempfile.mkdtemp(), 'maxd.cfg')
+        with open(path, 'w') as f:
+            f.write(text)
+        w = Worker(Configuration(path))
+        w.apply_schedule = Mock()
+        return w, path
+
+    def test_reload_config(self):
+        text = "[GENERAL]\ncalendars = cal1, cal2\nhigh_temperature = 22\n\n" \
+               "[cal1]\nurl = tests/fixtures/calendars/repeating.ics\n\n" \
+               "[cal2]\nurl = tests/fixtures/calendars/single_event.ics\n"
+        w, path = self._reload_worker(text)
+        w.execute()
+        fetchers = dict(w._fetchers)
+        indexes = dict(w._indexes)
+        w._current_schedule = Mock()
+
+        # nothing changed: everything stays
+        assert w.reload_config() == {'calendars': [], 'rooms': [], 'schedule': False}
+        assert w._fetchers == fetchers and w._indexes == indexes
+        assert w._current_schedule is not None
+
+        # cal2 changed, cal1 kept
+        with open(path, 'w') as f:
+            f.write(text.replace('single_event.ics', 'feiertage.ics'))
+        assert w.reload_config() == {'calendars': ['cal2'], 'rooms': [], 'schedule': False}
+        assert list(w._indexes.keys()) == ['cal1'] and w._indexes['cal1'] is indexes['cal1']
+        assert [k[0] for k in w._fetchers] == ['cal1']
+        assert w.config.calendars[1].url == 'tests/fixtures/calendars/feiertage.ics'
+
+        # a new setpoint rewrites the program
+        with open(path, 'w') as f:
+            f.write(text.replace('22', '21').replace('single_event.ics', 'feiertage.ics'))
+        assert w.reload_config() == {'calendars': [], 'rooms': [], 'schedule': True}
+        assert w._current_schedule is None
+        assert w.config.high_temperature == 21
+
+    def test_reload_removed_calendar(self):
+        w, path = self._reload_worker("[GENERAL]\ncalendars = cal1\n\n[cal1]\nurl = tests/fixtures/calendars/repeating.ics\n")
+        w.execute()
+        assert 'cal1' in w.last_fetch
+
+        with open(path, 'w') as f:
+            f.write("[GENERAL]\ncalendars =\n")
+        assert w.reload_config() == {'calendars': ['cal1'], 'rooms': [], 'schedule': False}
+        assert w._fetchers == {} and w._indexes == {} and w.last_fetch == {}
+
+    def test_reload_changed_calendar_snapshot(self):
+        snapshot_path = os.path.join(tempfile.mkdtemp(), 'events.json')
+        text = "[GENERAL]\ncalendars = cal1, cal2\nsnapshot = %s\n\n" \
+               "[cal1]\nurl = tests/fixtures/calendars/repeating.ics\n\n" \
+               "[cal2]\nurl = tests/fixtures/calendars/single_event.ics\n" % snapshot_path
+        w, path = self._reload_worker(text)
+        w.execute()
+        assert 'cal1' in w.snapshot and 'cal2' in w.snapshot
+
+        # the events of the old url are no fallback for the new one
+        with open(path, 'w') as f:
+            f.write(text.replace('single_event.ics', 'feiertage.ics'))
+        w.reload_config()
+        assert 'cal1' in w.snapshot and 'cal2' not in w.snapshot
+
+    def test_reload_allday_range(self):
+        snapshot_path = os.path.join(tempfile.mkdtemp(), 'events.json')
+        text = "[GENERAL]\ncalendars = cal1\nallday = 06:00 - 23:00\nsnapshot = %s\n\n" \
+               "[cal1]\nurl = tests/fixtures/calendars/feiertage.ics\n" % snapshot_path
+        w, path = self._reload_worker(text)
+        w.clock = VirtualClock(datetime.datetime(2015, 12, 21, tzinfo=pytz.UTC))
+        w.execute()
+        assert 'cal1' in w.snapshot
+
+        with open(path, 'w') as f:
+            f.write(text.replace('06:00 - 23:00', '10:00 - 12:00'))
+        assert w.reload_config()['schedule']
+        assert w._indexes == {} and 'cal1' not in w.snapshot
+
+        # the all day events are expanded with the new range, like by a fresh worker
+        fresh = Worker(Configuration(path), VirtualClock(datetime.datetime(2015, 12, 21, tzinfo=pytz.UTC)))
+        start, end = w.get_window()
+        events = sorted(w.fetch_events(w.config.calendars[0], start, end))
+        assert events == sorted(fresh.fetch_events(fresh.config.calendars[0], start, end))
+        christmas = [e for e in events if e.name == '1. Weihnachtsfeiertag'][0]
+        assert christmas.end - christmas.start == datetime.timedelta(hours=2)
+
+    def test_write_after_reload(self):
+        text = "[GENERAL]\ncalendars = cal1\n\n[cal1]\nurl = tests/fixtures/calendars/repeating.ics\n"
+        w, path = self._reload_worker(text)
+        w.apply_room_schedules = Mock()
+        state = w.compute()
+
+        # the state computed for a single schedule isn't written with the rooms mapped now
+        with open(path, 'a') as f:
+            f.write("\n[room:office]\nid = 1\n")
+        w.reload_config()
+        w.write(state)
+        assert not w.apply_schedule.called and not w.apply_room_schedules.called
+
+        w.write(w.compute())
+        assert w.apply_room_schedules.called
+
+    def test_reload_invalid_config(self):
+        w, path = self._reload_worker("[GENERAL]\nhigh_temperature = 22\n")
+        with open(path, 'w') as f:
+            f.write("[GENERAL]\nhigh_temperature = hot\n")
+        assert w.reload_config() is None
+        assert w.config.high_temperature == 22
+
+    def _rooms_worker(self):
+        w = Worker(Configuration('tests/fixtures/config/rooms.cfg'))
+        w.clock = VirtualClock(datetime.datetime(2015, 12, 28, tzinfo=pytz.UTC))
+        cube = StubCube([Room(1, 'Office', 1), Room(2, 'Hall', 3), Room(3, 'Meeting room', 4), Room(4, 'Kitchen', 5)])
+        w.connect_to_cube = Mock(return_value=cube)
+        w.fetch_events = Mock(side_effect=w.fetch_events)
+        return w, cube
+
+    def test_room_schedules(self):
+        w, cube = self._rooms_worker()
+        w.execute()
+
+        # every calendar is fetched once
+        assert sorted(c[0][0].name for c in w.fetch_events.call_args_list) == ['single', 'weekly']
+        assert sorted(w.effective_schedule.keys()) == ['hall', 'meeting', 'office']
+        assert sorted(set(room for room, _ in cube.programs)) == [1, 2, 3]
+        assert cube.writes == 21
+
+        # office and hall share the calendar but not the temperature
+        office, hall = cube.programs[(1, 1)], cube.programs[(2, 1)]
+        assert [p.temperature for p in office] == [10, 21, 10]
+        assert [p.temperature for p in hall] == [10, 22, 10]
+
+        # the meeting room only gets the filtered event, not the weekly one
+        assert w.effective_schedule['office']['Tuesday'] == [('2015-12-29T07:30:00+00:00', '2015-12-29T10:00:00+00:00')]
+        assert w.effective_schedule['meeting']['Tuesday'] == [('2015-12-29T07:30:00+00:00', '2015-12-29T09:00:00+00:00')]
+
+        w.execute()
+        assert cube.writes == 21
+
+    def test_room_schedules_shared(self):
+        w, cube = self._rooms_worker()
+        schedules = w.create_room_schedules(w.get_window()[0], {'weekly': [], 'single': []})
+        assert schedules['office'] is schedules['hall']
+        assert schedules['office'] is not schedules['meeting']
+
+    def test_room_settings_changed(self):
+        w, cube = self._rooms_worker()
+        w.execute()
+
+        w.config.cfg_parser.set('room:hall', 'high_temperature', '19')
+        w.config._rooms = None
+        w.execute()
+        # only the days of the hall with a period get another program
+        assert cube.writes == 25
+        assert [p.temperature for p in cube.programs[(2, 1)]] == [10, 19, 10]
+
+    def test_boost(self):
+        w, cube = self._rooms_worker()
+        w.clock.advance(9 * 3600 + 10 * 60)
+        w.config.cfg_parser.set('cube', 'timezone', 'UTC')
+
+        result = w.boost(['office', 'Kitchen'])
+        end = datetime.datetime(2015, 12, 28, 10, 30, tzinfo=pytz.UTC)
+        assert result == {'rooms': ['Office', 'Kitchen'], 'until': end.isoformat()}
+        # the office gets the high temperature of its section, the unmapped kitchen the general one
+        assert cube.overrides == {1: (21, end), 4: (22, end)}
+        assert cube.writes == 0
+        assert w.status()['overrides'] == {'Office': end.isoformat(), 'Kitchen': end.isoformat()}
+
+        w.boost(['3'], datetime.timedelta(minutes=30), 21.5)
+        assert cube.overrides[3] == (21.5, datetime.datetime(2015, 12, 28, 10, tzinfo=pytz.UTC))
+
+        w.clock.advance(3600)
+        assert w.status()['overrides'] == {'Office': end.isoformat(), 'Kitchen': end.isoformat()}
+        w.clock.advance(1800)
+        assert w.status()['overrides'] == {}
+
+    def test_boost_unknown_room(self):
+        w, cube = self._rooms_worker()
+        with pytest.raises(Exception):
+            w.boost(['hall', 'cellar'])
+        with pytest.raises(Exception):
+            w.boost(['hall'], temperature=35)
+        assert cube.overrides == {}
+
 
 class TestSchedule(object):
 
@@ -328,6 +743,46 @@ class TestSchedule(object):
             ProgramSchedule(10, datetime.time(9), 1440),
         ]
 
+    def test_to_program_compaction(self):
+        def _t(h, m):
+            return datetime.datetime(2015, 12, 21, h, m, tzinfo=pytz.UTC)
+
+        # eight meetings need 17 slots. The two shortest gaps (10 minutes after 09:00 and 5 minutes after 13:00) are closed
+        schedule = Schedule({
+            0: [
+                (_t(7, 0), _t(8, 0)),
+                (_t(8, 30), _t(9, 0)),
+                (_t(9, 10), _t(10, 0)),
+                (_t(11, 0), _t(12, 0)),
+                (_t(12, 30), _t(13, 0)),
+                (_t(13, 5), _t(14, 0)),
+                (_t(15, 0), _t(16, 0)),
+                (_t(17, 0), _t(18, 0)),
+            ]
+        })
+        programs = list(schedule.to_program(0, 10, 20))
+
+        assert len(programs) == 13
+        assert [(p.begin_minutes, p.end_minutes) for p in programs if p.temperature == 20] == [
+            (7 * 60, 8 * 60),
+            (8 * 60 + 30, 10 * 60),
+            (11 * 60, 12 * 60),
+            (12 * 60 + 30, 14 * 60),
+            (15 * 60, 16 * 60),
+            (17 * 60, 18 * 60),
+        ]
+
+        # within the budget: nothing changes
+        assert len(list(schedule.to_program(0, 10, 20, max_slots=17))) == 17
+
+    def test_compact_periods(self):
+        assert compact_periods([], 6) == []
+        assert compact_periods([(5, 6), (1, 2)], 6) == [(1, 2), (5, 6)]
+        # equal gaps: the earlier one is merged first
+        assert compact_periods([(1, 2), (3, 4), (5, 6)], 2) == [(1, 4), (5, 6)]
+        assert compact_periods([(1, 2), (3, 4), (5, 6)], 1) == [(1, 6)]
+        assert compact_periods([(1, 2), (3, 4), (5, 6)], 0) == [(1, 6)]
+
     @patch('maxd.worker.HTTPCalendarEventFetcher')
     @patch('maxd.worker.LocalCalendarEventFetcher')
     def test_fetch_events_http(self, local_mock, http_mock):
@@ -346,6 +801,24 @@ class TestSchedule(object):
         assert local_mock.called
         assert not http_mock.called
 
+    @patch('maxd.worker.CalDAVCalendarEventFetcher')
+    @patch('maxd.worker.HTTPCalendarEventFetcher')
+    def test_fetch_events_caldav(self, http_mock, caldav_mock):
+        cc = CalendarConfig(name='test', url='http://localhost/cal/', caldav=True)
+        w = Worker(Configuration('tests/fixtures/config/local.cfg'))
+        start, end = datetime.datetime.now() - datetime.timedelta(days=6), datetime.datetime.now()
+        w.fetch_events(cc, start, end)
+        assert caldav_mock.called
+        assert not http_mock.called
+        caldav_mock.return_value.fetch.assert_called_with(cc, start, end, deadline=None)
+
+    @patch('maxd.worker.HTTPCalendarEventFetcher')
+    def test_fetcher_reused(self, http_mock):
+        cc = CalendarConfig(name='test', url='http://localhost/test.ics')
+        w = Worker(Configuration('tests/fixtures/config/local.cfg'))
+        assert w.get_fetcher(cc) is w.get_fetcher(cc)
+        assert http_mock.call_count == 1
+
 
 class TestFetcherUtils(object):
 